@@ -29,14 +29,13 @@ np.savetxt('gs_fermions_2x2x2.txt', data[indicies])
 
 
 import sys
-sys.path.append("../symmetry_stuff/")
-from lattice_object import LatticeObject
-
-for i in range(6):
-    latt = LatticeObject(contributions[i], [2,2,2])
-    latt.apply_charge_conjugation()
-    print(latt.to_int(), latt.to_int() == contributions[-i-1])
-    print("--")
+sys.path.append("../python_gauss_lattice/")
+from gauss_lattice.symmetry_ops import SymmetryOps
+
+ops = SymmetryOps([2,2,2])
+conjugated, _ = ops.apply(contributions, ops.compile('charge_conjugation'))
+for c, cc, expected in zip(contributions, conjugated, contributions[::-1]):
+    print(c, cc, cc == expected)
 
 
 state = data
@@ -0,0 +1,74 @@
+""" ----------------------------------------------------------------------------
+
+    bit_magic_benchmark.py - LR, December 2020
+
+    Micro-benchmark for the fermionic sign computation on 2x2x4 states: the
+    old bit-by-bit loops against the popcount versions in bit_magic and the
+    vectorized popcount over uint64 arrays.
+
+    If a state file is given (-f, as produced by state_finder.py), its states
+    are used, otherwise random 48 bit integers.
+
+---------------------------------------------------------------------------- """
+import argparse, time
+import numpy as np
+from gauss_lattice import HamiltonianBuilder
+from gauss_lattice.aux_stuff import read_all_states
+from gauss_lattice.bit_magic import count_particles, sum_occupancies_ordered, plaquette_sign_mask, popcount64
+
+
+def count_particles_loop(state, nb=64):
+    return sum([(state>>k)&1 for k in range(nb)])
+
+def sum_occupancies_loop(a, b, state):
+    o = 0
+    for k in range(b,a+1):
+        o += (state>>k)&1
+    return o
+
+def sign_loop(state, p, sum_occupancies):
+    """ The sign as computed in the original plaquette operator.
+    """
+    a = max(p)
+    n, new_state = 0, state
+    for k in range(4):
+        n += sum_occupancies(a, p[k], new_state)
+        new_state ^= 1 << p[k]
+    return (-1)**n
+
+
+def bench(label, f, n_calls):
+    ts = time.time()
+    f()
+    te = time.time()
+    print('{:<40s} {:10.2f} ms  ({:.3f} us/call)'.format(label, (te-ts)*1000, (te-ts)*1e6/n_calls))
+
+
+parser = argparse.ArgumentParser(description="Benchmark of the sign computation.")
+parser.add_argument('-f', metavar='', type=str, default=None, help='HDF5 state file of the 2x2x4 lattice.')
+parser.add_argument('-n', metavar='', type=int, default=20000, help='Number of states.')
+args = parser.parse_args()
+
+L = [2,2,4]
+if args.f:
+    states = [int(s) for s in read_all_states(L, filename=args.f)[:args.n]]
+else:
+    states = [int(s) for s in np.random.randint(0, 2**48, size=args.n, dtype=np.int64)]
+
+builder = HamiltonianBuilder({'L' : L}, states=[], silent=True)
+plaquettes = [p[:4] for p in builder.plaquettes]
+sign_masks = [plaquette_sign_mask(p) for p in plaquettes]
+n_signs = len(states)*len(plaquettes)
+print(f'{len(states)} states, {len(plaquettes)} plaquettes')
+
+bench('count_particles (loop)', lambda: [count_particles_loop(s) for s in states], len(states))
+bench('count_particles (bit_count)', lambda: [count_particles(s) for s in states], len(states))
+
+bench('sign (loop)', lambda: [sign_loop(s, p, sum_occupancies_loop) for s in states for p in plaquettes], n_signs)
+bench('sign (bit_count per link)', lambda: [sign_loop(s, p, sum_occupancies_ordered) for s in states for p in plaquettes], n_signs)
+bench('sign (one AND + bit_count)', lambda: [(-1)**((s & r).bit_count() + c) for s in states for r, c in sign_masks], n_signs)
+
+words = np.array(states, dtype=np.uint64)
+r = np.array([r for r, _ in sign_masks], dtype=np.uint64)
+c = np.array([c for _, c in sign_masks], dtype=np.int64)
+bench('sign (vectorized popcount64)', lambda: 1 - 2*((popcount64(words[:,None] & r[None,:]) + c) & 1), n_signs)
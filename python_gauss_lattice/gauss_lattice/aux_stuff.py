@@ -11,6 +11,7 @@ import h5py as hdf
 import numpy as np
 from itertools import product
 import datetime as dt
+from .winding import sector_of
 
 
 def timestamp():
@@ -186,6 +187,19 @@ def read_all_states(L, merged=True, basedir='./output/', filename=None):
     return states
 
 
+def sort_into_sectors(states, L):
+    """ Sorts a list (or array) of states into winding sectors. Returns a
+        dictionary that maps the winding tag (as used for the HDF5 datasets) to
+        the array of states in the sector.
+    """
+    states = np.asarray(states)
+    if not len(states):
+        return {}
+    w = sector_of(states, L)
+    sectors, inverse = np.unique(w, axis=0, return_inverse=True)
+    return {winding_tag(ws) : states[inverse.ravel() == k] for k, ws in enumerate(sectors.tolist())}
+
+
 def read_sequential_spectrum(filename):
     spectrum = []
     with hdf.File(filename, 'r') as f:
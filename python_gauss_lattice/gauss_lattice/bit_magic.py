@@ -5,7 +5,6 @@
     Some useful bit routines.
 
 ---------------------------------------------------------------------------- """
-from numba import jit
 import numpy as np
 
 def set_bits(bits):
@@ -17,21 +16,59 @@ def count_particles(state, nb=64):
     """ Counts particles, i.e., set bits, in an integer. Default: 64 bit, can
         be arbitrary.
     """
-    return sum([(state>>k)&1 for k in range(nb)])
+    return (int(state) & ((1 << nb) - 1)).bit_count()
 
-# def sum_occupancies(a, b, state):
-#     """ Sums all occupancies between index a and b, both inclusive. Order of a
-#         and b does not matter, will be from min to max.
-#     """
-#     return sum([(state>>k)&1 for k in range(min(a,b),max(a,b))])
+def range_mask(a, b):
+    """ Mask with all bits between index a and b set, both inclusive.
+        Assumes a >= b.
+    """
+    return (1 << (int(a)+1)) - (1 << int(b))
 
-# @jit(nopython=True)
 def sum_occupancies_ordered(a, b, state):
     """ Sums all occupancies between index a and b, both inclusive.
         Assumes a >= b.
+
+        Note: this works on Python integers of arbitrary length, compiled
+        versions for 64 bit states live in jit_kernels.py.
+    """
+    return (int(state) & range_mask(a, b)).bit_count()
+
+def plaquette_sign_mask(p):
+    """ Returns the parity mask r and the offset c, such that the fermionic
+        sign of flipping the plaquette p = [l1, l2, l3, l4, ...] in the state s
+        is (-1)**(popcount(s & r) + c), i.e., one AND and one popcount.
+
+        The sign of the plaquette operator is obtained by summing the
+        occupancies between the link p[k] and the largest link a = max(p),
+        while flipping the links one after another. Only the parity matters,
+        so the four ranges can be merged by XOR. The links that were already
+        flipped shift the sum by one each (whether they were occupied or not),
+        which only depends on the ordering of the link indices.
+    """
+    p = p[:4]
+    a = max(p)
+    r, c = 0, 0
+    for k in range(4):
+        r ^= range_mask(a, p[k])
+        c += sum([1 for j in range(k) if p[j] >= p[k]])
+    return r, c % 2
+
+
+# Masks for the SWAR population count (see, e.g., Hacker's Delight, ch. 5).
+_M1 = np.uint64(0x5555555555555555)
+_M2 = np.uint64(0x3333333333333333)
+_M4 = np.uint64(0x0f0f0f0f0f0f0f0f)
+_H01 = np.uint64(0x0101010101010101)
+
+def popcount64(x):
+    """ Counts the set bits of every element in an array of unsigned 64 bit
+        integers. Uses the numpy ufunc if available (numpy >= 2.0), otherwise
+        the classic SWAR reduction.
     """
-    o = 0
-    for k in range(b,a+1):
-        o += (state>>k)&1
-    return o
-    # return np.sum([(state>>k)&1 for k in range(b,a)])
+    x = np.asarray(x, dtype=np.uint64)
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(x).astype(np.uint8)
+    x = x - ((x >> np.uint64(1)) & _M1)
+    x = (x & _M2) + ((x >> np.uint64(2)) & _M2)
+    x = (x + (x >> np.uint64(4))) & _M4
+    return ((x * _H01) >> np.uint64(56)).astype(np.uint8)
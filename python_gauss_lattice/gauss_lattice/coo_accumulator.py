@@ -0,0 +1,94 @@
+""" ----------------------------------------------------------------------------
+
+    coo_accumulator.py - LR, December 2020
+
+    Collects the COO triplets of the Hamiltonian chunk by chunk. The entries are
+    written into preallocated typed arrays (int32 indices as long as the basis
+    allows it, int64 otherwise, int8 matrix elements) that grow geometrically,
+    so the peak memory is roughly the size of the final matrix plus one chunk.
+
+    Alternatively, the entries can be spilled to raw binary files in a
+    directory, which are memory-mapped once the construction is finished. Then
+    only one chunk is held in memory at any time.
+
+---------------------------------------------------------------------------- """
+import os
+import numpy as np
+
+
+def index_dtype(n_fock):
+    """ Smallest integer type that can hold all row/column indices.
+    """
+    return np.int32 if n_fock < 2**31 else np.int64
+
+
+class COOAccumulator(object):
+    """ Growable storage for COO triplets (row, col, data).
+    """
+    _fields = ('row', 'col', 'data')
+
+    def __init__(self, n_fock, capacity=2**16, spill_dir=None):
+        self.n_fock = n_fock
+        self.size = 0
+        self.dtypes = {'row' : index_dtype(n_fock), 'col' : index_dtype(n_fock), 'data' : np.int8}
+
+        self.spill_dir = spill_dir
+        if spill_dir is None:
+            self.arrays = {f : np.empty(capacity, dtype=self.dtypes[f]) for f in self._fields}
+        else:
+            os.makedirs(spill_dir, exist_ok=True)
+            self.files = {f : os.path.join(spill_dir, f'coo_{f}.bin') for f in self._fields}
+            self.handles = {f : open(self.files[f], 'wb') for f in self._fields}
+
+    def __len__(self):
+        return self.size
+
+    def _grow(self, n):
+        """ Makes room for at least n entries by doubling the capacity.
+        """
+        capacity = len(self.arrays['row'])
+        if n <= capacity:
+            return
+        while capacity < n:
+            capacity *= 2
+        for f in self._fields:
+            a = np.empty(capacity, dtype=self.dtypes[f])
+            a[:self.size] = self.arrays[f][:self.size]
+            self.arrays[f] = a
+
+    def append(self, row, col, data):
+        """ Adds a chunk of entries.
+        """
+        n = len(row)
+        if self.spill_dir is None:
+            self._grow(self.size + n)
+            for f, a in zip(self._fields, (row, col, data)):
+                self.arrays[f][self.size:self.size+n] = a
+        else:
+            for f, a in zip(self._fields, (row, col, data)):
+                np.asarray(a, dtype=self.dtypes[f]).tofile(self.handles[f])
+        self.size += n
+
+    def extend(self, chunks):
+        """ Appends all (row, col, data) chunks of an iterable, e.g., the
+            results of Pool.imap.
+        """
+        for chunk in chunks:
+            self.append(*chunk)
+        return self
+
+    def finalize(self):
+        """ Returns the (row, col, data) arrays. In spill mode, these are
+            read-only memory maps of the files.
+        """
+        if self.spill_dir is None:
+            return tuple(self.arrays[f][:self.size] for f in self._fields)
+
+        triplets = []
+        for f in self._fields:
+            self.handles[f].close()
+            if self.size:
+                triplets.append(np.memmap(self.files[f], dtype=self.dtypes[f], mode='r', shape=(self.size,)))
+            else:
+                triplets.append(np.zeros(0, dtype=self.dtypes[f]))
+        return tuple(triplets)
@@ -0,0 +1,175 @@
+""" ----------------------------------------------------------------------------
+
+    frontier_search.py - LR, December 2020
+
+    Breadth-first search through the states that are connected by plaquette
+    flips, level by level (used for the low-energy states). All sets of states
+    are sorted key arrays as in StateIndex, i.e., 8 bytes per state up to 64
+    links and 16 bytes per state up to 128 links.
+
+    In every level, the frontier is cut into chunks, which are expanded (all
+    plaquettes flipped at once, see plaquette_kernels.flip_plaquettes) and
+    deduplicated independently - in a process pool if requested. The sorted
+    children of the chunks are merged (concatenated and sorted with a stable
+    sort, which merges the sorted runs) and the states that were visited before
+    are removed with a bisection into the (sorted) visited states.
+
+    For searches that don't fit into memory, the levels can be kept on disk
+    instead, as sorted runs (one HDF5 dataset per level). Plaquette flips are
+    their own inverse, so a state reached from level k is in level k-1, k or
+    k+1 - the children only have to be compared with the current frontier (in
+    memory) and the run of the previous level, which is streamed block by
+    block. Hence only the frontier (and the next one) has to fit into memory.
+
+---------------------------------------------------------------------------- """
+import numpy as np
+import h5py as hdf
+from multiprocessing import Pool
+from .plaquette_kernels import state_words, flip_plaquettes
+from .state_index import StateIndex, _word_keys, sort_keys, searchsorted_keys, unique_keys
+
+
+def keys_to_words(keys, nw):
+    """ Inverse of the key representation, returns the word array.
+    """
+    return StateIndex.from_keys(keys, nw).words
+
+
+def merge_keys(runs):
+    """ Merges sorted key arrays into one sorted array without duplicates.
+    """
+    runs = [r for r in runs if len(r)]
+    if not runs:
+        return None
+    if len(runs) == 1:
+        return runs[0]
+    return unique_keys(sort_keys(np.concatenate(runs)))
+
+
+def difference_keys(keys, sorted_keys):
+    """ Returns the keys that are not in the sorted array sorted_keys.
+    """
+    if not len(sorted_keys) or not len(keys):
+        return keys
+    ind = searchsorted_keys(sorted_keys, keys)
+    found = ind < len(sorted_keys)
+    found[found] = sorted_keys[ind[found]] == keys[found]
+    return keys[~found]
+
+
+def expand_chunk(keys, masks, nw):
+    """ Returns the sorted (unique) keys of all states that are reached from
+        the chunk with a single plaquette flip.
+    """
+    _, children, _ = flip_plaquettes(keys_to_words(keys, nw), masks)
+    return unique_keys(sort_keys(_word_keys(children)))
+
+
+def _run_label(level):
+    return 'run_{:d}'.format(level)
+
+
+def write_run(filename, level, keys):
+    """ Stores the sorted keys of a level in the run file.
+    """
+    with hdf.File(filename, 'a') as f:
+        if _run_label(level) in f:
+            del f[_run_label(level)]
+        f.create_dataset(_run_label(level), data=keys)
+
+
+def read_run(filename, level, block_size=2**20):
+    """ Generator over the (sorted) blocks of the run of a level.
+    """
+    with hdf.File(filename, 'r') as f:
+        dset = f[_run_label(level)]
+        for k in range(0, dset.shape[0], block_size):
+            yield dset[k:k+block_size]
+
+
+def difference_run(keys, blocks):
+    """ Same as difference_keys, with the sorted array given as sorted blocks
+        (e.g., a run that is read from disk). Only the keys in the range of a
+        block are looked up in it.
+    """
+    keep = np.ones(len(keys), dtype=bool)
+    for block in blocks:
+        if not len(keys) or not len(block):
+            continue
+        start = searchsorted_keys(keys, block[:1])[0]
+        stop = searchsorted_keys(keys, block[-1:])[0]
+        if stop < len(keys) and keys[stop] == block[-1]:
+            stop += 1
+        ind = searchsorted_keys(block, keys[start:stop])
+        found = ind < len(block)
+        found[found] = block[ind[found]] == keys[start:stop][found]
+        keep[start:stop] &= ~found
+    return keys[keep]
+
+
+def read_runs(filename, n_levels=None):
+    """ Reads all levels from the run file and returns the sorted keys (only
+        for searches that fit into memory).
+    """
+    with hdf.File(filename, 'r') as f:
+        n_levels = n_levels if n_levels is not None else len(f)
+        return merge_keys([f[_run_label(level)][()] for level in range(n_levels)])
+
+
+# Worker side: every process holds the plaquette masks.
+_worker = {}
+
+def _init_worker(masks, nw):
+    _worker['masks'] = masks
+    _worker['n_words'] = nw
+
+def _expand_chunk(keys):
+    return expand_chunk(keys, _worker['masks'], _worker['n_words'])
+
+
+def frontier_levels(seed_states, masks, nw, n_threads=1, chunk_size=2**16, max_level=10000,
+                    run_file=None, block_size=2**20):
+    """ Generator over the levels of the search. Yields (level, frontier,
+        visited), where frontier holds the states that are first reached at
+        this level and visited all states up to (and including) this level,
+        both as sorted key arrays.
+
+        With a run file, the levels are written to disk and visited is None.
+        The file is truncated at the start.
+    """
+    visited = unique_keys(sort_keys(_word_keys(state_words(seed_states, nw))))
+    frontier, level = visited, 0
+    if run_file:
+        hdf.File(run_file, 'w').close()
+        write_run(run_file, 0, frontier)
+        visited = None
+
+    pool = Pool(n_threads, initializer=_init_worker, initargs=(masks, nw)) if n_threads > 1 else None
+    try:
+        while True:
+            yield level, frontier, visited
+            if not len(frontier) or level >= max_level:
+                return
+
+            chunks = [frontier[k:k+chunk_size] for k in range(0, len(frontier), chunk_size)]
+            if pool is not None:
+                children = pool.imap_unordered(_expand_chunk, chunks)
+            else:
+                children = (expand_chunk(c, masks, nw) for c in chunks)
+            children = merge_keys(children)
+            if children is None:
+                children = frontier[:0]
+
+            if run_file:
+                children = difference_keys(children, frontier)
+                if level > 0:
+                    children = difference_run(children, read_run(run_file, level-1, block_size))
+                frontier = children
+                write_run(run_file, level+1, frontier)
+            else:
+                frontier = difference_keys(children, visited)
+                visited = merge_keys([visited, frontier])
+            level += 1
+    finally:
+        if pool is not None:
+            pool.terminate()
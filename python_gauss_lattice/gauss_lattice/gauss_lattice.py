@@ -7,14 +7,34 @@
 
 ---------------------------------------------------------------------------- """
 import numpy as np
-import math, os, datetime
-import h5py as hdf
-from itertools import product
-from queue import Empty, Queue
+import math, os, datetime, time
+from itertools import product, islice
 from multiprocessing import Pool
 from .aux_stuff import winding_tag, charge_tag
+from .bit_magic import popcount64
+from .plaquette_kernels import n_words, state_words, words_to_states
+from .winding import winding_links, winding_shape, winding_numbers, sector_of, plane_links
+from .state_writer import SectorWriter
+from .state_counter import count_sectors
 import sys
 
+
+# Worker side of the parallel search: every process holds a copy of the lattice.
+_worker = {}
+
+def _init_worker(glatt):
+    _worker['lattice'] = glatt
+
+def _pack(counts, b):
+    """ Packs non-negative integers into fields of b bits of a single integer.
+    """
+    return sum(int(c) << (b*j) for j, c in enumerate(counts))
+
+def _search_subtree(args):
+    index, task = args
+    return (index,) + _worker['lattice']._search_subtree(task)
+
+
 class GaussLattice(object):
     """ Represents a Gauss lattice in arbitrary dimension.
 
@@ -79,6 +99,7 @@ class GaussLattice(object):
         self.mpos, self.mneg = self.create_gls_masks(ind_gls)
         self.checkable_gls = self.find_checkable_gls(ind_bs, ind_gls)
         assert len(self.checkable_gls[-1]) == self.N_sublattice
+        self.check_tables = self.compile_check_tables()
 
 
         # Initialize winding number bins.
@@ -92,6 +113,15 @@ class GaussLattice(object):
             else:
                 self.ds_label = "all-ws"
 
+        # Optionally, only the states of one winding sector (given as index of
+        # the histogram, i.e., as in the labels of the HDF5 datasets).
+        self.target = kwargs.get('winding_sector')
+        if self.target is not None:
+            if not self.use_winding:
+                raise ValueError('A target winding sector requires a lattice without static charges.')
+            self.target = tuple(int(w) for w in self.target)
+            self.winding_bounds = self.compile_winding_bounds(self.target)
+
 
         # ----------------------------------------------------------------------
         # Some settings for storage and I/O.
@@ -114,20 +144,29 @@ class GaussLattice(object):
         if self.write_states:
             # Writing to file should happen through a buffer, since otherwises
             # we'd need to do a costly file I/O operation after every state,
-            # which greatly slows down the calculation. In order to circumvent
-            # race conditions in the recursion, the buffer is realized as a queue,
-            # which handles multi-producer data quite well (the order does not
-            # really matter for us anyways). There's some price to pay in terms
-            # of runtime, but it's generally not the bottleneck.
+            # which greatly slows down the calculation. The states are handed
+            # to the writer in batches (and sorted into sectors there), which
+            # flushes the buffers of all sectors at once when they are full.
             buf_len = kwargs.get('buffer_length')
             if buf_len is None:
                 buf_len = 1e6
-            self.buffer = Queue(maxsize=buf_len)
 
             # Initialize the file.
             append = kwargs.get('append_states', False)
-            print(append)
-            self._init_file(state_file, append=append)
+            self._init_file(state_file, append=append, buffer_length=buf_len,
+                            compression=kwargs.get('compression', 'gzip'),
+                            resume=kwargs.get('resume', False))
+
+        # With HDF5 output, the search is split into subtrees and the finished
+        # ones are recorded in the file every checkpoint_interval seconds, such
+        # that an interrupted run can be resumed (resume=True).
+        self.checkpoint_interval = kwargs.get('checkpoint_interval', 60)
+        self.checkpoints = self.write_states and self.output_format == 'hdf5' \
+            and self.checkpoint_interval is not None
+
+        # Number of states that are enumerated before they are counted and
+        # handed to the writer.
+        self.batch_size = kwargs.get('batch_size', 2**16)
 
 
     @staticmethod
@@ -308,26 +347,43 @@ class GaussLattice(object):
         """ Returns masks to check the violation of Gauss law. There are two
             contributions: positive and negative. Both are returned as separate
             dictioinaries that map the lattice index (on the full lattice) to the
-            indices and the integer representation of the lattice with only the
-            two corresponding indicies set.
+            integer representation of the lattice with only the links of the
+            corresponding direction set.
         """
         mpos, mneg = {}, {}
-        for j, s in enumerate(gls):
+        for s in gls:
             i = self.get_vertex_links(s)
-            mpos[s] = i[::2]
-            mneg[s] = i[1::2]
+            mpos[s] = sum(1 << p for p in i[::2])
+            mneg[s] = sum(1 << n for n in i[1::2])
+        return mpos, mneg
 
-            platt = 0
-            for p in mpos[s]:
-                platt += 1 << p
-            mpos[s].append(platt)
 
-            nlatt = 0
-            for n in mneg[s]:
-                nlatt += 1 << n
-            mneg[s].append(nlatt)
+    def compile_check_tables(self):
+        """ Compiles the Gauss law checks into flat tables per level. Since the
+            sites that are checkable at a level stay checkable (and unchanged)
+            at all higher levels, every level only holds the sites that become
+            checkable with it. For every such site we store
 
-        return mpos, mneg
+                masks       (positive mask, negative mask, static charge) as
+                            Python integers for single states,
+                pos, neg    the masks as word arrays (n_sites, n_words),
+                charge      the static charges as array,
+
+            the latter for checking batches of states at once.
+        """
+        nw = n_words(self.bitlen)
+        tables, checked = [], set()
+        for sites in self.checkable_gls:
+            new = [g for g in sites if g not in checked]
+            checked.update(new)
+            tables.append({
+                'sites' : new,
+                'masks' : [(self.mpos[g], self.mneg[g], self.static_charges[g]) for g in new],
+                'pos' : state_words([self.mpos[g] for g in new], nw).reshape(-1, nw),
+                'neg' : state_words([self.mneg[g] for g in new], nw).reshape(-1, nw),
+                'charge' : np.array([self.static_charges[g] for g in new], dtype=np.int64),
+            })
+        return tables
 
 
     def find_checkable_gls(self, bs, gls):
@@ -369,237 +425,387 @@ class GaussLattice(object):
         return cstates
 
 
+    def compile_winding_bounds(self, target):
+        """ Compiles the bounds for the search of a single winding sector.
+            Without static charges, the winding number of a direction is the
+            number of occupied links in any plane perpendicular to it, so we
+            track the partial counts of all of these planes. After placing the
+            vertex of a level, every count has to stay within
+
+                target - (maximal remaining contribution) <= count
+                count <= target - (minimal remaining contribution),
+
+            where the remaining contributions come from the vertices of the
+            higher levels. The counts are packed into a single integer, with
+            fields of b bits (the top bit of every field is a guard bit), such
+            that both bounds are checked with one subtraction each:
+
+                (count + guard - lower) & guard == guard   <=>   count >= lower
+
+            and likewise for the upper bound. The table holds
+
+                planes      masks of all planes (Python integers),
+                words       the masks as word array (n_planes, n_words),
+                contrib     packed counts of every vertex of every level,
+                lower       packed lower bounds after every level,
+                upper       packed upper bounds after every level,
+                guard       the guard bits,
+                bits        the width b of the fields,
+                bounds      the bounds as arrays (n_levels, n_planes),
+
+            the latter for the batched check of the prefixes.
+        """
+        shape = winding_shape(self.L)
+        if len(target) != self.d or any(not 0 <= t < n for t, n in zip(target, shape)):
+            raise ValueError(f'Winding sector {target} does not exist on this lattice.')
+
+        planes, targets = [], []
+        for t, links in zip(target, plane_links(self.L)):
+            for p in links:
+                planes.append(sum(1 << k for k in p))
+                targets.append(t)
+        targets = np.array(targets)
+
+        b = int(max(shape)).bit_length() + 1
+        guard = _pack([1 << (b-1)]*len(planes), b)
+
+        # Contributions of the vertices and what can still come after a level.
+        contrib = [
+            np.array([[(v & m).bit_count() for m in planes] for v in vertices]) for vertices in self.lattice_base
+        ]
+        remaining = [(np.zeros(len(planes), dtype=int), np.zeros(len(planes), dtype=int))]
+        for c in contrib[:0:-1]:
+            lo, hi = remaining[0]
+            remaining.insert(0, (lo + c.min(axis=0), hi + c.max(axis=0)))
+
+        lower, upper, bounds = [], [], []
+        for lo, hi in remaining:
+            a, z = np.maximum(targets - hi, 0), targets - lo
+            if np.any(z < 0):
+                # Can't be reached anymore.
+                a, z = np.ones_like(a), np.zeros_like(z)
+            lower.append(_pack(a, b))
+            upper.append(_pack(z, b))
+            bounds.append((a, z))
+
+        return {
+            'planes' : planes,
+            'words' : state_words(planes, n_words(self.bitlen)),
+            'contrib' : [[_pack(c, b) for c in level] for level in contrib],
+            'lower' : lower,
+            'upper' : upper,
+            'guard' : guard,
+            'bounds' : bounds,
+            'bits' : b,
+        }
+
+
     def check_lattice(self, latt, level):
         """ Checks whether the provided lattice string is valid. Also works on
             partial lattice information, however, only check the "checkable"
             states in this case.
         """
-        # Loop through all checkable sates at this order.
-        for g in self.checkable_gls[level]:
-            # We initialize with the static charge, then add the field lines,
-            # in the end this should add up to 0 for GL to be valid.
-            s = -self.static_charges[g]
-
-            # Sum positive contributions.
-            platt = latt & self.mpos[g][-1]
-            for p in self.mpos[g][:-1]:
-                s += (platt >> p) & 1
+        return all(self.check_level(latt, l) for l in range(level+1))
 
-            # Sum negative contributions.
-            nlatt = latt & self.mneg[g][-1]
-            for n in self.mneg[g][:-1]:
-                s -= (nlatt >> n) & 1
 
-            # If nonzero, GL is violated.
-            if s:
+    def check_level(self, latt, level):
+        """ Checks only the sites that become checkable at the given level, which
+            is all that needs to be done if the partial state was valid before
+            adding the vertex of this level. The field lines of a site have to
+            add up to its static charge.
+        """
+        for pos, neg, charge in self.check_tables[level]['masks']:
+            if (latt & pos).bit_count() - (latt & neg).bit_count() != charge:
                 return False
         return True
 
 
-    def _find_states(self, prefix):
-        """ Finds all possible states of length L that can be constructed from the base,
-            which holds all possible basis states.
+    def check_batch(self, words, level):
+        """ Vectorized version of check_level for a batch of (partial) states
+            given as word array of shape (n_states, n_words). Returns a boolean
+            mask of the states that pass.
         """
-        # Convert to binary representation.
-        latt = self.base_to_link(prefix)
-        l = len(prefix)
-
-        # For any system with static charges the condition with the length of the prefix
-        # is crucial!
-        if not l or self.check_lattice(latt, len(prefix)-1):
-            if not l-self.N_sublattice:
-                self._collect_state(latt)
-                return
-            for b in self.spatial_base_elements[l]:
-                self._find_states(prefix+b)
-            return
-        return
+        table = self.check_tables[level]
+        if not len(table['sites']):
+            return np.ones(len(words), dtype=bool)
+        pos = popcount64(words[:,None,:] & table['pos'][None,:,:]).sum(axis=2, dtype=np.int64)
+        neg = popcount64(words[:,None,:] & table['neg'][None,:,:]).sum(axis=2, dtype=np.int64)
+        return np.all(pos - neg == table['charge'][None,:], axis=1)
 
 
-    def find_states(self):
-        """ Wraps the recursive function for external use.
+    def __getstate__(self):
+        """ The lattice is sent to worker processes without the writer (the
+            workers only enumerate, all output goes through the parent).
         """
-        self._find_states([])
-        if self.write_states:
-            self._flush_buffer()
-        return self.winding_bins
+        state = self.__dict__.copy()
+        state.pop('writer', None)
+        state['write_states'] = False
+        return state
+
+
+    def _search(self, latt=0, level=0):
+        """ Depth-first search through all states that can be constructed from
+            the partial state latt, which holds the basis vertices of the first
+            level sites (level = 0 is the empty lattice). Generator over all
+            states that obey Gauss' law.
+
+            The search uses an explicit stack: the partial states and the next
+            basis vertex to try are kept per level, such that pushing a vertex
+            is a single addition (the vertices don't share any links) and
+            popping is free.
+        """
+        N, base = self.N_sublattice, self.lattice_base
+        partial = [0]*(N+1)
+        choice = [0]*(N+1)
+        partial[level] = latt
+
+        # Packed partial winding counts, if we search a single sector.
+        wb = self.winding_bounds if self.target is not None else None
+        if wb is not None:
+            counts = [0]*(N+1)
+            counts[level] = _pack([(latt & m).bit_count() for m in wb['planes']], wb['bits'])
+            contrib, lower, upper, guard = wb['contrib'], wb['lower'], wb['upper'], wb['guard']
+
+        l = level
+        while l >= level:
+            if l == N:
+                yield partial[N]
+                l -= 1
+                continue
+
+            k = choice[l]
+            if k == len(base[l]):
+                choice[l] = 0
+                l -= 1
+                continue
+            choice[l] = k+1
+
+            # For any system with static charges the check at every level is
+            # crucial!
+            latt = partial[l] + base[l][k]
+            if self.check_level(latt, l):
+                if wb is not None:
+                    c = counts[l] + contrib[l][k]
+                    if (c + guard - lower[l]) & guard != guard or (upper[l] + guard - c) & guard != guard:
+                        continue
+                    counts[l+1] = c
+                partial[l+1] = latt
+                l += 1
+
+
+    def prefixes(self, depth):
+        """ Returns all valid partial states with the first depth basis vertices
+            set. These are the roots of independent subtrees of the search.
+
+            This is a breadth-first expansion with batched checks: all partial
+            states of a level are combined with all basis vertices of the next
+            site at once (the vertices don't share links with the partial
+            states, so the combination is a bitwise or).
+        """
+        nw = n_words(self.bitlen)
+        words = np.zeros((1, nw), dtype=np.uint64)
+        for l in range(depth):
+            base = state_words(self.lattice_base[l], nw).reshape(-1, nw)
+            words = (words[:,None,:] | base[None,:,:]).reshape(-1, nw)
+            words = words[self.check_batch(words, l)]
+            if self.target is not None:
+                words = words[self.check_winding_batch(words, l)]
+        return words_to_states(words)
+
+
+    def check_winding_batch(self, words, level):
+        """ Checks whether the partial states (as word array) with the vertices
+            up to level set can still reach the target winding sector.
+        """
+        wb = self.winding_bounds
+        counts = popcount64(words[:,None,:] & wb['words'][None,:,:]).sum(axis=2, dtype=np.int64)
+        lo, hi = wb['bounds'][level]
+        return np.all((counts >= lo) & (counts <= hi), axis=1)
 
 
-    def _collect_state(self, latt):
-        """ Does all the counting and whatever else is needed.
+    def split_depth(self, n_tasks):
+        """ Smallest prefix depth that yields at least n_tasks subtrees.
         """
-        # Optional output for 3D calculations, so that we see some progress.
-        s = self.winding_bins.sum()
-        if not s % 100000:
-            print(datetime.datetime.now().strftime("%H:%M:%S") + ' - {:d}'.format(s))
+        for depth in range(self.N_sublattice):
+            if len(self.prefixes(depth)) >= n_tasks:
+                return depth
+        return self.N_sublattice
 
-        if self.use_winding:
-            w = self.get_winding_numbers(latt)
-            self.winding_bins[tuple(w)] += 1
 
+    def _search_subtree(self, args):
+        """ Enumerates the subtree below a prefix, returns the winding
+            histogram of the subtree and (if requested) the states together with
+            their winding numbers.
+        """
+        latt, level, keep_states = args
+        states = list(self._search(latt, level))
+        bins = np.zeros_like(self.winding_bins)
+        if not self.use_winding:
+            bins[0] = len(states)
+            return bins, states if keep_states else [], None
+
+        # The winding numbers of the whole subtree at once.
+        w = sector_of(states, self.L)
+        np.add.at(bins, tuple(w.T), 1)
+        return bins, states if keep_states else [], w if keep_states else None
+
+
+    def find_states(self, n_threads=1, split_depth=None):
+        """ Finds all states that obey Gauss' law.
+
+            With n_threads > 1, the search tree is split at split_depth (by
+            default such that there are about 8 subtrees per process) and the
+            subtrees are enumerated by a process pool. The winding histograms of
+            the workers are merged, the states are written by this process.
+
+            With checkpoints, the serial search is split as well (into at least
+            64 subtrees). When resuming, the split depth of the checkpoint is
+            used and only the unfinished subtrees are enumerated.
+        """
+        if n_threads == 1 and not self.checkpoints:
+            search = self._search()
+            for states in iter(lambda: list(islice(search, self.batch_size)), []):
+                self._collect_batch(states)
             if self.write_states:
-                self.buffer.put([latt] + w)
-        else:
-            self.winding_bins[0] += 1
-            if self.write_states:
-                self.buffer.put([latt, self.ds_label])
+                self.writer.flush()
+            return self.winding_bins
+
+        restored = self.writer.restored if self.write_states else {}
+        if restored:
+            split_depth = int(restored['depth'])
+        elif split_depth is None:
+            split_depth = self.split_depth(8*n_threads if n_threads > 1 else 64)
+
+        prefixes = self.prefixes(split_depth)
+        done = np.zeros(len(prefixes), dtype=bool)
+        if restored:
+            done = np.unpackbits(restored['done'])[:len(prefixes)].astype(bool)
+            self.winding_bins[...] = restored['bins']
+        todo = [i for i in range(len(prefixes)) if not done[i]]
+        print(f'Enumerating {len(todo)} of {len(prefixes)} subtrees (prefix depth {split_depth}) with {n_threads} processes.')
+
+        last = time.time()
+        for i in self._enumerate_subtrees(prefixes, todo, split_depth, n_threads):
+            done[i] = True
+            if self.checkpoints and time.time() - last >= self.checkpoint_interval:
+                self._checkpoint(split_depth, done)
+                last = time.time()
+
+        if self.checkpoints:
+            self._checkpoint(split_depth, done)
+        elif self.write_states:
+            self.writer.flush()
+        return self.winding_bins
+
 
-        # Flush buffer, if full.
-        if self.buffer.full():
-            self._flush_buffer()
+    def count_states(self):
+        """ Returns the number of states per winding sector (the histogram of
+            find_states) without enumerating the states, see state_counter.py.
+        """
+        return count_sectors(self)
 
 
-    def get_winding_numbers(self, latt):
-        """ Computes the winding numbers for every direction from a state in the
-            basis-vertex string representation.
+    def _enumerate_subtrees(self, prefixes, todo, depth, n_threads):
+        """ Enumerates the subtrees below the prefixes with indices todo and
+            collects their states. Generator over the indices of the finished
+            subtrees.
         """
-        # Compute all Winding numbers.
-        w = []
-        for i, wm in enumerate(self.winding_masks):
-            winding = 0
-            for k in wm:
-                winding += (latt >> int(k))&1
-            # w[i] = w[i] // self.L[i]
-            w.append(winding)
-        return w
+        if n_threads == 1:
+            for i in todo:
+                search = self._search(prefixes[i], depth)
+                for states in iter(lambda: list(islice(search, self.batch_size)), []):
+                    self._collect_batch(states)
+                yield i
+            return
 
+        tasks = [(i, (prefixes[i], depth, self.write_states)) for i in todo]
+        with Pool(n_threads, initializer=_init_worker, initargs=(self,)) as pool:
+            for i, bins, states, w in pool.imap_unordered(_search_subtree, tasks):
+                self.winding_bins += bins
+                self._write_batch(states, w)
+                self._print_progress()
+                yield i
 
-    def prepare_winding_numbers(self):
-        """ Computes the indices to be summed over for the different winding
-            numbers.
+
+    def _checkpoint(self, depth, done):
+        """ Writes all collected states and records the finished subtrees (and
+            the histogram so far) in the state file.
         """
-        L, S, d = self.L, self.S, self.d
+        self.writer.checkpoint(depth=depth, done=np.packbits(done), bins=self.winding_bins)
 
-        # Find the indices and shifts along the axes. The indices in this case
-        # are of the site on the lattice, without pointing to a specific link yet.
-        # The shift moves a piont on the axis to the opposite side of the lattice.
-        e = []
-        for i in range(1,d+1):
-            e.append(np.arange(0,S[i],S[i-1])*d)
 
-        if self.d == 2:
-            winding_bins = np.zeros(shape=tuple(L[::-1]+1), dtype=np.int)
+    def _collect_batch(self, states):
+        """ Does all the counting and whatever else is needed for a batch of
+            states.
+        """
+        if self.use_winding:
+            w = sector_of(states, self.L)
+            np.add.at(self.winding_bins, tuple(w.T), 1)
+        else:
+            w = None
+            self.winding_bins[0] += len(states)
+        self._write_batch(states, w)
+        self._print_progress()
 
-            # In 2D these are just along one axis.
-            winding_masks = [
-                e[1],
-                e[0]+1
-            ]
 
-        if self.d == 3:
-            shape = tuple(np.array([
-                L[1]*L[2] + 1,
-                L[0]*L[2] + 1,
-                L[0]*L[1] + 1
-            ]))
-            winding_bins = np.zeros(shape=shape, dtype=np.int)
+    def _write_batch(self, states, w):
+        """ Hands the states (and their winding numbers w) to the writer.
+        """
+        if not self.write_states or not len(states):
+            return
+        if self.use_winding:
+            self.writer.add_batch(states, w)
+        else:
+            self.writer.add((self.ds_label,), states)
 
-            winding_masks = []
 
-            # In 3D we have to sum over entire faces of the cube - here we
-            # construct the indices for all of them.
-            wmx = []
-            for j in range(L[2]):
-                wmx = np.concatenate((wmx, np.arange(j*3*S[2], 3*(j*S[2]+S[2]), 3*S[1])))
-            winding_masks.append(np.array(wmx, dtype=np.int))
-            # winding_masks.append(np.arange(0,3*S[3],3))
+    def _print_progress(self):
+        """ Optional output for 3D calculations, so that we see some progress.
+        """
+        print(datetime.datetime.now().strftime("%H:%M:%S") + ' - {:d}'.format(self.winding_bins.sum()))
 
 
-            wmy = []
-            for j in range(L[2]):
-                wmy = np.concatenate((wmy, np.arange(j*3*S[2], 3*(j*S[2]+S[1]), 3*S[0])))
-            winding_masks.append(np.array(wmy, dtype=np.int)+1)
-            # winding_masks.append(np.arange(1,3*S[3],3))
+    def get_winding_numbers(self, latt):
+        """ Computes the winding numbers for every direction from a state in the
+            basis-vertex string representation.
+        """
+        return list(winding_numbers(latt, self.L))
 
-            wmz = []
-            for j in range(L[0]):
-                wmz = np.concatenate((wmz, np.arange(j*3*S[1], 3*(j*S[1]+S[1]), 3*S[0])))
-            winding_masks.append(np.array(wmz, dtype=np.int)+2)
-            # winding_masks.append(np.arange(2,3*S[3],3))
 
-        return winding_bins, winding_masks
+    def prepare_winding_numbers(self):
+        """ Sets up the histogram of the winding sectors and returns it with
+            the indices to be summed over for the different winding numbers.
+        """
+        winding_bins = np.zeros(shape=winding_shape(self.L), dtype=np.int64)
+        return winding_bins, winding_links(self.L)
 
 
 
     # ==========================================================================
     # I/O stuff.
 
-    def _init_file(self, state_file, append=False):
-        """ Sets up the state output.
+    def _init_file(self, state_file, append=False, **kwargs):
+        """ Sets up the state output. Additional arguments are passed on to the
+            writer.
         """
         self.state_file = self.out_dir + '/' + state_file
         self.output_format = state_file.split('.')[-1]
 
-        if self.output_format == 'hdf5':
-            with hdf.File(self.state_file, 'a' if append else 'w') as f:
-                # We can loop through all winding number sectors with the product
-                # functions, which is essentially a cartesian product generator.
-                ds_labels = []
-                if self.use_winding:
-                    winding_indicies = product(*map(lambda n: range(n), self.winding_bins.shape))
-                    for ws in winding_indicies:
-                        ds_labels.append(winding_tag(ws))
-                else:
-                    ds_labels = [self.ds_label]
-
-                for ds_label in ds_labels:
-                    if ds_label in f:
-                        del f[ds_label]
-                    dset = f.create_dataset(
-                        ds_label,
-                        (0,),
-                        maxshape=(None,),
-                        dtype='i8',
-                        chunks=True
-                    )
+        # We can loop through all winding number sectors with the product
+        # functions, which is essentially a cartesian product generator.
+        if self.target is not None:
+            sectors, label = [self.target], winding_tag
+            name = winding_tag(self.target)
+        elif self.use_winding:
+            sectors = list(product(*map(lambda n: range(n), self.winding_bins.shape)))
+            label, name = winding_tag, 'all-ws'
         else:
-            # Attention: truncates existing file.
-            with open(self.state_file, 'w') as f:
-                # This is a dimensional "limitation" - works only for up to 3D.
-                labels = np.array(['x', 'y', 'z'])[:self.d]
-                f.write('state,' + ('w_{:s},'*self.d).format(*labels)[:-1] + '\n')
-
-
-    def _flush_buffer(self):
-        """ Writes the buffer to file and clears it.
-        """
-        # Writing with the HDF5 format requires some extra work, since we want to
-        # also sort it by winding sector. To do this, we need to first sort the
-        # corresponding winding sectors and then loop through all of them to append
-        # to the file.
-        # We could, alternatively, append to the HDF5 datasets one-by-one, but
-        # this will likely increase the overhead in file storage time and disk
-        # space significantly (I say that without testing it though).
-        if self.output_format == 'hdf5':
-
-            # Sorting (probably inefficient, but this is a rare task).
-            wn_dict = {}
-            try:
-                for line in iter(self.buffer.get_nowait, None):
-                    state, ws = line[0], tuple(line[1:])
-                    wlist = wn_dict.get(ws)
-                    if not wlist:
-                        wn_dict[ws] = [state]
-                    else:
-                        # For all the C-programmers who may or may not make it to this
-                        # point: this works, because Python defaults to call-by-reference!
-                        wlist.append(state)
-            except Empty:
-                pass
-
-            # Write to HDF5 file.
-            with hdf.File(self.state_file, 'a') as f:
-                for ws, states in wn_dict.items():
-                    ds_tag = winding_tag(ws) if self.use_winding else ws[0] # Somewhat dirty hack to make the code work for non-winding sorted stuff as well.
-                    dset = f[ds_tag]
-                    dset.resize(dset.shape[0]+len(states), axis=0)
-                    dset[-len(states):] = states
+            sectors = [(self.ds_label,)]
+            label = lambda key: key[0]
+            name = self.ds_label
 
-        else:
-            # Iterates through the queue and empties it in a FIFO manner.
-            with open(self.state_file, 'a+') as f:
-                try:
-                    for line in iter(self.buffer.get_nowait, None):
-                        f.write(','.join(map(str, line))+'\n')
-                except Empty:
-                    pass
+        # This is a dimensional "limitation" - works only for up to 3D.
+        labels = np.array(['x', 'y', 'z'])[:self.d]
+        header = 'state,' + ('w_{:s},'*self.d).format(*labels)[:-1]
+
+        self.writer = SectorWriter(self.state_file, sectors, label, append=append, header=header, name=name, **kwargs)
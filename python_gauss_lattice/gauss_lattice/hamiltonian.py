@@ -6,10 +6,13 @@
 
 ---------------------------------------------------------------------------- """
 import numpy as np
-from scipy.sparse import coo_matrix, save_npz, load_npz
-from scipy.sparse.linalg import eigsh
+from scipy.sparse import coo_matrix, csr_matrix, diags, save_npz, load_npz
+from scipy.sparse.linalg import eigsh, lobpcg, LinearOperator
 from scipy.linalg import eigvals, eig
 from .aux_stuff import write_simple_spectrum
+from . import matrix_free
+from multiprocessing import current_process
+from contextlib import nullcontext
 from copy import copy
 
 
@@ -18,25 +21,39 @@ class Hamiltonian(object):
         ultimately is only a sparse matrix) and handling some convenient I/O
         business.
     """
-    def __init__(self, data, row, col, n_fock):
+    def __init__(self, data, row, col, n_fock, half=False, indptr=None):
         """ Takes is a sparse matrix that holds the entries of the hamiltonian.
+            If half is set, only one entry of every pair of Hermitian conjugate
+            off-diagonal elements is stored (the matrix is real symmetric).
+
+            The rows may also be given in compressed form (row=None and the
+            row pointers indptr of a CSR matrix, e.g. when read from file),
+            the row indices are then only expanded if they are needed.
         """
         self.n_fock = n_fock
+        self.half = half
 
         # The storage should be separate, in order to keep the options flexible
-        # regarding a change of parameters.
-        self.row = np.array(row)
-        self.col = np.array(col)
-        self.data = np.array(data)
+        # regarding a change of parameters. Arrays are not copied.
+        self._row = None if row is None else np.asarray(row)
+        self.indptr = None if indptr is None else np.asarray(indptr)
+        self.col = np.asarray(col)
+        self.data = np.asarray(data)
 
         self.diagonalized = False
         self.sparsified = False
 
+    @property
+    def row(self):
+        if self._row is None:
+            self._row = np.repeat(np.arange(self.n_fock, dtype=np.int32), np.diff(self.indptr))
+        return self._row
+
     @classmethod
     def from_scipy_dump(cls, input_file):
         """ Alternate setup with data from file.
         """
-        sp = load_npz(input_file)
+        sp = load_npz(input_file).tocoo()
         return cls(sp.data, sp.row, sp.col, sp.shape[0])
 
     @classmethod
@@ -50,12 +67,25 @@ class Hamiltonian(object):
         return str(self.sparse_rep.todense())
 
 
+    def full_entries(self, data=None):
+        """ Returns the (data, (row, col)) entries of the full matrix, i.e.,
+            with the mirrored entries added if only one half is stored.
+        """
+        data = self.data if data is None else data
+        if not self.half:
+            return data, (self.row, self.col)
+        return (
+            np.concatenate((data, data)),
+            (np.concatenate((self.row, self.col)), np.concatenate((self.col, self.row)))
+        )
+
+
     def _sparsify(self, entries=None):
         """ Constructs the sparse matrix from the pieces we stored.
         """
         if entries is None:
             self.sparse_rep = coo_matrix(
-                (self.data, (self.row, self.col)),
+                self.full_entries(),
                 shape=(self.n_fock, self.n_fock),
                 dtype=np.float
             )
@@ -68,6 +98,22 @@ class Hamiltonian(object):
         self.sparsified = True
 
 
+    def csr_arrays(self):
+        """ Returns the stored entries (only one half in half storage) in CSR
+            form, as (indptr, indices, data). The rows come out of the
+            construction sorted, otherwise the entries are reordered.
+        """
+        if self.indptr is not None:
+            return self.indptr, self.col, self.data
+
+        indptr = np.zeros(self.n_fock + 1, dtype=np.int64)
+        np.cumsum(np.bincount(self.row, minlength=self.n_fock), out=indptr[1:])
+        if np.all(self.row[1:] >= self.row[:-1]):
+            return indptr, self.col, self.data
+        order = np.argsort(self.row, kind='stable')
+        return indptr, self.col[order], self.data[order]
+
+
     def store_hamiltonian(self, filename='hamiltonian_sparse.npz'):
         """ Stores the Hamiltonian matrix in sparse format.
         """
@@ -76,10 +122,15 @@ class Hamiltonian(object):
         save_npz(filename, self.sparse_rep)
 
 
-    def diagonalize(self, n_eigenvalues=50, which='BE', full_diag=False, compute_eigenstates=False):
+    def diagonalize(self, n_eigenvalues=50, which='BE', full_diag=False, compute_eigenstates=False, v0=None, solver='arpack', tol=0):
         """ The diagonalization routine which is called from the outside. If
             full_diag is set to True, a full eigensolver (not ARPACK) will be
             used which could lead to a dramatic loss of performance.
+
+            For the sparse solvers, a starting guess v0 can be provided (e.g.,
+            the eigenvectors at a neighbouring parameter point), see
+            _compute_lower_spectrum. The number of matrix-vector products (and
+            iterations) of the last run is kept in solver_info.
         """
         if not self.sparsified:
             self._sparsify()
@@ -88,7 +139,7 @@ class Hamiltonian(object):
         if full_diag:
             self._full_diagonalization(compute_eigenstates=compute_eigenstates)
         else:
-            self._compute_lower_spectrum(n_eigenvalues, which)
+            self._compute_lower_spectrum(n_eigenvalues, which, v0=v0, solver=solver, tol=tol)
         self.diagonalized = True
 
         # Sorting.
@@ -98,21 +149,65 @@ class Hamiltonian(object):
         return self.eigenvalues[m]
 
 
-    def _compute_lower_spectrum(self, n_eigenvalues, which):
+    def _counting_operator(self):
+        """ Wraps the sparse matrix into a LinearOperator that counts the
+            matrix-vector products.
+        """
+        A = self.sparse_rep
+        self.solver_info['matvecs'] = 0
+
+        def matvec(x):
+            self.solver_info['matvecs'] += 1
+            return A @ x
+
+        def matmat(X):
+            self.solver_info['matvecs'] += X.shape[1]
+            return A @ X
+
+        return LinearOperator(A.shape, matvec=matvec, matmat=matmat, rmatvec=matvec, dtype=A.dtype)
+
+
+    def _compute_lower_spectrum(self, n_eigenvalues, which, v0=None, solver='arpack', tol=0):
         """ Performs the diagonalization with ARPACK and returns the lower part
             (n_eigenvalues) of the spectrum.
 
             Relies on the method scipy.sparse.linalg.eigsh, which is able to
-            treat hermitean matrices (such as the Hamiltonian).
+            treat hermitean matrices (such as the Hamiltonian). With
+            solver='lobpcg', scipy.sparse.linalg.lobpcg is used instead (only
+            for the lowest or highest eigenvalues, which='SA' or 'LA').
+
+            The starting guess v0 may be a vector or a block of vectors (one
+            per column). ARPACK starts from the sum of the vectors (which has
+            overlap with all of them), LOBPCG uses the block and fills up
+            missing columns with random vectors.
         """
+        self.solver_info = {'solver' : solver, 'matvecs' : 0, 'iterations' : None}
+
         # Warning: the diagonal of the Hamiltonian is set to 0 - this is not the
         # most general case.
         if self.n_fock == 1:
             print("HERE")
             print(self.sparse_rep)
             self.eigenvalues, self.eigenstates = np.array([0]), np.array([[0,0]])
+            return
+
+        A = self._counting_operator()
+        v0 = None if v0 is None else np.asarray(v0, dtype=A.dtype).reshape(self.n_fock, -1)
+        if solver == 'lobpcg' and which in ['SA', 'LA']:
+            X = np.random.default_rng(42).standard_normal((self.n_fock, n_eigenvalues))
+            if v0 is not None:
+                k = min(v0.shape[1], n_eigenvalues)
+                X[:,:k] = v0[:,:k]
+            self.eigenvalues, self.eigenstates, history = lobpcg(
+                A, X, largest=(which == 'LA'), tol=tol if tol else None,
+                maxiter=max(1000, 10*n_eigenvalues), retResidualNormsHistory=True
+            )
+            self.solver_info['iterations'] = len(history)
         else:
-            self.eigenvalues, self.eigenstates = eigsh(self.sparse_rep, n_eigenvalues, which=which)
+            self.solver_info['solver'] = 'arpack'
+            self.eigenvalues, self.eigenstates = eigsh(
+                A, n_eigenvalues, which=which, tol=tol, v0=None if v0 is None else v0.sum(axis=1)
+            )
 
 
     def _full_diagonalization(self, compute_eigenstates=False):
@@ -151,9 +246,100 @@ class GaussLatticeHamiltonian(Hamiltonian):
 
         The concretization allows us to provide parameters
     """
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, flips=None, **kwargs):
         super().__init__(*args, **kwargs)
 
+        # Number of flippable plaquettes per state, computed on first use unless
+        # it is provided (e.g., read from file).
+        self.flips = None if flips is None else np.asarray(flips)
+
+        # CSR structure of the Hamiltonian (off-diagonal entries plus the full
+        # diagonal) and the data vectors of both terms, per gauge particle type.
+        self._csr_cache = {}
+
+
+    def flip_counts(self):
+        """ Number of flippable plaquettes for every state, i.e., the diagonal
+            of the lambda term. Every off-diagonal entry in a row corresponds to
+            one flippable plaquette (in half storage, every entry counts for
+            its row and its column).
+        """
+        if self.flips is None:
+            if self.indptr is not None:
+                flips = np.diff(self.indptr)
+            else:
+                flips = np.bincount(self.row, minlength=self.n_fock)
+            if self.half:
+                flips += np.bincount(self.col, minlength=self.n_fock)
+            self.flips = flips.astype(np.uint16)
+        return self.flips
+
+
+    @classmethod
+    def from_csr_terms(cls, terms, n_fock, gauge_particles='fermions'):
+        """ Alternate setup from the output of csr_terms (e.g., arrays that live
+            in shared memory). Only the given gauge particle type is available.
+        """
+        ham = cls(np.zeros(0, dtype=np.int8), np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.int32), n_fock)
+        ham._csr_cache[gauge_particles] = tuple(terms)
+        return ham
+
+
+    def _offdiag_matrix(self, data):
+        """ The plaquette term as CSR matrix with the given data on the stored
+            entries (mirrored in half storage), with sorted indices and without
+            duplicates. Entries that were read in CSR form are used as they are.
+        """
+        shape = (self.n_fock, self.n_fock)
+        if self.indptr is not None:
+            offdiag = csr_matrix((data, self.col, self.indptr), shape=shape)
+        else:
+            offdiag = csr_matrix((data, (self.row, self.col)), shape=shape)
+        if self.half:
+            offdiag = (offdiag + offdiag.T).tocsr()
+        offdiag.sum_duplicates()
+        return offdiag
+
+
+    def csr_terms(self, gauge_particles):
+        """ Builds (once) the CSR structure that holds both terms and returns
+            it together with the data vectors of the plaquette term and the
+            lambda term on that structure.
+        """
+        if gauge_particles not in self._csr_cache:
+            data = np.abs(self.data) if gauge_particles == 'bosons' else self.data
+            offdiag = self._offdiag_matrix(data.astype(np.result_type(data, np.float64)))
+
+            # The diagonal is added as explicit entries, distinguished from the
+            # off-diagonal ones by their sign after the conversion (also if
+            # off-diagonal entries are summed up on the diagonal, which happens
+            # in a symmetry reduced basis).
+            pattern = csr_matrix((np.ones(offdiag.nnz), offdiag.indices, offdiag.indptr), shape=offdiag.shape)
+            pattern = (pattern + diags(np.full(self.n_fock, -1.0 - offdiag.nnz), format='csr')).tocsr()
+            pattern.sum_duplicates()
+
+            # Both matrices have sorted indices and the off-diagonal pattern is
+            # a subset of the full one, which lets us scatter its data (to the
+            # positions of its flat indices in the full pattern).
+            flat = lambda m: np.repeat(np.arange(m.shape[0], dtype=np.int64), np.diff(m.indptr))*m.shape[1] + m.indices
+            is_diag = pattern.data < 0
+            off_data = np.zeros(pattern.nnz, dtype=offdiag.dtype)
+            off_data[np.searchsorted(flat(pattern), flat(offdiag))] = offdiag.data
+            diag_data = np.zeros(pattern.nnz)
+            diag_data[is_diag] = self.flip_counts()
+
+            self._csr_cache[gauge_particles] = (pattern.indices, pattern.indptr, off_data, diag_data)
+        return self._csr_cache[gauge_particles]
+
+
+    def matrix(self, J=1, lam=0, gauge_particles='fermions'):
+        """ Returns H(J, lam) as CSR matrix. The structure is only built for the
+            first call (per type of gauge particles), afterwards this is merely
+            a linear combination of two data vectors.
+        """
+        indices, indptr, off_data, diag_data = self.csr_terms(gauge_particles)
+        return csr_matrix((J*off_data + lam*diag_data, indices, indptr), shape=(self.n_fock, self.n_fock))
+
 
     def diagonalize(self, J=1, lam=0, gauge_particles='fermions', **kwargs):
         """ Performs the diagonalization. If no keyword arguments are provided,
@@ -162,18 +348,68 @@ class GaussLatticeHamiltonian(Hamiltonian):
             Alternatively, parameters may be provided to obtain the spectrum at
             the specific parameter choice.
         """
-        if gauge_particles == 'bosons':
-            self._sparsify(entries=(J*np.abs(self.data), (self.row, self.col)))
-        else:
-            self._sparsify(entries=(J*self.data, (self.row, self.col)))
-
-        # If an interaction term exists, we must construct it.
-        if abs(lam):
-            diag = np.zeros(self.n_fock)
-            for k in self.row:
-                diag[int(k)] += lam
-            self.sparse_rep.setdiag(diag)
-
+        self.sparse_rep = self.matrix(J, lam, gauge_particles)
+        self.sparsified = True
 
         # Perform the usual diagonalization.
         return super().diagonalize(**kwargs)
+
+
+
+class MatrixFreeHamiltonian(Hamiltonian):
+    """ The Hamiltonian of GaussLatticeHamiltonian without a stored matrix. It
+        keeps the sorted state table and the plaquette masks and computes the
+        matrix-vector products on the fly (see matrix_free.py), such that the
+        memory is dominated by the table and the vectors of the eigensolver.
+    """
+    def __init__(self, index, masks, n_threads=1, chunk_size=2**14):
+        super().__init__(np.zeros(0, dtype=np.int8), np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.int32), len(index))
+        self.index = index
+        self.masks = masks
+        self.n_threads = n_threads
+        self.chunk_size = chunk_size
+        self.flips = None
+
+
+    def flip_counts(self):
+        """ Number of flippable plaquettes for every state, i.e., the diagonal
+            of the lambda term.
+        """
+        if self.flips is None:
+            self.flips = matrix_free.flip_counts(self.index, self.masks, self.chunk_size)
+        return self.flips
+
+
+    def operator(self, J=1, lam=0, gauge_particles='fermions', matvec=None):
+        """ Returns H(J, lam) as LinearOperator. The products are computed in
+            the calling process unless matvec is given (e.g., a ParallelMatvec).
+        """
+        if matvec is None:
+            bosons = gauge_particles == 'bosons'
+            matvec = lambda x: matrix_free.matvec(self.index, self.masks, x, J, lam, bosons, self.chunk_size)
+        shape = (self.n_fock, self.n_fock)
+        return LinearOperator(shape, matvec=matvec, matmat=matvec, rmatvec=matvec, dtype=np.float64)
+
+
+    def _sparsify(self, entries=None):
+        raise ValueError('The matrix-free Hamiltonian does not hold a matrix.')
+
+
+    def diagonalize(self, J=1, lam=0, gauge_particles='fermions', full_diag=False, **kwargs):
+        """ Same as GaussLatticeHamiltonian.diagonalize, only with the sparse
+            solvers. With n_threads > 1, the products are distributed over a
+            process pool for the duration of the diagonalization (not inside
+            of pool workers, e.g. in a parallel lambda scan).
+        """
+        if full_diag:
+            raise ValueError('The matrix-free Hamiltonian can only be diagonalized with the sparse solvers.')
+
+        parallel = self.n_threads > 1 and not current_process().daemon
+        bosons = gauge_particles == 'bosons'
+        with matrix_free.ParallelMatvec(self.index, self.masks, self.n_threads, J, lam, bosons, self.chunk_size) if parallel else nullcontext() as matvec:
+            self.sparse_rep = self.operator(J, lam, gauge_particles, matvec)
+            self.sparsified = True
+            try:
+                return super().diagonalize(**kwargs)
+            finally:
+                self.sparsified = False
@@ -6,12 +6,19 @@
 
 ---------------------------------------------------------------------------- """
 import numpy as np
-from bisect import bisect_left
-from .hamiltonian import GaussLatticeHamiltonian
+from .hamiltonian import GaussLatticeHamiltonian, MatrixFreeHamiltonian
 from .hamiltonian_builder_methods import do_single_state, apply_u, apply_u_dagger
 from .bit_magic import set_bits
+from .plaquette_kernels import n_words, plaquette_masks, construct_coo, flip_plaquettes
+from .state_index import StateIndex
+from .shared_tables import parallel_construct_coo
+from .coo_accumulator import COOAccumulator
+from .translations import translation_tables, representatives, characters, orbit_norms, momentum_sectors
+from . import symmetries
+from . import jit_kernels
 from .aux_stuff import timestamp
 from copy import copy
+from functools import partial
 from tqdm import tqdm as tbar
 from multiprocessing import Pool
 from itertools import product
@@ -33,6 +40,7 @@ class HamiltonianBuilder(object):
         # Flag for big int storage.
         self.nb = self.S[-1]*self.d
         self.big_int = self.nb > 60
+        self.n_words = n_words(self.nb)
 
         # Some I/O business.
         self.silent = silent
@@ -40,11 +48,7 @@ class HamiltonianBuilder(object):
 
         # Set up the lookup table, which is merely ordering the states such that
         # the inverse lookup can be done efficiently with bisection.
-        self.lookup_table = sorted(states)
-        # print("FIRST STATE: ", self.lookup_table[722])
-        self.inv_lookup_table = HamiltonianBuilder._make_inv_lookuptable(self.lookup_table)
-
-        self.n_fock = len(self.lookup_table)
+        self.lookup_table = states
         if not self.silent:
             self._log(f'Setting up the Hamiltonian with {self.n_fock} Fock states.')
 
@@ -66,11 +70,17 @@ class HamiltonianBuilder(object):
             print(timestamp() + ' ' + msg)
 
 
-    @staticmethod
-    def _make_inv_lookuptable(lookup_table):
-        """ Produces an inverse lookup table.
+    @property
+    def lookup_table(self):
+        """ The sorted list of states (as Python integers). Note that this is
+            produced from the state index on every call.
         """
-        return {int(v):k for k,v in enumerate(lookup_table)}
+        return self.state_index.states()
+
+    @lookup_table.setter
+    def lookup_table(self, states):
+        self.state_index = StateIndex(states, self.nb)
+        self.n_fock = len(self.state_index)
 
 
     def shift_index(self, i, d):
@@ -178,47 +188,292 @@ class HamiltonianBuilder(object):
         return ind
 
 
-    def construct(self, n_threads=1, progress_bar=False):
+    def construct(self, n_threads=1, progress_bar=False, method=None, chunk_size=2**14, spill_dir=None, hermitian=False):
         """ Actually builds the Hamiltonian and returns a Hamiltonian object
             ready to be diagonalized.
+
+            The method may be
+                'jit'           compiled loop over all states, only for states
+                                that fit into 64 bits (default if possible),
+                'vectorized'    processes the lookup table in blocks of
+                                chunk_size states with array operations (see
+                                plaquette_kernels.py),
+                'python'        loops over all states and plaquettes one by one
+                                (reference implementation),
+                'matrix_free'   doesn't construct the matrix at all, returns a
+                                MatrixFreeHamiltonian that computes the
+                                matrix-vector products from the lookup table
+                                (in blocks of chunk_size states, on n_threads
+                                processes), see matrix_free.py.
+
+            The compiled and the vectorized construction stream their chunks
+            into a COOAccumulator. If spill_dir is given, the entries are
+            written to files in that directory instead of being kept in memory
+            (the Hamiltonian then holds memory maps of those files).
+
+            With hermitian=True, only the U+ term is applied to every state,
+            which yields one matrix element of every Hermitian conjugate pair.
+            This halves the work and the storage, the returned Hamiltonian is
+            flagged accordingly and mirrors the entries when it is sparsified.
         """
-        # Loop through all Fock states and create the overlap matrix. First step:
-        # do it naively (with some doubled work). Then try to improve on that (by
-        # using, e.g., Hermiticity).
+        if method is None:
+            method = 'jit' if self.n_words == 1 else 'vectorized'
 
         self._log(f'Working with {n_threads} threads.')
+        if method == 'matrix_free':
+            masks = plaquette_masks(self.plaquettes, self.n_words)
+            return MatrixFreeHamiltonian(self.state_index, masks, n_threads=n_threads, chunk_size=chunk_size)
+        if method == 'jit':
+            irow, icol, idata = self._construct_jit(n_threads, chunk_size, spill_dir, hermitian)
+        elif method == 'vectorized':
+            irow, icol, idata = self._construct_vectorized(n_threads, chunk_size, spill_dir, hermitian)
+        elif method == 'python':
+            irow, icol, idata = self._construct_python(n_threads, progress_bar, hermitian)
+        else:
+            raise ValueError(f'Unknown construction method \'{method}\'.')
+
+        if not self.silent:
+            self._log("# of nonzero entries: " + str(len(idata)))
+        return GaussLatticeHamiltonian(idata, irow, icol, n_fock=self.n_fock, half=hermitian)
+
+
+    def _construct_jit(self, n_threads, chunk_size, spill_dir=None, half=False):
+        """ Construction of the COO triplets with the compiled kernel.
+        """
+        if self.n_words > 1:
+            raise ValueError('The compiled construction only works for states up to 64 bits.')
+        plaquettes = {'links' : jit_kernels.plaquette_links(self.plaquettes)}
+        if n_threads == 1:
+            table, n = self.state_index.keys, self.n_fock
+            chunks = (jit_kernels.construct_coo(table, plaquettes['links'], k, min(k+chunk_size, n), half) for k in range(0, n, chunk_size))
+            return COOAccumulator(n, spill_dir=spill_dir).extend(chunks).finalize()
+        return parallel_construct_coo(self.state_index, plaquettes, n_threads, method='jit', chunk_size=chunk_size, spill_dir=spill_dir, half=half)
+
+
+    def _construct_vectorized(self, n_threads, chunk_size, spill_dir=None, half=False):
+        """ Block-wise construction of the COO triplets with array operations.
+        """
+        masks = plaquette_masks(self.plaquettes, self.n_words)
+        if n_threads == 1:
+            return construct_coo(self.state_index, masks, chunk_size=chunk_size, spill_dir=spill_dir, half=half)
+        return parallel_construct_coo(self.state_index, masks, n_threads, method='vectorized', chunk_size=chunk_size, spill_dir=spill_dir, half=half)
+
+
+    def _construct_python(self, n_threads, progress_bar, half=False):
+        """ Loops through all Fock states and creates the overlap matrix. This
+            does all the work twice, unless half is set (then only U+ is
+            applied and the other half follows from Hermiticity).
+        """
         all_entries = []
+        lookup_table = self.lookup_table
         if n_threads == 1:
-            if progress_bar:
-                for s in tbar(self.lookup_table):
-                    all_entries += [do_single_state((s, self.plaquettes))]
-            else:
-                for s in self.lookup_table:
-                    entr = do_single_state((s, self.plaquettes))
-                    # all_entries += [do_single_state((s, self.plaquettes))]
+            states = tbar(lookup_table) if progress_bar else lookup_table
+            for s in states:
+                all_entries += [do_single_state((s, self.plaquettes), half=half)]
 
         else:
             with Pool(n_threads) as pool:
-                all_entries = pool.map(do_single_state, product(self.lookup_table, [self.plaquettes]))
-
-        # Make a sparse matrix out ot this -although pretty plain, this can handle
-        # reasonably sized lists of indices (will do fo now).
-        icol, irow, idata = [], [], []
-        for line in all_entries:
-            if len(line):
-                row, col, data = zip(*line)
-
-                # Convert the columns to the proper format.
-                for k in range(len(row)):
-                    c = self.state_to_index(col[k])
-                    if c is not None:
-                        irow.append(self.state_to_index(row[k]))
-                        icol.append(c)
-                        idata.append(data[k])
+                all_entries = pool.map(partial(do_single_state, half=half), product(lookup_table, [self.plaquettes]))
+
+        # The rows are given by the ordering of the states, the columns are
+        # looked up all at once.
+        irow, cstates, idata = [], [], []
+        for i, line in enumerate(all_entries):
+            for _, c, s in line:
+                irow.append(i)
+                cstates.append(c)
+                idata.append(s)
+
+        icol = self.states_to_indices(cstates)
+        found = icol >= 0
+        return np.array(irow, dtype=np.int64)[found], icol[found], np.array(idata, dtype=np.int8)[found]
+
+    def _reduced_basis(self, representatives, norms, chunk_size=2**14):
+        """ Representatives of the orbits among the states (those that are
+            their own representative) with a non-vanishing norm, see
+            momentum_basis and symmetric_basis.
+        """
+        words = self.state_index.words
+        keep, kept_norms = np.zeros(self.n_fock, dtype=bool), []
+        for k in range(0, self.n_fock, chunk_size):
+            block = words[k:k+chunk_size]
+            norm = norms(block)
+            keep[k:k+chunk_size] = np.all(representatives(block)[0] == block, axis=1) & (norm > 0)
+            kept_norms.append(norm[keep[k:k+chunk_size]])
+
+        index = StateIndex.from_keys(self.state_index.keys[keep], self.n_words)
+        return index, np.concatenate(kept_norms) if kept_norms else np.zeros(0, dtype=np.int64)
+
+
+    def _construct_reduced(self, index, norms, representatives, gauge_particles, chunk_size=2**14):
+        """ Builds the Hamiltonian in a symmetry reduced basis. With the
+            symmetric states
+
+                |a> ~ sum_g chi(g)* g |a>
+
+            of the representatives a, the plaquette term H|a> = sum_j h_j |s_j>
+            becomes
+
+                <b|H|a> = h_j (-1)**p_j chi(g_j)* sqrt(N_b / N_a)
+
+            where g_j |s_j> = (-1)**p_j |b> and N are the norms (stabilizer
+            sizes). representatives(words) has to return the representatives
+            and the phases (-1)**p_j chi(g_j)*.
+
+            The fermionic signs (of both the plaquette flips and the symmetry
+            operations) are only applied for gauge_particles='fermions', hence
+            the returned Hamiltonian only serves that type of gauge particles.
+        """
+        fermions = gauge_particles == 'fermions'
+        masks = plaquette_masks(self.plaquettes, self.n_words)
+
+        irow, icol, idata = [], [], []
+        flips = np.zeros(len(index), dtype=np.uint16)
+        for k in range(0, len(index), chunk_size):
+            r, children, signs = flip_plaquettes(index.words[k:k+chunk_size], masks, offset=k)
+            flips += np.bincount(r, minlength=len(index)).astype(np.uint16)
+            reps, phases = representatives(children)
+            c, found = index.lookup_words(reps)
+            r, c, signs, phases = r[found], c[found], signs[found], phases[found]
+
+            irow.append(c)
+            icol.append(r)
+            idata.append((signs if fermions else 1) * phases * np.sqrt(norms[c] / norms[r]))
+
+        data = np.concatenate(idata) if idata else np.zeros(0)
+        if np.allclose(data.imag, 0):
+            data = data.real
+        ham = GaussLatticeHamiltonian(
+            data,
+            np.concatenate(irow) if irow else np.zeros(0, dtype=np.int64),
+            np.concatenate(icol) if icol else np.zeros(0, dtype=np.int64),
+            n_fock=len(index),
+            flips=flips
+        )
+
+        # The data already carries the signs of the requested gauge particles.
+        return GaussLatticeHamiltonian.from_csr_terms(ham.csr_terms('fermions'), len(index), gauge_particles)
+
+
+    def momentum_basis(self, momentum, fermions=True, chunk_size=2**14):
+        """ Basis of the momentum sector k = 2 pi m / L (momentum = m): the
+            representatives of the translation orbits among the states (see
+            translations.py), without those whose momentum state vanishes.
+            Returns their StateIndex and the sizes of their stabilizers. The
+            states have to be closed under translations (e.g. all states of
+            a winding sector).
+        """
+        tables = translation_tables(self.L)
+        return self._reduced_basis(
+            lambda words: representatives(words, tables, fermions),
+            lambda words: orbit_norms(words, tables, self.L, momentum, fermions),
+            chunk_size
+        )
 
+
+    def construct_momentum(self, momentum, gauge_particles='fermions', chunk_size=2**14):
+        """ Builds the Hamiltonian in the momentum sector k = 2 pi m / L
+            (momentum = m), which is smaller than the full one by about the
+            number of sites. The symmetric states are the momentum states
+
+                |a, k> ~ sum_t exp(-i k t) T_t |a>,
+
+            see _construct_reduced. The matrix is complex unless all
+            components of k are 0 or pi.
+        """
+        fermions = gauge_particles == 'fermions'
+        index, stabilizers = self.momentum_basis(momentum, fermions, chunk_size)
+        tables = translation_tables(self.L)
+
+        def reduce(words):
+            reps, shifts, parity = representatives(words, tables, fermions)
+            return reps, (1 - 2*parity) * characters(shifts, self.L, momentum)
+
+        ham = self._construct_reduced(index, stabilizers, reduce, gauge_particles, chunk_size)
         if not self.silent:
-            self._log("# of nonzero entries: " + str(len(idata)))
-        return GaussLatticeHamiltonian(idata, irow, icol, n_fock=self.n_fock)
+            self._log(f'Momentum sector {tuple(momentum)}: {len(index)} states.')
+        return ham
+
+
+    def symmetric_basis(self, generators, irrep, fermions=True, chunk_size=2**14):
+        """ Basis of the irreducible representation irrep of the abelian group
+            spanned by the generators (see symmetries.py), analogous to
+            momentum_basis. The states have to be closed under the group.
+        """
+        return self._reduced_basis(
+            lambda words: symmetries.representatives(words, generators, fermions),
+            lambda words: symmetries.orbit_norms(words, generators, irrep, fermions),
+            chunk_size
+        )
+
+
+    def check_symmetries(self, generators, fermions=True, n_states=256):
+        """ Checks that the operations commute with the plaquette term, by
+            comparing g H|s> and H g|s> on the first n_states states. Raises a
+            ValueError otherwise (e.g., reflections of fermionic links, for
+            which the fermionic signs of the plaquettes don't match).
+        """
+        masks = plaquette_masks(self.plaquettes, self.n_words)
+        words = self.state_index.words[:n_states]
+        rows, children, signs = flip_plaquettes(words, masks)
+        for g in generators:
+            images, p = symmetries.apply_operation(children, g, fermions)
+            moved, q = symmetries.apply_operation(words, g, fermions)
+            moved_rows, moved_children, moved_signs = flip_plaquettes(moved, masks)
+            if fermions:
+                p, q = (1 - 2*p) * signs, (1 - 2*q[moved_rows]) * moved_signs
+            else:
+                p, q = np.ones(len(rows)), np.ones(len(moved_rows))
+            gh = sorted(zip(rows.tolist(), map(tuple, images.tolist()), p.tolist()))
+            hg = sorted(zip(moved_rows.tolist(), map(tuple, moved_children.tolist()), q.tolist()))
+            if gh != hg:
+                raise ValueError(f'The operation \'{g["name"]}\' is not a symmetry of the Hamiltonian.')
+
+
+    def construct_symmetric(self, operations, irrep, gauge_particles='fermions', chunk_size=2**14):
+        """ Builds the Hamiltonian in the irreducible representation irrep (see
+            symmetries.irreps) of the abelian group generated by the named
+            operations, e.g. ['parity', 'charge_conjugation'].
+        """
+        fermions = gauge_particles == 'fermions'
+        generators = symmetries.symmetry_generators(self.L, operations, fermions)
+        self.check_symmetries(generators, fermions)
+        index, stabilizers = self.symmetric_basis(generators, irrep, fermions, chunk_size)
+
+        def reduce(words):
+            reps, exponents, parity = symmetries.representatives(words, generators, fermions)
+            return reps, (1 - 2*parity) * symmetries.characters(exponents, generators, irrep)
+
+        ham = self._construct_reduced(index, stabilizers, reduce, gauge_particles, chunk_size)
+        if not self.silent:
+            self._log(f'Representation {tuple(irrep)} of {operations}: {len(index)} states.')
+        return ham
+
+
+    def construct_momentum_sectors(self, gauge_particles='fermions', chunk_size=2**14):
+        """ Hamiltonians of all (non-empty) momentum sectors, as dictionary
+            {momentum : Hamiltonian}.
+        """
+        hams = {}
+        for m in momentum_sectors(self.L):
+            ham = self.construct_momentum(m, gauge_particles, chunk_size)
+            if ham.n_fock:
+                hams[m] = ham
+        return hams
+
+
+    def construct_symmetric_sectors(self, operations, gauge_particles='fermions', chunk_size=2**14):
+        """ Hamiltonians of all (non-empty) irreducible representations of the
+            group generated by the operations, as dictionary {irrep : Hamiltonian}.
+        """
+        generators = symmetries.symmetry_generators(self.L, operations, gauge_particles == 'fermions')
+        hams = {}
+        for q in symmetries.irreps(generators):
+            ham = self.construct_symmetric(operations, q, gauge_particles, chunk_size)
+            if ham.n_fock:
+                hams[q] = ham
+        return hams
+
 
     def apply_u(self, *args, **kwargs):
         return apply_u(*args, **kwargs)
@@ -233,19 +488,19 @@ class HamiltonianBuilder(object):
             Note:
                 - likely deprecated, here for historic purposes.
         """
-        return self.lookup_table[n]
+        return self.state_index.state(n)
 
 
     def state_to_index(self, state):
-        """ Maps the bit string to the basis index via an inverse lookup table.
-            This does require some more memory than a bisection search (which
-            could easily be done and has log lookup) but shouldn't be an issue
-            for most of the problems of interest here.
-
-            If, however, one wishes to use a bisection, note the following:
-            the algorithm implemented in the bisect package yields either the
-            position where it is found or the positin where it should be inserted,
-            not, however, the maximum index (= length of list). Therefore, it is
-            not well suited for checking whether a key exists or not.
-        """
-        return self.inv_lookup_table.get(state)
+        """ Maps the bit string to the basis index via a bisection search in the
+            sorted state index. Returns None if the state is not part of the
+            basis.
+        """
+        return self.state_index.index(state)
+
+
+    def states_to_indices(self, states):
+        """ Batched version of state_to_index (vectorized bisection), returns
+            an array with -1 for all states that are not part of the basis.
+        """
+        return self.state_index.indices(states)
@@ -8,14 +8,15 @@
     multiprocessing.Pool).
 
 ---------------------------------------------------------------------------- """
-from copy import copy
-from .bit_magic import sum_occupancies_ordered
+from .bit_magic import plaquette_sign_mask
+from functools import lru_cache
 import numpy as np
 
 
-def do_single_state(args, sign=True, set_collection=False):
+def do_single_state(args, sign=True, set_collection=False, half=False):
     """ Constructs matrix-elements for a single Fock state, suitable for parallel
-        computing.
+        computing. With half=True, only the U+ term is applied, i.e., only one
+        of the two (Hermitian conjugate) matrix elements of every pair.
     """
     state, plaquettes = args
 
@@ -27,7 +28,7 @@ def do_single_state(args, sign=True, set_collection=False):
         # If U term was not successful, try the U^dagger term.
         # (the order could have been switched - there's always only one
         # possibility for overlap to be generated)
-        if not new_state:
+        if not new_state and not half:
             new_state, s = apply_u(state, p, sign=sign)
 
         if new_state:
@@ -54,6 +55,11 @@ def apply_u_dagger(state, p, sign=True):
     return _apply_plaquette_operator(state, p, [True, True, False, False], sign)
 
 
+@lru_cache(maxsize=None)
+def _sign_mask(p):
+    return plaquette_sign_mask(p)
+
+
 def _apply_plaquette_operator(state, p, mask, sign):
     """ Applies the U operator
 
@@ -65,33 +71,16 @@ def _apply_plaquette_operator(state, p, mask, sign):
 
         to a given plaquette in a given state (link configuration starting
         with x-mu link and going counter-clockwise).
+
+        The fermionic sign is computed with the (cached) parity mask of the
+        plaquette, see bit_magic.plaquette_sign_mask.
     """
-    n = 0
-    # print("---------")
-    # print("STATE: ", bin(state))
-    # print(p)
-    if sign:
-        a = max(p[:-1])
-    new_state = copy(state)
+    state = int(state)
     for k in range(4):
-        m = 1 << p[k]
-        if bool(new_state & m) == mask[k]:
-            if sign:
-                # print('{:08b}'.format(new_state), " // ({:d} -> {:d})".format(a, p[k]))
-                # print( sum_occupancies_ordered(a, p[k], new_state))
-                n += sum_occupancies_ordered(a, p[k], new_state)
-            new_state = copy(new_state^m)
-        else:
+        if bool(state & (1 << p[k])) != mask[k]:
             return 0, 0
 
-    if state == 52378704074343307122:
-        print("------")
-        print("plaquette: ", p[:-1])
-        print("state: ", state)
-        print("{:128b}".format(state))
-        print("{:128b}".format(new_state))
-        print("new state: ", new_state)
-        print("{:128b}".format(state^new_state))
-
-    # print(n, " // ", (-1)**n)
-    return new_state, (-1)**n
+    if sign:
+        r, c = _sign_mask(tuple(p[:4]))
+        return state ^ p[-1], (-1)**((state & r).bit_count() + c)
+    return state ^ p[-1], 1
@@ -0,0 +1,144 @@
+""" ----------------------------------------------------------------------------
+
+    jit_kernels.py - LR, December 2020
+
+    Compiled (numba, nopython) versions of the routines in
+    hamiltonian_builder_methods.py for lattices whose states fit into a single
+    unsigned 64 bit integer. Plaquettes are handed over as an integer array of
+    shape (n_plaquettes, 4) holding the link indices, i.e., the plaquette list
+    of the HamiltonianBuilder without the mask.
+
+    Note: numba does not promote mixed signed/unsigned integer arithmetic to an
+    integer type, hence all the explicit np.uint64 casts.
+
+---------------------------------------------------------------------------- """
+import numpy as np
+from numba import njit
+from .bit_magic import _M1, _M2, _M4, _H01
+
+_ONE = np.uint64(1)
+
+# The occupations that are required for the links of a plaquette.
+_U_DAGGER = np.array([1, 1, 0, 0], dtype=np.uint64)
+_U = np.array([0, 0, 1, 1], dtype=np.uint64)
+
+
+def plaquette_links(plaquettes):
+    """ Converts the plaquette list of the HamiltonianBuilder into the array
+        format the kernels work with.
+    """
+    return np.array([p[:4] for p in plaquettes], dtype=np.int64).reshape(-1, 4)
+
+
+@njit(cache=True)
+def popcount(x):
+    """ Counts the set bits of an unsigned 64 bit integer.
+    """
+    x = x - ((x >> np.uint64(1)) & _M1)
+    x = (x & _M2) + ((x >> np.uint64(2)) & _M2)
+    x = (x + (x >> np.uint64(4))) & _M4
+    return (x * _H01) >> np.uint64(56)
+
+
+@njit(cache=True)
+def sum_occupancies_ordered(a, b, state):
+    """ Sums all occupancies between index a and b, both inclusive.
+        Assumes a >= b.
+    """
+    # Shifting by 64 is undefined, so the topmost link needs special care.
+    mask = (_ONE << np.uint64(a+1)) - (_ONE << np.uint64(b)) if a < 63 else ~((_ONE << np.uint64(b)) - _ONE)
+    return popcount(state & mask)
+
+
+@njit(cache=True)
+def apply_plaquette_operator(state, p, occupation):
+    """ Applies the U (occupation = _U) or the U+ (occupation = _U_DAGGER) term
+        to the plaquette p. Returns the new state and the fermionic sign, or
+        (0, 0) if the plaquette is not flippable.
+    """
+    a = max(p[0], max(p[1], max(p[2], p[3])))
+    n = np.uint64(0)
+    new_state = state
+    for k in range(4):
+        if (new_state >> np.uint64(p[k])) & _ONE != occupation[k]:
+            return np.uint64(0), 0
+        n += sum_occupancies_ordered(a, p[k], new_state)
+        new_state ^= _ONE << np.uint64(p[k])
+    return new_state, 1 - 2*np.int64(n & _ONE)
+
+
+@njit(cache=True)
+def _flip(state, p, half=False):
+    """ Tries U+ first and U second (unless half is set), as in
+        hamiltonian_builder_methods.
+    """
+    new_state, s = apply_plaquette_operator(state, p, _U_DAGGER)
+    if not new_state and not half:
+        new_state, s = apply_plaquette_operator(state, p, _U)
+    return new_state, s
+
+
+@njit(cache=True)
+def do_single_state(state, plaquettes):
+    """ Applies all plaquettes to a single state and returns the new states
+        and the corresponding signs.
+    """
+    new_states = np.zeros(len(plaquettes), dtype=np.uint64)
+    signs = np.zeros(len(plaquettes), dtype=np.int8)
+    n = 0
+    for i in range(len(plaquettes)):
+        new_state, s = _flip(state, plaquettes[i])
+        if new_state:
+            new_states[n] = new_state
+            signs[n] = s
+            n += 1
+    return new_states[:n], signs[:n]
+
+
+@njit(cache=True)
+def cycle_plaquettes(state, plaquettes):
+    """ Same as do_single_state, but only returns the (unique) new states.
+    """
+    return np.unique(do_single_state(state, plaquettes)[0])
+
+
+@njit(cache=True)
+def _lookup(table, state):
+    """ Bisection in the sorted table, returns -1 if the state is not found.
+    """
+    c = np.searchsorted(table, state)
+    if c < len(table) and table[c] == state:
+        return c
+    return -1
+
+
+@njit(cache=True)
+def construct_coo(table, plaquettes, start=0, stop=-1, half=False):
+    """ Builds the COO triplets of the plaquette term for the states
+        table[start:stop] of the sorted uint64 array table. Matrix elements that
+        point to a state outside the table are dropped. With half=True only the
+        U+ entries are produced.
+
+        The columns (or -1 if the state is not in the table) are stored per row
+        and plaquette in a single pass, the arrays are compacted at the end.
+    """
+    stop = len(table) if stop < 0 else stop
+    n_p = len(plaquettes)
+
+    cols = np.full((stop-start, n_p), -1, dtype=np.int64)
+    signs = np.zeros((stop-start, n_p), dtype=np.int8)
+    for i in range(start, stop):
+        for j in range(n_p):
+            new_state, s = _flip(table[i], plaquettes[j], half)
+            if new_state:
+                cols[i-start,j] = _lookup(table, new_state)
+                signs[i-start,j] = s
+
+    rows, ps = np.nonzero(cols >= 0)
+    n = len(rows)
+    icol = np.empty(n, dtype=np.int64)
+    data = np.empty(n, dtype=np.int8)
+    for k in range(n):
+        icol[k] = cols[rows[k], ps[k]]
+        data[k] = signs[rows[k], ps[k]]
+    return rows.astype(np.int64) + start, icol, data
@@ -1,16 +1,27 @@
 from .hamiltonian_builder import HamiltonianBuilder
 from .hamiltonian_builder_methods import cycle_plaquettes
+from . import jit_kernels
 from .aux_stuff import timestamp
-from multiprocessing import Pool
+from .winding import sector_of
+from .plaquette_kernels import plaquette_masks
+from .state_index import StateIndex
+from .frontier_search import frontier_levels, keys_to_words
 import os, subprocess
 import h5py as hdf
 import time
 import datetime as dt
 import numpy as np
-from itertools import product
 from copy import copy
 
 
+def _cycle_plaquettes_jit(args):
+    """ Compiled version of cycle_plaquettes (for states up to 64 bits), with
+        the same signature.
+    """
+    state, plaquettes = args
+    return set(map(int, jit_kernels.cycle_plaquettes(np.uint64(state), plaquettes)))
+
+
 class LowEnergyStateFinder(HamiltonianBuilder):
     """ Builds a Hamiltonian with low energy states only.
     """
@@ -44,47 +55,48 @@ class LowEnergyStateFinder(HamiltonianBuilder):
         return split_data
 
 
-    def _exhaust(self, seed_states, rest, level, pool=None, output_file=None, max_level=10000):
-        """ One step in the iteration.
+    def _split_words(self, words, bit_shift=63):
+        """ Vectorized version of _split for a word array (lowest word first,
+            at most two words).
         """
-        self.level = level
-        self._log(str(level) + " " + str(len(seed_states)))
+        if words.shape[1] > 2:
+            raise ValueError('States with more than 128 links cannot be stored.')
+        split_data = np.zeros((len(words),2), dtype=np.int64)
+        split_data[:,1] = (words[:,0] & np.uint64(2**bit_shift - 1)).astype(np.int64)
+        high = words[:,0] >> np.uint64(bit_shift)
+        if words.shape[1] == 2:
+            high |= words[:,1] << np.uint64(64 - bit_shift)
+        split_data[:,0] = high.astype(np.int64)
+        return split_data
 
-        # Write states.
-        if output_file:
-            with hdf.File(output_file, 'r+') as f:
-                if self.big_int:
-                    data = self._split(list(seed_states))
-                else:
-                    data = list(seed_states)
-                f.create_dataset('states_lv_{:d}'.format(level), data=data)
-
-        # Notify for testing purposes.
-        if self.notify_level and (level>=self.notify_level):
-            self.level_alert(level, len(seed_states))
-
-        L = len(seed_states)
-        if not L or level>=max_level:
-            self._log(f"Terminated at {level} layers.")
-            return seed_states.union(rest)
-
-        if pool:
-            states = set().union(*pool.map(cycle_plaquettes, product(seed_states, [self.plaquettes])))
-        else:
-            # states = set()
-            # for s in seed_states:
-            #     states = states | cycle_plaquettes((s,self.plaquettes))
-            setlist = [cycle_plaquettes((s,self.plaquettes)) for s in seed_states]
-            states = set().union(*setlist)
-
-        new_rest = seed_states.union(rest)
-        states.difference_update(new_rest)
-        # states = states.difference(new_rest)
-        return self._exhaust(states, new_rest, level+1, pool, output_file, max_level)
-
-
-    def find_all_states(self, seed_states, n_threads=1, output_file=None, max_level=10000):
-        """ Finds all states.
+
+    def _write_level(self, output_file, level, frontier):
+        """ Stores the states that were first reached at the given level.
+        """
+        with hdf.File(output_file, 'r+') as f:
+            words = keys_to_words(frontier, self.n_words)
+            if self.big_int:
+                data = self._split_words(words)
+            else:
+                data = words[:,0].astype(np.int64)
+            f.create_dataset('states_lv_{:d}'.format(level), data=data)
+
+
+    def find_all_states(self, seed_states, n_threads=1, output_file=None, max_level=10000, chunk_size=2**16,
+                        as_set=True, run_file=None):
+        """ Finds all states that are connected to the seed states by at most
+            max_level plaquette flips, with the breadth-first search of
+            frontier_search (iterative, so there's no limit on the depth).
+            The states of every level are written to the output file.
+
+            The states end up in the state index of the builder (8 or 16 bytes
+            per state). By default, they are also returned as set, with
+            as_set=False the state index is returned instead.
+
+            With a run file, the visited states are kept on disk (as sorted
+            runs, one per level) and only the frontier is kept in memory. The
+            states are not loaded then, only n_fock is set and None returned
+            (see frontier_search.read_runs).
         """
         if not self.silent:
             self._log(f"Starting search for states in the low-energy sector on {n_threads} cores.")
@@ -94,22 +106,40 @@ class LowEnergyStateFinder(HamiltonianBuilder):
             with hdf.File(output_file, 'w') as f:
                 f.attrs['n_threads'] = n_threads
             self._log(f"Writing states to {output_file}")
+        if run_file:
+            self._log(f"Keeping the visited states in {run_file}")
 
-        # Execute on multiple processes.
         ts = time.time()
         self.n_threads = n_threads
-        if n_threads > 1:
-            with Pool(n_threads) as p:
-                states = self._exhaust(set(seed_states), set(), 0, pool=p, output_file=output_file, max_level=max_level)
-        else:
-            states = self._exhaust(set(seed_states), set(), 0, pool=None, output_file=output_file, max_level=max_level)
+        masks = plaquette_masks(self.plaquettes, self.n_words)
+        levels = frontier_levels(seed_states, masks, self.n_words, n_threads, chunk_size, max_level, run_file)
+        n_states, sectors = 0, set()
+        for level, frontier, visited in levels:
+            self.level = level
+            self._log(str(level) + " " + str(len(frontier)))
+            n_states += len(frontier)
+            if output_file:
+                self._write_level(output_file, level, frontier)
+            if not self.silent and len(frontier):
+                words = keys_to_words(frontier, self.n_words)
+                sectors.update(map(tuple, np.unique(sector_of(words, self.L), axis=0).tolist()))
+
+            # Notify for testing purposes.
+            if self.notify_level and (level>=self.notify_level):
+                self.level_alert(level, len(frontier))
+        self._log(f"Terminated at {level} layers.")
 
         te = time.time()
         if not self.silent:
-            self._log('Recursion took  %2.2f ms' % ((te - ts) * 1000))
-
-        self.lookup_table = sorted(list(states))
-        self.n_fock = len(self.lookup_table)
-        if not self.silent:
-            self._log(f"Found {len(self.lookup_table)} states in the low-energy sector.")
-        return set(self.lookup_table)
+            self._log('Search took  %2.2f ms' % ((te - ts) * 1000))
+            self._log(f"Found {n_states} states in the low-energy sector.")
+            self._log(f"The states belong to {len(sectors)} winding sector(s).")
+
+        if run_file:
+            self.state_index = StateIndex([], self.nb)
+            self.n_fock = n_states
+            return None
+
+        self.state_index = StateIndex.from_keys(visited, self.n_words)
+        self.n_fock = len(self.state_index)
+        return set(self.lookup_table) if as_set else self.state_index
@@ -0,0 +1,128 @@
+""" ----------------------------------------------------------------------------
+
+    matrix_free.py - LR, December 2020
+
+    Matrix-vector products with the Hamiltonian without storing it. The rows of
+    y = H x are computed block by block from the sorted state table and the
+    plaquette masks: the states of the block are flipped (plaquette_kernels.
+    flip_plaquettes), the new states are looked up in the table and
+
+        y_i = J sum_p s_ip x_j(i,p) + lam n_i x_i,
+
+    where s_ip is the fermionic sign (one for bosons) and n_i the number of
+    flippable plaquettes of state i within the basis, i.e., the lambda
+    diagonal. Only the table (8 bytes per state up to 64 links) and the
+    vectors are kept in memory, every product redoes the work of the
+    construction.
+
+    The parallel version follows shared_tables.py: the table, the masks and
+    the two vectors live in shared memory and the workers compute (and write)
+    contiguous ranges of rows of y.
+
+---------------------------------------------------------------------------- """
+import numpy as np
+from multiprocessing import Pool
+from .state_index import StateIndex
+from .plaquette_kernels import flip_plaquettes
+from .shared_tables import SharedArrays, attach
+
+
+def matvec_block(index, masks, x, start, stop, J=1, lam=0, bosons=False):
+    """ Rows [start, stop) of H x for the states of the StateIndex index. The
+        vector x may be real or complex, with one column per vector.
+    """
+    rows, new_states, signs = flip_plaquettes(index.words[start:stop], masks)
+    cols, found = index.lookup_words(new_states)
+    rows, cols = rows[found], cols[found]
+    weights = J*(np.ones(len(rows)) if bosons else signs[found].astype(np.float64))
+    n = stop - start
+
+    x = x.reshape(len(index), -1)
+    diag = lam*np.bincount(rows, minlength=n)
+    y = diag[:,None]*x[start:stop]
+    for k in range(x.shape[1]):
+        y[:,k] += np.bincount(rows, weights=weights*x[cols,k].real, minlength=n)
+        if np.iscomplexobj(x):
+            y[:,k] += 1j*np.bincount(rows, weights=weights*x[cols,k].imag, minlength=n)
+    return y
+
+
+def matvec(index, masks, x, J=1, lam=0, bosons=False, chunk_size=2**14):
+    """ H x for all states, one block of chunk_size states at a time.
+    """
+    y = np.empty((len(index), x.reshape(len(index), -1).shape[1]), dtype=np.result_type(x, np.float64))
+    for k in range(0, len(index), chunk_size):
+        y[k:k+chunk_size] = matvec_block(index, masks, x, k, min(k+chunk_size, len(index)), J, lam, bosons)
+    return y.reshape(x.shape)
+
+
+def flip_counts(index, masks, chunk_size=2**14):
+    """ Number of flippable plaquettes (within the basis) for every state.
+    """
+    counts = np.empty(len(index), dtype=np.uint16)
+    for k in range(0, len(index), chunk_size):
+        rows, new_states, _ = flip_plaquettes(index.words[k:k+chunk_size], masks)
+        _, found = index.lookup_words(new_states)
+        counts[k:k+chunk_size] = np.bincount(rows[found], minlength=min(chunk_size, len(index)-k))
+    return counts
+
+
+# ------------------------------------------------------------------------------
+# Worker side.
+
+_worker = {}
+
+def _init_worker(spec, n_words, J, lam, bosons):
+    arrays, blocks = attach(spec)
+    _worker['blocks'] = blocks
+    _worker['x'], _worker['y'] = arrays.pop('x'), arrays.pop('y')
+    _worker['index'] = StateIndex.from_keys(arrays.pop('keys'), n_words)
+    _worker['masks'] = arrays
+    _worker['parameters'] = (J, lam, bosons)
+
+
+def _matvec_range(bounds):
+    start, stop = bounds
+    _worker['y'][start:stop] = matvec_block(_worker['index'], _worker['masks'], _worker['x'], start, stop, *_worker['parameters'])[:,0]
+
+
+# ------------------------------------------------------------------------------
+# Driver side.
+
+class ParallelMatvec(object):
+    """ H x on n_threads processes. Use as context manager, the pool and the
+        shared memory are released on exit.
+    """
+    def __init__(self, index, masks, n_threads, J=1, lam=0, bosons=False, chunk_size=2**14):
+        self.n = len(index)
+        self.bounds = [(k, min(k+chunk_size, self.n)) for k in range(0, self.n, chunk_size)]
+        arrays = dict(masks, keys=index.keys, x=np.zeros(self.n), y=np.zeros(self.n))
+        self.shared = SharedArrays(arrays)
+        self.arrays, self.blocks = attach(self.shared.spec)
+        self.pool = Pool(n_threads, initializer=_init_worker, initargs=(self.shared.spec, index.n_words, J, lam, bosons))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.pool.terminate()
+        del self.arrays
+        for shm in self.blocks:
+            shm.close()
+        self.shared.__exit__(*args)
+
+    def _real(self, x):
+        self.arrays['x'][:] = x
+        self.pool.map(_matvec_range, self.bounds)
+        return self.arrays['y'].copy()
+
+    def __call__(self, x):
+        """ H x, with one column per vector.
+        """
+        X = x.reshape(self.n, -1)
+        Y = np.empty(X.shape, dtype=np.result_type(x, np.float64))
+        for k in range(X.shape[1]):
+            Y[:,k] = self._real(X[:,k].real)
+            if np.iscomplexobj(X):
+                Y[:,k] += 1j*self._real(X[:,k].imag)
+        return Y.reshape(x.shape)
@@ -0,0 +1,135 @@
+""" ----------------------------------------------------------------------------
+
+    plaquette_kernels.py - LR, December 2020
+
+    Vectorized version of the plaquette flips in hamiltonian_builder_methods.
+    Instead of looping over (state, plaquette) pairs, a whole block of the
+    (sorted) lookup table is treated at once as an array of 64 bit words. The
+    flippability check, the flip and the fermionic sign then reduce to a few
+    mask operations per block:
+
+        flippable:  (state & m) == m_u    or    (state & m) == m_ud
+        new state:  state ^ m
+        sign:       (-1)**(popcount(state & r) + c)
+
+    where m is the plaquette mask and r, c are precomputed per plaquette (see
+    plaquette_masks below). States with more than 64 links are split into
+    several words, the lowest bits being stored in the first word.
+
+---------------------------------------------------------------------------- """
+import numpy as np
+from .bit_magic import set_bits, popcount64, plaquette_sign_mask
+from .coo_accumulator import COOAccumulator
+
+_WORD = 64
+_WORD_MASK = (1 << _WORD) - 1
+
+
+def n_words(nb):
+    """ Number of 64 bit words that are needed to store nb links.
+    """
+    return max(1, -(-nb // _WORD))
+
+
+def state_words(states, nw):
+    """ Converts a list of states (Python or numpy integers) to an array of
+        shape (len(states), nw) of unsigned 64 bit words.
+    """
+    states = states if len(states) else np.zeros(0, dtype=np.uint64)
+    if nw == 1 and isinstance(states, np.ndarray) and states.dtype.kind in 'iu':
+        return states.astype(np.uint64).reshape(-1, 1)
+
+    words = np.empty((len(states), nw), dtype=np.uint64)
+    for k in range(nw):
+        words[:,k] = np.fromiter(
+            ((int(s) >> (_WORD*k)) & _WORD_MASK for s in states),
+            dtype=np.uint64,
+            count=len(states)
+        )
+    return words
+
+
+def words_to_states(words):
+    """ Inverse of state_words, returns a list of Python integers.
+    """
+    states = [0]*len(words)
+    for i, w in enumerate(words):
+        for k in range(len(w)):
+            states[i] += int(w[k]) << (_WORD*k)
+    return states
+
+
+def _split_int(v, nw):
+    return [(v >> (_WORD*k)) & _WORD_MASK for k in range(nw)]
+
+
+def plaquette_masks(plaquettes, nw):
+    """ Pre-computes everything that is needed to flip a plaquette, given a
+        list of plaquettes in the format of HamiltonianBuilder.get_plaquette_list.
+        For every plaquette we store
+
+            flip        mask of all four links,
+            u_dagger    occupation of the four links for which U+ acts,
+            u           occupation of the four links for which U acts,
+            sign        parity mask of the fermionic sign,
+            sign_offset constant contribution to the fermionic sign.
+
+        The sign is explained in bit_magic.plaquette_sign_mask.
+    """
+    n_p = len(plaquettes)
+    masks = {
+        'flip' : np.zeros((n_p, nw), dtype=np.uint64),
+        'u_dagger' : np.zeros((n_p, nw), dtype=np.uint64),
+        'u' : np.zeros((n_p, nw), dtype=np.uint64),
+        'sign' : np.zeros((n_p, nw), dtype=np.uint64),
+        'sign_offset' : np.zeros(n_p, dtype=np.uint8),
+    }
+    for i, p in enumerate(plaquettes):
+        p = p[:4]
+        r, c = plaquette_sign_mask(p)
+        masks['flip'][i] = _split_int(set_bits(p), nw)
+        masks['u_dagger'][i] = _split_int(set_bits(p[:2]), nw)
+        masks['u'][i] = _split_int(set_bits(p[2:]), nw)
+        masks['sign'][i] = _split_int(r, nw)
+        masks['sign_offset'][i] = c
+    return masks
+
+
+def flip_plaquettes(words, masks, offset=0, half=False):
+    """ Applies U and U+ to all plaquettes of all states in the block words.
+        Returns the row indices (position in the block shifted by offset), the
+        new states (as words) and the fermionic signs of all non-vanishing
+        matrix elements. With half=True, only U+ is applied.
+    """
+    overlap = words[:,None,:] & masks['flip'][None,:,:]
+    flippable = np.all(overlap == masks['u_dagger'][None,:,:], axis=2)
+    if not half:
+        flippable |= np.all(overlap == masks['u'][None,:,:], axis=2)
+    rows, ps = np.nonzero(flippable)
+    source = words[rows]
+
+    new_states = source ^ masks['flip'][ps]
+    parity = popcount64(source & masks['sign'][ps]).sum(axis=1, dtype=np.int64)
+    parity += masks['sign_offset'][ps]
+    signs = (1 - 2*(parity & 1)).astype(np.int8)
+    return rows + offset, new_states, signs
+
+
+def coo_chunks(index, masks, chunk_size=2**14, half=False):
+    """ Generates the COO triplets of the plaquette term for all states of the
+        StateIndex index, one block of chunk_size states at a time. Matrix
+        elements that point to a state outside the index are dropped.
+    """
+    table = index.words
+    for k in range(0, len(table), chunk_size):
+        r, new_states, s = flip_plaquettes(table[k:k+chunk_size], masks, offset=k, half=half)
+        c, found = index.lookup_words(new_states)
+        yield r[found], c[found], s[found]
+
+
+def construct_coo(index, masks, chunk_size=2**14, spill_dir=None, half=False):
+    """ Builds the COO triplets of the plaquette term for all states of the
+        StateIndex index by streaming the blocks into a COOAccumulator.
+    """
+    accumulator = COOAccumulator(len(index), spill_dir=spill_dir)
+    return accumulator.extend(coo_chunks(index, masks, chunk_size, half)).finalize()
@@ -0,0 +1,106 @@
+""" ----------------------------------------------------------------------------
+
+    shared_tables.py - LR, December 2020
+
+    Parallel construction of the Hamiltonian with the sorted state table and the
+    plaquette masks in shared memory (multiprocessing.shared_memory). The
+    workers attach to the shared blocks once (in the pool initializer), are
+    handed contiguous ranges of states and return the COO triplets of their
+    range as numpy arrays. Nothing but the ranges and the results is pickled,
+    and since the table is not a Python object, the workers don't touch (and
+    hence don't copy) any of its pages.
+
+---------------------------------------------------------------------------- """
+import numpy as np
+from multiprocessing import Pool
+from multiprocessing.shared_memory import SharedMemory
+from .state_index import StateIndex
+from .plaquette_kernels import flip_plaquettes
+from .coo_accumulator import COOAccumulator
+from . import jit_kernels
+
+
+class SharedArrays(object):
+    """ Places a dictionary of numpy arrays into shared memory. Use as context
+        manager, the shared blocks are released on exit. The spec attribute is
+        what needs to be sent to other processes in order to attach.
+    """
+    def __init__(self, arrays):
+        self.blocks, self.spec = [], {}
+        for name, a in arrays.items():
+            shm = SharedMemory(create=True, size=max(1, a.nbytes))
+            np.ndarray(a.shape, dtype=a.dtype, buffer=shm.buf)[...] = a
+            self.blocks.append(shm)
+            self.spec[name] = (shm.name, a.shape, a.dtype)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        for shm in self.blocks:
+            shm.close()
+            shm.unlink()
+
+
+def attach(spec):
+    """ Attaches to the shared arrays described by spec. Returns the arrays and
+        the shared memory handles (which need to be kept alive).
+    """
+    arrays, blocks = {}, []
+    for name, (shm_name, shape, dtype) in spec.items():
+        # Pool workers share the resource tracker of the creating process, so
+        # the block stays registered once and is cleaned up by its owner.
+        shm = SharedMemory(name=shm_name)
+        arrays[name] = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        blocks.append(shm)
+    return arrays, blocks
+
+
+# ------------------------------------------------------------------------------
+# Worker side.
+
+_worker = {}
+
+def _init_worker(spec, method, n_words, half):
+    arrays, blocks = attach(spec)
+    _worker['blocks'] = blocks
+    _worker['method'] = method
+    _worker['half'] = half
+    _worker['index'] = StateIndex.from_keys(arrays.pop('keys'), n_words)
+    _worker['plaquettes'] = arrays
+
+
+def _construct_range(bounds):
+    """ Computes the COO triplets for the states in the range [start, stop).
+    """
+    start, stop = bounds
+    index, plaquettes, half = _worker['index'], _worker['plaquettes'], _worker['half']
+    if _worker['method'] == 'jit':
+        return jit_kernels.construct_coo(index.keys, plaquettes['links'], start, stop, half)
+
+    rows, new_states, signs = flip_plaquettes(index.words[start:stop], plaquettes, offset=start, half=half)
+    cols, found = index.lookup_words(new_states)
+    return rows[found], cols[found], signs[found]
+
+
+# ------------------------------------------------------------------------------
+# Driver side.
+
+def parallel_construct_coo(index, plaquettes, n_threads, method='vectorized', chunk_size=2**14, spill_dir=None, half=False):
+    """ Builds the COO triplets of the plaquette term for all states of the
+        StateIndex index on n_threads processes. The plaquettes are given as
+        dictionary of arrays - the masks of plaquette_kernels.plaquette_masks
+        for the vectorized method, {'links' : ...} for the compiled one.
+
+        The chunk results are streamed (in order) into a COOAccumulator as they
+        come in, see there for spill_dir. With half=True, only the U+ entries
+        are produced.
+    """
+    bounds = [(k, min(k+chunk_size, len(index))) for k in range(0, len(index), chunk_size)]
+    arrays = dict(plaquettes, keys=index.keys)
+    accumulator = COOAccumulator(len(index), spill_dir=spill_dir)
+
+    with SharedArrays(arrays) as shared:
+        with Pool(n_threads, initializer=_init_worker, initargs=(shared.spec, method, index.n_words, half)) as pool:
+            accumulator.extend(pool.imap(_construct_range, bounds))
+    return accumulator.finalize()
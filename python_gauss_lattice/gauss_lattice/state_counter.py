@@ -0,0 +1,182 @@
+""" ----------------------------------------------------------------------------
+
+    state_counter.py - LR, December 2020
+
+    Counts the Gauss law states per winding sector without enumerating them.
+
+    This is a transfer matrix recursion over the sites of the lattice. The
+    sites are visited one after another (slice by slice, along the axis order
+    with the smallest cross-section). Every site gets one of its allowed
+    vertices (the same vertex basis as in the search, but for all sites, not
+    only the sublattice), so Gauss' law holds by construction - the vertex just
+    has to agree with the links that were already set by its neighbours.
+
+    The state of the recursion is the occupation of the "open" links, i.e., the
+    links with exactly one site visited, together with the partial winding
+    numbers. It is propagated as array of distinct states with their
+    multiplicities, which is governed by the cross-section of the lattice and
+    not by the number of Gauss law states. The open links are packed into one
+    integer (reusing the bits of links that are closed) along with the winding
+    numbers, which are counted on the planes that are closed last.
+
+---------------------------------------------------------------------------- """
+import numpy as np
+from itertools import permutations
+from .winding import plane_links, winding_shape
+
+
+def _merge(keys, counts):
+    """ Merges equal keys and sums up their counts. The keys are expected to
+        consist of a few sorted runs, which the stable sort exploits.
+    """
+    order = np.argsort(keys, kind='stable')
+    keys, counts = keys[order], counts[order]
+    first = np.flatnonzero(np.diff(keys, prepend=-1))
+    return keys[first], np.add.reduceat(counts, first) if len(keys) else counts
+
+
+def _open_links(order, links):
+    """ Maximal number of open links when visiting the sites in this order.
+    """
+    seen, n_open, n_max = set(), 0, 0
+    for s in order:
+        for k in links[s]:
+            n_open += -1 if k in seen else 1
+            seen.add(k)
+        n_max = max(n_max, n_open)
+    return n_max
+
+
+def site_order(glatt):
+    """ Order of the sites that minimizes the number of open links. All axis
+        orders are tried, with the sites sorted lexicographically by their
+        coordinates.
+    """
+    sites = range(glatt.S[-1])
+    coords = [[(i // glatt.S[k]) % glatt.L[k] for k in range(glatt.d)] for i in sites]
+    links = [glatt.get_vertex_links(i) for i in sites]
+
+    orders = []
+    for axes in permutations(range(glatt.d)):
+        order = sorted(sites, key=lambda i: [coords[i][a] for a in axes])
+        orders.append((_open_links(order, links), order))
+    return min(orders)[1]
+
+
+def _closing_steps(glatt, order):
+    """ Step (position in the order) at which every link gets closed.
+    """
+    seen, closing = set(), {}
+    for step, s in enumerate(order):
+        for k in glatt.get_vertex_links(s):
+            if k in seen:
+                closing[k] = step
+            seen.add(k)
+    return closing
+
+
+def winding_planes(glatt, order):
+    """ Links to be counted for the winding numbers. Without static charges,
+        the winding number in a direction is the same for every plane
+        perpendicular to it (see winding.plane_links), so we take the plane
+        whose links are closed as late as possible - until then, its winding
+        number is still encoded in the open links and doesn't add to the
+        states of the recursion.
+    """
+    closing = _closing_steps(glatt, order)
+    return [
+        sum(1 << l for l in max(planes, key=lambda p: min(closing[l] for l in p)))
+        for planes in plane_links(glatt.L)
+    ]
+
+
+def transfer_tables(glatt, order):
+    """ Precomputes the data of the recursion for every site in the order:
+
+            freed       mask of the bits of the links set by earlier sites,
+            expected    occupation of these links for every vertex,
+            outgoing    occupation of the new open links (at the bits that
+                        are assigned to them) for every vertex,
+            winding     winding numbers of the closed links for every vertex.
+
+        The vertices of every site are constructed with find_vertex_base and
+        construct_lattice_basis, as link masks on the full lattice.
+    """
+    vertex_base = glatt.find_vertex_base()
+    basis = glatt.construct_lattice_basis(order, glatt.static_charges, vertex_base)
+    planes = winding_planes(glatt, order) if glatt.use_winding else []
+
+    position, free, tables = {}, [], []
+    n_bits = 0
+    for s, vertices in zip(order, basis):
+        links = glatt.get_vertex_links(s)
+        incoming = [k for k in links if k in position]
+        new = [k for k in links if k not in position]
+
+        bits_in = [position.pop(k) for k in incoming]
+        free += bits_in
+        bits_out = []
+        for k in new:
+            if not free:
+                free.append(n_bits)
+                n_bits += 1
+            position[k] = free.pop()
+            bits_out.append(position[k])
+
+        pattern = lambda v, ks, bs: sum(((v >> k) & 1) << b for k, b in zip(ks, bs))
+        in_mask = sum(1 << k for k in incoming)
+        tables.append({
+            'freed' : sum(1 << b for b in bits_in),
+            'expected' : np.array([pattern(v, incoming, bits_in) for v in vertices], dtype=np.int64),
+            'outgoing' : np.array([pattern(v, new, bits_out) for v in vertices], dtype=np.int64),
+            'winding' : np.array([
+                [(v & in_mask & m).bit_count() for m in planes] for v in vertices
+            ], dtype=np.int64).reshape(len(vertices), len(planes)),
+        })
+
+    return tables, n_bits
+
+
+def count_sectors(glatt):
+    """ Counts the Gauss law states of the lattice. Returns an array of the
+        shape of the winding histogram (GaussLattice.winding_bins), with the
+        same content as after GaussLattice.find_states.
+    """
+    tables, n_bits = transfer_tables(glatt, site_order(glatt))
+
+    # The states are single integers: the open links in the lowest n_bits
+    # bits, followed by a field for every winding number.
+    shape = winding_shape(glatt.L) if glatt.use_winding else ()
+    widths = [int(n-1).bit_length() for n in shape]
+    offsets = [n_bits + sum(widths[:j]) for j in range(len(widths))]
+    if n_bits + sum(widths) > 63:
+        raise ValueError(f'Too many open links ({n_bits}) for the transfer matrix.')
+
+    keys = np.zeros(1, dtype=np.int64)
+    counts = np.ones(1, dtype=np.int64)
+    for t in tables:
+        increments = t['outgoing'] + sum(t['winding'][:,j] << o for j, o in enumerate(offsets))
+
+        # The keys are sorted, hence the keys of every vertex (those that agree
+        # with its incoming links, with these bits cleared) are as well, and
+        # the merge only has to combine sorted runs.
+        pattern = keys & t['freed']
+        new_keys, new_counts = [], []
+        for expected in np.unique(t['expected']):
+            keep = pattern == expected
+            k, c = keys[keep] - expected, counts[keep]
+            for increment in increments[t['expected'] == expected]:
+                new_keys.append(k + increment)
+                new_counts.append(c)
+        keys, counts = _merge(np.concatenate(new_keys), np.concatenate(new_counts))
+
+        if counts.size and counts.max() > 2**62 // 20:
+            raise OverflowError('State counts exceed the range of 64 bit integers.')
+
+    if not glatt.use_winding:
+        return np.array([counts.sum()], dtype=np.int64)
+
+    bins = np.zeros(shape, dtype=np.int64)
+    w = tuple((keys >> o) & ((1 << n) - 1) for o, n in zip(offsets, widths))
+    np.add.at(bins, w, counts)
+    return bins
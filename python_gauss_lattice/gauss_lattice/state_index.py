@@ -0,0 +1,150 @@
+""" ----------------------------------------------------------------------------
+
+    state_index.py - LR, December 2020
+
+    Compact inverse lookup for the Fock basis. The sorted states are kept in a
+    contiguous array of unsigned 64 bit integers (8 bytes per state) or, for
+    lattices with more than 64 links, in a structured array of several words
+    with the most significant word first (16 bytes per state for two words),
+    which compares lexicographically and hence in the same order as the
+    integers themselves. Lookups are bisections with np.searchsorted and can
+    be done for whole batches of states at once.
+
+    Numpy's generic (comparison based) sort and search of structured arrays
+    are slow, so the structured keys are sorted word by word with stable sorts
+    (least significant word first) and searched with a vectorized bisection,
+    see sort_keys and searchsorted_keys.
+
+---------------------------------------------------------------------------- """
+import numpy as np
+from .plaquette_kernels import n_words, state_words, words_to_states
+
+
+def _word_keys(words):
+    """ Maps a word array of shape (n, nw) to the sortable key representation.
+    """
+    nw = words.shape[1]
+    if nw == 1:
+        return np.ascontiguousarray(words[:,0])
+    keys = np.empty(len(words), dtype=[('w{:d}'.format(k), '<u8') for k in range(nw-1,-1,-1)])
+    for k in range(nw):
+        keys['w{:d}'.format(k)] = words[:,k]
+    return keys
+
+
+def sort_keys(keys):
+    """ Returns the sorted key array.
+    """
+    if keys.dtype.names is None:
+        return np.sort(keys)
+    order = np.arange(len(keys))
+    for name in keys.dtype.names[::-1]:
+        order = order[np.argsort(keys[name][order], kind='stable')]
+    return keys[order]
+
+
+def searchsorted_keys(sorted_keys, keys):
+    """ Same as np.searchsorted(sorted_keys, keys) (left side). For structured
+        keys, the range of equal most significant words is found with
+        np.searchsorted first, which is then bisected on the other words for
+        all keys at once.
+    """
+    names = sorted_keys.dtype.names
+    if names is None:
+        return np.searchsorted(sorted_keys, keys)
+
+    lo = np.searchsorted(sorted_keys[names[0]], keys[names[0]], side='left')
+    hi = np.searchsorted(sorted_keys[names[0]], keys[names[0]], side='right')
+    active = np.flatnonzero(lo < hi)
+    while len(active):
+        mid = (lo[active] + hi[active]) // 2
+        less, equal = np.zeros(len(active), dtype=bool), np.ones(len(active), dtype=bool)
+        for name in names[1:]:
+            a, b = sorted_keys[name][mid], keys[name][active]
+            less |= equal & (a < b)
+            equal &= a == b
+        lo[active] = np.where(less, mid+1, lo[active])
+        hi[active] = np.where(less, hi[active], mid)
+        active = active[lo[active] < hi[active]]
+    return lo
+
+
+def unique_keys(keys):
+    """ Removes duplicates from a sorted key array.
+    """
+    if not len(keys):
+        return keys
+    first = np.ones(len(keys), dtype=bool)
+    first[1:] = keys[1:] != keys[:-1]
+    return keys[first]
+
+
+class StateIndex(object):
+    """ Sorted array of Fock states with a bisection based inverse lookup.
+    """
+    def __init__(self, states, nb, presorted=False):
+        self.n_words = n_words(nb)
+        self.keys = _word_keys(state_words(states, self.n_words))
+        if not presorted:
+            self.keys = sort_keys(self.keys)
+
+    @classmethod
+    def from_keys(cls, keys, n_words):
+        """ Alternate setup from an existing (sorted) key array, e.g. one that
+            lives in shared memory. No copy is made.
+        """
+        index = cls.__new__(cls)
+        index.n_words = n_words
+        index.keys = keys
+        return index
+
+    def __len__(self):
+        return len(self.keys)
+
+    @property
+    def words(self):
+        """ The states as array of shape (n_states, n_words), lowest word first.
+            This is a view on the keys, no copy is made.
+        """
+        if self.n_words == 1:
+            return self.keys.reshape(-1, 1)
+        return self.keys.view(np.uint64).reshape(-1, self.n_words)[:,::-1]
+
+    @property
+    def nbytes(self):
+        return self.keys.nbytes
+
+    def state(self, n):
+        """ Returns the n-th state as (Python) integer.
+        """
+        return words_to_states(self.words[n:n+1])[0]
+
+    def states(self):
+        """ Returns all states as list of (Python) integers.
+        """
+        if self.n_words == 1:
+            return self.keys.tolist()
+        return words_to_states(self.words)
+
+    def lookup_words(self, words):
+        """ Finds the positions of the states given as word array. Returns the
+            indices and a boolean mask that flags the states which were found.
+        """
+        keys = _word_keys(words)
+        ind = searchsorted_keys(self.keys, keys)
+        found = ind < len(self.keys)
+        found[found] = self.keys[ind[found]] == keys[found]
+        return ind, found
+
+    def indices(self, states):
+        """ Batched inverse lookup, returns -1 for states that are not found.
+        """
+        ind, found = self.lookup_words(state_words(states, self.n_words))
+        ind[~found] = -1
+        return ind
+
+    def index(self, state):
+        """ Inverse lookup of a single state, returns None if it is not found.
+        """
+        ind = self.indices([state])[0]
+        return int(ind) if ind >= 0 else None
@@ -0,0 +1,159 @@
+""" ----------------------------------------------------------------------------
+
+    state_writer.py - LR, December 2020
+
+    Buffered output of states sorted by sector (winding sector or charge
+    configuration). Every sector has its own numpy append buffer, the states
+    are added in batches (e.g., the results of a subtree of the search) and
+    once the buffers hold buffer_length states in total, all of them are
+    written in one go - one contiguous append per sector and a single opening
+    of the file.
+
+    The HDF5 datasets are chunked and compressed (gzip with byte shuffling by
+    default, which works well for the sorted-ish integers we produce).
+
+    For long runs, the writer can checkpoint: the buffers are flushed and the
+    size of every dataset is recorded as attribute 'n_checkpoint', together
+    with whatever the caller needs to resume (as file attributes with prefix
+    'checkpoint_<name>_', such that several runs can share a file). On resume, the datasets are truncated to the checkpointed
+    sizes, which drops the states that were written after the last checkpoint.
+
+---------------------------------------------------------------------------- """
+import os
+import numpy as np
+import h5py as hdf
+
+
+class SectorWriter(object):
+    """ Writes states to the datasets of their sectors. The sectors are given
+        as keys (tuples, e.g. the winding numbers) and label maps a key to the
+        name of the dataset. Files that don't end with .hdf5 are written as
+        plain text with the given header and one line 'state,key...' per state.
+    """
+    def __init__(self, filename, sectors, label, append=False, buffer_length=2**20,
+                 chunk_size=2**14, compression='gzip', compression_opts=4, header='state,sector',
+                 resume=False, name='all'):
+        self.filename = filename
+        self.prefix = f'checkpoint_{name}_'
+        self.output_format = filename.split('.')[-1]
+        self.label = label
+        self.labels = [label(key) for key in sectors]
+        self.buffer_length = int(buffer_length)
+        self.buffers, self.n_buffered, self.n_written = {}, 0, 0
+
+        # Attributes of the checkpoint we resume from (empty if none).
+        self.restored = {}
+        if resume:
+            if self.output_format != 'hdf5':
+                raise ValueError('Resuming is only possible with HDF5 output.')
+            if os.path.exists(self.filename):
+                self.restored = self.restore()
+                if self.restored:
+                    return
+
+        if self.output_format == 'hdf5':
+            with hdf.File(self.filename, 'a' if append or resume else 'w') as f:
+                for k in list(f.attrs):
+                    if k.startswith(self.prefix):
+                        del f.attrs[k]
+                for key in sectors:
+                    if label(key) in f:
+                        del f[label(key)]
+                    f.create_dataset(
+                        label(key),
+                        (0,),
+                        maxshape=(None,),
+                        dtype='i8',
+                        chunks=(chunk_size,),
+                        compression=compression,
+                        compression_opts=compression_opts if compression == 'gzip' else None,
+                        shuffle=compression is not None
+                    )
+        else:
+            # Attention: truncates existing file.
+            with open(self.filename, 'w') as f:
+                f.write(header + '\n')
+
+
+    def add(self, key, states):
+        """ Appends states (array-like of integers) to the sector key.
+        """
+        states = np.asarray(states, dtype=np.int64)
+        buf, n = self.buffers.get(key, (None, 0))
+        if buf is None or n + len(states) > len(buf):
+            new = np.empty(max(2*(n + len(states)), 1024), dtype=np.int64)
+            if buf is not None:
+                new[:n] = buf[:n]
+            buf = new
+        buf[n:n+len(states)] = states
+        self.buffers[key] = (buf, n + len(states))
+
+        self.n_buffered += len(states)
+        if self.n_buffered >= self.buffer_length:
+            self.flush()
+
+
+    def add_batch(self, states, keys):
+        """ Appends a batch of states, keys holds the sector of every state (as
+            array of shape (n_states, key length)).
+        """
+        states = np.asarray(states, dtype=np.int64)
+        if not len(states):
+            return
+        sectors, inverse = np.unique(keys, axis=0, return_inverse=True)
+        inverse = inverse.ravel()
+        order = np.argsort(inverse, kind='stable')
+        bounds = np.searchsorted(inverse[order], np.arange(len(sectors)+1))
+        for k, key in enumerate(sectors.tolist()):
+            self.add(tuple(key), states[order[bounds[k]:bounds[k+1]]])
+
+
+    def flush(self):
+        """ Writes all buffered states to file and clears the buffers.
+        """
+        if not self.n_buffered:
+            return
+
+        if self.output_format == 'hdf5':
+            with hdf.File(self.filename, 'a') as f:
+                for key, (buf, n) in self.buffers.items():
+                    if n:
+                        dset = f[self.label(key)]
+                        dset.resize(dset.shape[0]+n, axis=0)
+                        dset[-n:] = buf[:n]
+        else:
+            with open(self.filename, 'a') as f:
+                for key, (buf, n) in self.buffers.items():
+                    suffix = ',' + ','.join(map(str, key)) + '\n'
+                    f.writelines(str(s) + suffix for s in buf[:n].tolist())
+
+        self.n_written += self.n_buffered
+        self.buffers = {key : (buf, 0) for key, (buf, n) in self.buffers.items()}
+        self.n_buffered = 0
+
+
+    def checkpoint(self, **attrs):
+        """ Flushes the buffers and records the dataset sizes along with the
+            given attributes.
+        """
+        self.flush()
+        with hdf.File(self.filename, 'a') as f:
+            for label in self.labels:
+                f[label].attrs['n_checkpoint'] = f[label].shape[0]
+            for k, v in attrs.items():
+                f.attrs[self.prefix + k] = v
+
+
+    def restore(self):
+        """ Truncates the datasets to the last checkpoint and returns its
+            attributes (without prefix). Returns an empty dictionary if there
+            is no checkpoint in the file.
+        """
+        with hdf.File(self.filename, 'a') as f:
+            attrs = {k[len(self.prefix):] : v for k, v in f.attrs.items() if k.startswith(self.prefix)}
+            if not attrs or any(label not in f for label in self.labels):
+                return {}
+            for label in self.labels:
+                dset = f[label]
+                dset.resize(dset.attrs['n_checkpoint'], axis=0)
+        return attrs
@@ -0,0 +1,267 @@
+""" ----------------------------------------------------------------------------
+
+    symmetries.py - LR, December 2020
+
+    Point group operations (rotations, reflections, inversion) and charge
+    conjugation as precomputed link permutation tables that act on whole word
+    arrays of states (compare symmetry_stuff/lattice_object.py, which does the
+    same on a vertex by vertex object representation).
+
+    An operation maps the link from site x along the axis a to the link of the
+    rotated site R x along R e_a (with R a signed permutation of the axes, the
+    origin is kept). If R e_a points in a negative direction, it's the link
+    from R x - e_b along b, whose orientation is reversed - the electric field
+    changes its sign, i.e., the occupation of the link is complemented. The
+    permutation is applied by moving all links with the same displacement at
+    once (one mask and one shift each). Charge conjugation complements all
+    occupations.
+
+    As fermionic operators, a permutation reorders the creation operators of
+    the occupied links, the sign is the parity of the inversions among them:
+
+        (-1)**sum_i(s_i * popcount(s & inv_i)),   inv_i = {j > i : P(j) < P(i)}.
+
+    Complementing the links of the set M (c_k -> c_k^+ for k in M, with the
+    empty lattice mapped to the state with M occupied) gives the sign
+
+        (-1)**sum_{k occupied}(number of links in M below k),
+
+    which is one popcount with the mask of the links k for which this number
+    is odd. For charge conjugation (M all links), these are the odd links.
+
+    The symmetric basis is built for abelian groups, i.e., commuting
+    generators (including the fermionic signs, which is checked). Then every
+    generator g has eigenvalues lambda with lambda**n = omega (n the order of
+    g as permutation, omega = +1 or -1 as g**n = omega) and the irreducible
+    representations are labelled by the integers q with
+
+        lambda = exp(i pi (2 q + (1 - omega)/2) / n),   q = 0, ..., n-1.
+
+---------------------------------------------------------------------------- """
+import numpy as np
+from .bit_magic import popcount64
+from .plaquette_kernels import n_words, state_words, _split_int
+from .translations import shift_words, less_words
+
+
+def _mask_words(bits, nw):
+    return np.array(_split_int(sum(1 << int(b) for b in bits), nw), dtype=np.uint64)
+
+
+def _strides(L):
+    S = [1]
+    for l in L:
+        S.append(l*S[-1])
+    return S
+
+
+def axis_maps(d):
+    """ The named operations as signed permutation matrices R, acting on the
+        coordinates as x -> R x.
+    """
+    I = np.eye(d, dtype=np.int64)
+    maps = {'parity' : -I, 'identity' : I}
+    for a, label in zip(range(d), 'xyz'):
+        maps['mirror_' + label] = I.copy()
+        maps['mirror_' + label][a,a] = -1
+
+    # Rotations by 90 degrees in the planes (about the third axis in 3D).
+    planes = {'z' : (0,1), 'x' : (1,2), 'y' : (2,0)} if d == 3 else {'z' : (0,1)}
+    for label, (a, b) in planes.items():
+        R = I.copy()
+        R[:,a], R[:,b] = I[:,b], -I[:,a]
+        maps['c4_' + label] = R
+    if d == 3:
+        maps['c3'] = I[:,[1,2,0]]
+        maps['c2_xy'] = np.array([[0,1,0], [1,0,0], [0,0,-1]])
+        maps['c2_yz'] = np.array([[-1,0,0], [0,0,1], [0,1,0]])
+        maps['c2_xz'] = np.array([[0,0,1], [0,-1,0], [1,0,0]])
+    return maps
+
+
+def link_permutation(L, R):
+    """ Permutation of the links under x -> R x, as list perm with perm[k] the
+        new position of link k, and the list of new positions of the links
+        whose orientation is reversed.
+    """
+    d, S = len(L), _strides(L)
+    R = np.asarray(R)
+    for b, a in zip(*np.nonzero(R)):
+        if L[a] != L[b]:
+            raise ValueError(f'The operation maps axis {a} to axis {b}, but the lattice is {L}.')
+
+    perm, reversed_links = [], []
+    for i in range(S[-1]):
+        x = np.array([(i // S[k]) % L[k] for k in range(d)])
+        y = R @ x
+        for a in range(d):
+            b = int(np.flatnonzero(R[:,a])[0])
+            z = y - (R[b,a] < 0)*np.eye(d, dtype=np.int64)[b]
+            j = sum(int(z[k] % L[k])*S[k] for k in range(d))
+            perm.append(d*j + b)
+            if R[b,a] < 0:
+                reversed_links.append(perm[-1])
+    return perm, reversed_links
+
+
+def compile_operation(perm, complement=()):
+    """ Precomputes the masks of the operation (links permuted by perm, then
+        the links at the positions complement are complemented), see the
+        description above.
+    """
+    nb = len(perm)
+    nw = n_words(nb)
+    displacements = {}
+    for k, p in enumerate(perm):
+        displacements.setdefault(p - k, []).append(k)
+    below = np.cumsum([0] + [int(k in set(complement)) for k in range(nb-1)])
+
+    return {
+        'perm' : list(perm),
+        'moves' : [(_mask_words(bits, nw), shift) for shift, bits in displacements.items()],
+        'inversions' : np.array([_mask_words([j for j in range(i+1, nb) if perm[j] < perm[i]], nw) for i in range(nb)]),
+        'complement' : _mask_words(complement, nw),
+        'complement_sign' : _mask_words(np.flatnonzero(below % 2), nw),
+    }
+
+
+def _bits(words, nb):
+    """ Occupations as array of shape (n_states, nb).
+    """
+    return np.concatenate([
+        (words[:,k,None] >> np.arange(64, dtype=np.uint64)[None,:]) & np.uint64(1)
+        for k in range(words.shape[1])
+    ], axis=1)[:,:nb].astype(np.int64)
+
+
+def apply_operation(words, table, fermions=True):
+    """ Applies the operation to all states of the word array, returns the new
+        states and the parities of the fermionic signs (zero for bosons).
+    """
+    new_words = np.zeros_like(words)
+    for mask, shift in table['moves']:
+        new_words |= shift_words(words & mask, shift) if shift else words & mask
+
+    parity = np.zeros(len(words), dtype=np.int64)
+    if fermions:
+        counts = popcount64(words[:,None,:] & table['inversions'][None,:,:]).sum(axis=2, dtype=np.int64)
+        parity += (counts * _bits(words, len(table['perm']))).sum(axis=1)
+    if fermions:
+        parity += popcount64(new_words & table['complement_sign']).sum(axis=1, dtype=np.int64)
+    new_words ^= table['complement']
+    return new_words, parity & 1
+
+
+def _random_words(nb, n=16, seed=42):
+    rng = np.random.default_rng(seed)
+    return state_words([int.from_bytes(rng.bytes(16), 'little') % 2**nb for _ in range(n)], n_words(nb))
+
+
+def _compose(words, first, second, fermions):
+    words, p = apply_operation(words, first, fermions)
+    words, q = apply_operation(words, second, fermions)
+    return words, p ^ q
+
+
+def symmetry_generators(L, names, fermions=True):
+    """ Compiles the named operations (see axis_maps, and 'charge_conjugation')
+        as generators of an abelian group. Every table gets the order of the
+        operation and the scalar omega = g**order. Raises a ValueError if the
+        generators don't commute.
+    """
+    d = len(L)
+    maps = axis_maps(d)
+    generators = []
+    for name in names:
+        if name == 'charge_conjugation':
+            perm, _ = link_permutation(L, maps['identity'])
+            table = compile_operation(perm, complement=range(len(perm)))
+        elif name in maps:
+            table = compile_operation(*link_permutation(L, maps[name]))
+        else:
+            raise ValueError(f'Unknown symmetry operation \'{name}\'.')
+        table['name'] = name
+        generators.append(table)
+
+    test = _random_words(d*_strides(L)[-1])
+    for table in generators:
+        words, parity, order = test, np.zeros(len(test), dtype=np.int64), 0
+        while True:
+            words, p = apply_operation(words, table, fermions)
+            parity, order = parity ^ p, order + 1
+            if np.all(words == test):
+                break
+        if len(set(parity.tolist())) != 1:
+            raise ValueError(f'The power of \'{table["name"]}\' is not a scalar.')
+        table['order'], table['omega'] = order, 1 - 2*int(parity[0])
+
+    for i, g in enumerate(generators):
+        for h in generators[:i]:
+            gh, p_gh = _compose(test, h, g, fermions)
+            hg, p_hg = _compose(test, g, h, fermions)
+            if np.any(gh != hg) or np.any(p_gh != p_hg):
+                raise ValueError(f'The operations \'{g["name"]}\' and \'{h["name"]}\' don\'t commute.')
+    return generators
+
+
+def group_elements(words, generators, fermions=True, index=0):
+    """ Generator over all group elements g = g_0**e_0 g_1**e_1 ... applied to
+        the states, yields (e, images, parity).
+    """
+    if index == len(generators):
+        yield (), words, np.zeros(len(words), dtype=np.int64)
+        return
+
+    parity = np.zeros(len(words), dtype=np.int64)
+    for e in range(generators[index]['order']):
+        for rest, images, p in group_elements(words, generators, fermions, index+1):
+            yield (e,) + rest, images, (p + parity) & 1
+        words, p = apply_operation(words, generators[index], fermions)
+        parity += p
+
+
+def irreps(generators):
+    """ Labels q of all irreducible representations of the group.
+    """
+    return [tuple(int(q) for q in qs) for qs in np.ndindex(*[g['order'] for g in generators])]
+
+
+def eigenvalues(generators, irrep):
+    """ Eigenvalues of the generators in the irreducible representation.
+    """
+    return np.array([
+        np.exp(1j*np.pi*(2*q + (1 - g['omega'])//2) / g['order']) for g, q in zip(generators, irrep)
+    ])
+
+
+def characters(exponents, generators, irrep):
+    """ Complex conjugate character lambda**(-e) of the group elements given by
+        their exponents (rows of the array), which is the coefficient of the
+        element in the symmetric states.
+    """
+    return np.exp(-1j * (np.asarray(exponents) @ np.angle(eigenvalues(generators, irrep))))
+
+
+def representatives(words, generators, fermions=True):
+    """ Smallest image of every state under the group. Returns the
+        representatives, the exponents e of the group elements and the
+        parities p such that g**e |s> = (-1)**p |representative>.
+    """
+    reps, parity = words.copy(), np.zeros(len(words), dtype=np.int64)
+    exponents = np.zeros((len(words), len(generators)), dtype=np.int64)
+    for e, images, p in group_elements(words, generators, fermions):
+        smaller = less_words(images, reps)
+        reps[smaller], parity[smaller], exponents[smaller] = images[smaller], p[smaller], e
+    return reps, exponents, parity
+
+
+def orbit_norms(words, generators, irrep, fermions=True):
+    """ Sum of the characters times the signs over the stabilizer of every
+        state, which is the size of the stabilizer if the state survives the
+        projection onto the irreducible representation and zero otherwise.
+    """
+    norms = np.zeros(len(words), dtype=np.complex128)
+    for e, images, p in group_elements(words, generators, fermions):
+        same = np.all(images == words, axis=1)
+        norms[same] += (1 - 2*p[same]) * characters([e], generators, irrep)[0]
+    return norms.real.round().astype(np.int64)
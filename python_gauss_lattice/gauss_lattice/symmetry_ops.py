@@ -0,0 +1,200 @@
+""" ----------------------------------------------------------------------------
+
+    symmetry_ops.py - LR, December 2020
+
+    Bulk symmetry transformations of states, as replacement for the vertex by
+    vertex representation in symmetry_stuff/lattice_object.py (which is kept
+    for drawing and exploration). Every lattice symmetry - translations, the
+    point group operations of symmetries.py, charge conjugation and any
+    product of them - is a permutation of the link indices followed by the
+    complement of a set of links. It's compiled once into the masks of
+    symmetries.compile_operation and then applied to whole word arrays (or
+    lists of integer states) at once, including the fermionic signs.
+
+    An element is kept as the pair (perm, complement). Applying (P1, M1)
+    first and (P2, M2) second gives
+
+        s -> P2(P1 s ^ M1) ^ M2 = (P2 P1) s ^ (P2(M1) ^ M2),
+
+    so the products are again elements and the group spanned by a set of
+    generators is found as closure. As fermionic operators, the product and
+    the directly compiled element agree up to a global sign, which is kept
+    with the element (the sign of the product is the one that counts).
+
+    The same elements drive the orbit and stabilizer computations: the
+    representative of a state is its smallest image, the stabilizer is the
+    set of elements that map the state onto itself (up to the sign).
+
+---------------------------------------------------------------------------- """
+import numpy as np
+from .plaquette_kernels import n_words, state_words, words_to_states
+from .symmetries import axis_maps, link_permutation, compile_operation, apply_operation, _random_words
+from .translations import less_words
+
+
+class SymmetryOps(object):
+    """ Compiled symmetry operations of a lattice, applied to arrays of states.
+    """
+    def __init__(self, L, fermions=True, chunk_size=2**14):
+        self.L = list(L)
+        self.d = len(L)
+        self.S = [1]
+        for l in L:
+            self.S.append(l*self.S[-1])
+        self.nb = self.d*self.S[-1]
+        self.n_words = n_words(self.nb)
+        self.fermions = fermions
+        self.chunk_size = chunk_size
+        self._test_words = _random_words(self.nb)
+
+    # ----
+    def names(self):
+        """ All operations that can be compiled by name.
+        """
+        translations = ['translation_' + label for label in 'xyz'[:self.d]]
+        return translations + list(axis_maps(self.d)) + ['charge_conjugation']
+
+    def element(self, name):
+        """ The named operation as pair (perm, complement), see above.
+        """
+        maps = axis_maps(self.d)
+        if name == 'charge_conjugation':
+            return list(range(self.nb)), frozenset(range(self.nb))
+        if name.startswith('translation_') and name[-1:] in 'xyz'[:self.d]:
+            a = 'xyz'.index(name[-1])
+            perm = []
+            for i in range(self.S[-1]):
+                x = (i // self.S[a]) % self.L[a]
+                j = i + self.S[a] if x < self.L[a]-1 else i - (self.L[a]-1)*self.S[a]
+                perm += [self.d*j + b for b in range(self.d)]
+            return perm, frozenset()
+        if name in maps:
+            perm, reversed_links = link_permutation(self.L, maps[name])
+            return perm, frozenset(reversed_links)
+        raise ValueError(f'Unknown symmetry operation \'{name}\'.')
+
+    @staticmethod
+    def multiply(first, second):
+        """ The element that applies first and then second.
+        """
+        (p1, m1), (p2, m2) = first, second
+        return [p2[k] for k in p1], frozenset(p2[m] for m in m1) ^ m2
+
+    def _table(self, element, parity=0):
+        table = compile_operation(*element)
+        table['parity'] = parity
+        return table
+
+    def compile(self, *names):
+        """ Compiles the product of the named operations (applied in the given
+            order, i.e., the first one first) into a table for apply.
+        """
+        element = (list(range(self.nb)), frozenset())
+        words, parity = self._test_words, 0
+        for name in names:
+            element = self.multiply(element, self.element(name))
+            words, p = self.apply(words, self._table(self.element(name)))
+            parity = parity ^ p
+        table = self._table(element, self._global_parity(element, words, parity))
+        table['name'] = '*'.join(names) if names else 'identity'
+        return table
+
+    def _global_parity(self, element, words, parity):
+        """ Relative sign between the product (given by its action on the test
+            states) and the directly compiled element.
+        """
+        _, q = self.apply(self._test_words, self._table(element))
+        offset = parity ^ q
+        if len(set(offset.tolist())) != 1:
+            raise ValueError('The product is not a fermionic symmetry operation.')
+        return int(offset[0])
+
+    # ----
+    def _words(self, states):
+        if isinstance(states, np.ndarray) and states.ndim == 2:
+            return states
+        return state_words(states, self.n_words)
+
+    def apply(self, states, table):
+        """ Applies the compiled operation to all states (word array or list of
+            integers, the result is of the same type). Returns the new states
+            and the parities of the fermionic signs (zero for bosons).
+        """
+        words = self._words(states)
+        new_words, parity = np.empty_like(words), np.empty(len(words), dtype=np.int64)
+        for k in range(0, len(words), self.chunk_size):
+            new_words[k:k+self.chunk_size], parity[k:k+self.chunk_size] = apply_operation(
+                words[k:k+self.chunk_size], table, self.fermions
+            )
+        if self.fermions:
+            parity ^= table.get('parity', 0)
+        if words is states:
+            return new_words, parity
+        return words_to_states(new_words), parity
+
+    def group(self, names):
+        """ All elements of the group spanned by the named generators, as
+            compiled tables (the identity first). Every table holds the
+            generator names of one product that gives the element.
+        """
+        identity = (list(range(self.nb)), frozenset())
+        generators = [(name, self.element(name), self.compile(name)) for name in names]
+        key = lambda e: (tuple(e[0]), tuple(sorted(e[1])))
+
+        elements = [(identity, (), self._test_words, np.zeros(len(self._test_words), dtype=np.int64))]
+        seen, k = {key(identity)}, 0
+        while k < len(elements):
+            element, word, words, parity = elements[k]
+            for name, g, table in generators:
+                product = self.multiply(element, g)
+                if key(product) not in seen:
+                    seen.add(key(product))
+                    images, p = self.apply(words, table)
+                    elements.append((product, word + (name,), images, parity ^ p))
+            k += 1
+
+        tables = []
+        for element, word, words, parity in elements:
+            table = self._table(element, self._global_parity(element, words, parity))
+            table['name'] = '*'.join(word) if word else 'identity'
+            tables.append(table)
+        return tables
+
+    # ----
+    def orbits(self, states, group):
+        """ Representative (the smallest image) of every state under the group.
+            Returns the representatives (of the same type as the states), the
+            indices of the elements g and the parities p such that
+
+                g |s> = (-1)**p |rep>.
+        """
+        words = self._words(states)
+        reps, parity = words.copy(), np.zeros(len(words), dtype=np.int64)
+        elements = np.zeros(len(words), dtype=np.int64)
+        for k, table in enumerate(group):
+            images, p = self.apply(words, table)
+            smaller = less_words(images, reps)
+            reps[smaller], parity[smaller], elements[smaller] = images[smaller], p[smaller], k
+        if words is not states:
+            reps = words_to_states(reps)
+        return reps, elements, parity
+
+    def stabilizers(self, states, group):
+        """ Stabilizers of the states, as boolean array of shape (n_states,
+            n_elements) that flags the elements which map the state onto
+            itself, and the parities of the signs they pick up.
+        """
+        words = self._words(states)
+        fixed = np.zeros((len(words), len(group)), dtype=bool)
+        parity = np.zeros((len(words), len(group)), dtype=np.int64)
+        for k, table in enumerate(group):
+            images, p = self.apply(words, table)
+            fixed[:,k] = np.all(images == words, axis=1)
+            parity[:,k] = p
+        return fixed, parity
+
+    def orbit_sizes(self, states, group):
+        """ Number of distinct images of every state.
+        """
+        fixed, _ = self.stabilizers(states, group)
+        return len(group) // fixed.sum(axis=1)
@@ -0,0 +1,168 @@
+""" ----------------------------------------------------------------------------
+
+    translations.py - LR, December 2020
+
+    Translation symmetry on the bit level. The links of site i are the bits
+    d*i, ..., d*i+d-1, so a translation by one site along the axis a moves
+    every link by d*S[a] bits - except for the sites on the last slice, which
+    wrap around. The bit string consists of blocks of d*S[a+1] bits (one line
+    of sites along a), and within every block, the translation is a rotation:
+
+        T_a s = ((s & low) << d*S[a]) | ((s & high) >> d*(L[a]-1)*S[a])
+
+    where high holds the links of the last slice of every block and low the
+    rest. As fermionic operator, the translation also reorders the creation
+    operators of the occupied links. Only the links that leave the block
+    change their order with respect to others, hence the sign is
+
+        (-1)**sum_blocks(popcount(s & high_b) * popcount(s & low_b)).
+
+    The states are word arrays as in plaquette_kernels (lowest word first).
+    A general translation t = (t_x, t_y, ...) is applied step by step, the
+    representative of a state is its smallest image.
+
+---------------------------------------------------------------------------- """
+import numpy as np
+from .bit_magic import popcount64
+from .plaquette_kernels import n_words, _split_int
+
+_WORD = 64
+
+
+def _mask_words(bits, nw):
+    return np.array(_split_int(sum(1 << b for b in bits), nw), dtype=np.uint64)
+
+
+def shift_words(words, n):
+    """ Shifts all states of the word array by n bits (to the left for n > 0,
+        to the right for n < 0). Bits beyond the last word are dropped.
+    """
+    nw = words.shape[1]
+    q, r = divmod(abs(n), _WORD)
+    out = np.zeros_like(words)
+    for k in range(nw):
+        # The source words of word k (the lower one provides the carry).
+        j = k - q if n > 0 else k + q
+        j_carry = j - 1 if n > 0 else j + 1
+        if 0 <= j < nw:
+            out[:,k] = words[:,j] << np.uint64(r) if n > 0 else words[:,j] >> np.uint64(r)
+        if r and 0 <= j_carry < nw:
+            if n > 0:
+                out[:,k] |= words[:,j_carry] >> np.uint64(_WORD - r)
+            else:
+                out[:,k] |= words[:,j_carry] << np.uint64(_WORD - r)
+    return out
+
+
+def translation_tables(L):
+    """ Masks and shifts of the translations by one site along every axis (see
+        the description above).
+    """
+    d = len(L)
+    S = [1]
+    for l in L:
+        S.append(l*S[-1])
+    nb = d*S[-1]
+    nw = n_words(nb)
+
+    tables = []
+    for a in range(d):
+        step, block = d*S[a], d*S[a+1]
+        blocks = [range(b, b+block) for b in range(0, nb, block)]
+        high = [[k for k in bits if k - bits[0] >= block - step] for bits in blocks]
+        low = [[k for k in bits if k - bits[0] < block - step] for bits in blocks]
+        tables.append({
+            'low' : _mask_words(sum(low, []), nw),
+            'high' : _mask_words(sum(high, []), nw),
+            'extent' : L[a],
+            'up' : step,
+            'down' : block - step,
+            'low_blocks' : np.array([_mask_words(b, nw) for b in low]),
+            'high_blocks' : np.array([_mask_words(b, nw) for b in high]),
+        })
+    return tables
+
+
+def _popcounts(words, masks):
+    return popcount64(words[:,None,:] & masks[None,:,:]).sum(axis=2, dtype=np.int64)
+
+
+def translate(words, table, fermions=True):
+    """ Translates all states of the word array by one site, returns the new
+        states and the parity of the fermionic sign (zero for bosons).
+    """
+    new_words = shift_words(words & table['low'], table['up']) | shift_words(words & table['high'], -table['down'])
+    if not fermions:
+        return new_words, np.zeros(len(words), dtype=np.int64)
+    parity = (_popcounts(words, table['low_blocks']) * _popcounts(words, table['high_blocks'])).sum(axis=1) & 1
+    return new_words, parity
+
+
+def translations(words, tables, fermions=True, axis=0):
+    """ Generator over all translations of the states, yields (t, images,
+        parity) with the translation vector t.
+    """
+    if axis == len(tables):
+        yield (), words, np.zeros(len(words), dtype=np.int64)
+        return
+
+    parity = np.zeros(len(words), dtype=np.int64)
+    for t in range(tables[axis]['extent']):
+        for rest, images, p in translations(words, tables, fermions, axis+1):
+            yield (t,) + rest, images, (p + parity) & 1
+        words, p = translate(words, tables[axis], fermions)
+        parity += p
+
+
+def less_words(a, b):
+    """ Elementwise a < b for two word arrays.
+    """
+    less = np.zeros(len(a), dtype=bool)
+    equal = np.ones(len(a), dtype=bool)
+    for k in range(a.shape[1]-1, -1, -1):
+        less |= equal & (a[:,k] < b[:,k])
+        equal &= a[:,k] == b[:,k]
+    return less
+
+
+def representatives(words, tables, fermions=True):
+    """ Finds the representative (the smallest image under all translations)
+        of every state. Returns the representatives, the translations t (as
+        array of shape (n_states, d)) and the parities p such that
+
+            T_t |s> = (-1)**p |representative>.
+    """
+    reps, parity = words.copy(), np.zeros(len(words), dtype=np.int64)
+    shifts = np.zeros((len(words), len(tables)), dtype=np.int64)
+    for t, images, p in translations(words, tables, fermions):
+        smaller = less_words(images, reps)
+        reps[smaller], parity[smaller], shifts[smaller] = images[smaller], p[smaller], t
+    return reps, shifts, parity
+
+
+def characters(shifts, L, momentum):
+    """ exp(-i k t) for the translations t (rows of shifts) and the momentum
+        k = 2 pi m / L, given as integer vector m.
+    """
+    k = 2*np.pi*np.asarray(momentum) / np.asarray(L)
+    return np.exp(-1j * (shifts @ k))
+
+
+def orbit_norms(words, tables, L, momentum, fermions=True):
+    """ Sum of exp(-i k h) (-1)**p over the stabilizer {h : T_h s = (-1)**p s}
+        of every state. This is the size of the stabilizer if the momentum is
+        compatible with the state and zero otherwise (the momentum state
+        built from it vanishes).
+    """
+    norms = np.zeros(len(words), dtype=np.complex128)
+    for t, images, p in translations(words, tables, fermions):
+        same = np.all(images == words, axis=1)
+        norms[same] += (1 - 2*p[same]) * characters(np.array([t]), L, momentum)[0]
+    return norms.real.round().astype(np.int64)
+
+
+def momentum_sectors(L):
+    """ All momentum sectors of the lattice, as integer vectors m (the momentum
+        being k = 2 pi m / L).
+    """
+    return [tuple(int(m) for m in ms) for ms in np.ndindex(*L)]
@@ -0,0 +1,133 @@
+""" ----------------------------------------------------------------------------
+
+    winding.py - LR, December 2020
+
+    Winding numbers of lattice states. The winding number in a direction is the
+    number of occupied links of that direction which cross a plane (2D: a line)
+    perpendicular to it. With one bitmask per direction, this is a single
+    popcount of the state & mask - for a single (Python) integer, or for whole
+    batches of states given as uint64 array or as word array (for more than
+    64 links).
+
+    The winding numbers are used directly as index of the winding sector, i.e.,
+    into the histograms and for the labels of the HDF5 datasets.
+
+---------------------------------------------------------------------------- """
+import numpy as np
+from functools import lru_cache
+from .bit_magic import popcount64
+from .plaquette_kernels import n_words, state_words
+
+
+def winding_links(L):
+    """ Computes the indices of the links to be summed over for the different
+        winding numbers.
+    """
+    L = np.array(L)
+    d = len(L)
+    S = [1]
+    for l in L:
+        S.append(l*S[-1])
+
+    # Find the indices and shifts along the axes. The indices in this case
+    # are of the site on the lattice, without pointing to a specific link yet.
+    # The shift moves a piont on the axis to the opposite side of the lattice.
+    e = []
+    for i in range(1,d+1):
+        e.append(np.arange(0,S[i],S[i-1])*d)
+
+    if d == 2:
+        # In 2D these are just along one axis.
+        return [e[1], e[0]+1]
+
+    if d == 3:
+        # In 3D we have to sum over entire faces of the cube - here we
+        # construct the indices for all of them.
+        wmx = []
+        for j in range(L[2]):
+            wmx = np.concatenate((wmx, np.arange(j*3*S[2], 3*(j*S[2]+S[2]), 3*S[1])))
+
+        wmy = []
+        for j in range(L[2]):
+            wmy = np.concatenate((wmy, np.arange(j*3*S[2], 3*(j*S[2]+S[1]), 3*S[0])))
+
+        wmz = []
+        for j in range(L[0]):
+            wmz = np.concatenate((wmz, np.arange(j*3*S[1], 3*(j*S[1]+S[1]), 3*S[0])))
+
+        return [
+            np.array(wmx, dtype=np.int64),
+            np.array(wmy, dtype=np.int64)+1,
+            np.array(wmz, dtype=np.int64)+2
+        ]
+
+    raise NotImplementedError('Only 2D and 3D lattices are allowed.')
+
+
+def plane_links(L):
+    """ For every winding number, the links of all planes perpendicular to its
+        direction (the first one is that of winding_links). Without static
+        charges, the field lines are conserved and the winding number is the
+        same for every one of these planes.
+    """
+    L = [int(l) for l in L]
+    d = len(L)
+    S = [1]
+    for l in L:
+        S.append(l*S[-1])
+
+    planes = []
+    for links in winding_links(L):
+        k = int(links[0]) % d
+        sites = [int(l) // d for l in links]
+        x = [(i // S[k]) % L[k] for i in sites]
+        planes.append([
+            [d*(i + S[k]*((xi + c) % L[k] - xi)) + k for i, xi in zip(sites, x)]
+            for c in range(L[k])
+        ])
+    return planes
+
+
+def winding_shape(L):
+    """ Number of possible values of the winding numbers in every direction,
+        i.e., the shape of the winding sector histogram.
+    """
+    if len(L) == 2:
+        return tuple(int(l)+1 for l in L[::-1])
+    if len(L) == 3:
+        return (L[1]*L[2] + 1, L[0]*L[2] + 1, L[0]*L[1] + 1)
+    raise NotImplementedError('Only 2D and 3D lattices are allowed.')
+
+
+@lru_cache(maxsize=None)
+def _masks(L):
+    masks = [sum(1 << int(k) for k in links) for links in winding_links(L)]
+    nw = n_words(len(L)*int(np.prod(L)))
+    return masks, state_words(masks, nw)
+
+
+def winding_masks(L):
+    """ One bitmask (Python integer) per direction.
+    """
+    return _masks(tuple(L))[0]
+
+
+def winding_numbers(state, L):
+    """ Winding numbers of a single state.
+    """
+    return tuple((int(state) & m).bit_count() for m in winding_masks(L))
+
+
+def sector_of(states, L):
+    """ Winding sectors of a batch of states, returned as an integer array of
+        shape (n_states, d). The states may be given as a list of (Python)
+        integers, a 1D integer array, or a word array of shape
+        (n_states, n_words).
+    """
+    masks, mask_words = _masks(tuple(L))
+    nw = mask_words.shape[1]
+    if isinstance(states, np.ndarray) and states.ndim == 2:
+        words = states
+    else:
+        words = state_words(states, nw)
+    return popcount64(words[:,None,:] & mask_words[None,:,:]).sum(axis=2, dtype=np.int64)
@@ -16,6 +16,7 @@ from itertools import product
 sys.path.append('../')
 from gauss_lattice.aux_stuff import timeit, timestamp, full_timestamp
 from gauss_lattice import GaussLatticeHamiltonian, HamiltonianBuilder, GaussLattice
+from .lambda_scheduler import parallel_lambda_scan
 
 
 @timeit(logger=None)
@@ -89,16 +90,20 @@ class GLSimulation(object):
             else:
                 ws_shifted = ws
             self.ws = GLSimulation._winding_tag(ws_shifted)
+            self.ws_index = tuple(int(w) for w in ws_shifted)
         else:
             self.ws = 'all-ws'
+            self.ws_index = None
 
 
     # --------------------------------------------------------------------------
     # Actual calculation routines.
 
     def find_states(self, *args, file=None, **kwargs):
-        """ Find the GL states with recursive algorithm (slower than with LE),
-            only recommended for smaller runs (maximally 2x2x4).
+        """ Find the GL states with the (depth-first) search of GaussLattice,
+            distributed over n_threads processes (slower than with LE). If a
+            winding sector is set, only this sector is searched and added to
+            the state file.
 
             The other use-case is to provide a file with the states.
         """
@@ -108,9 +113,16 @@ class GLSimulation(object):
             self.param['L'],
             state_file=state_file,
             filetype='hdf5',
-            basedir='/' if self.working_directory[0]=='/' else './'
+            basedir='/' if self.working_directory[0]=='/' else './',
+            winding_sector=self.ws_index,
+            append_states=self.ws_index is not None,
+            resume=self.param.get('resume', False),
+            checkpoint_interval=self.param.get('checkpoint_interval', 60)
+        )
+        glatt.find_states(
+            n_threads=self.param.get('n_threads', 1),
+            split_depth=self.param.get('split_depth')
         )
-        glatt.find_states()
 
         # Read from file again, cumbersome but this is the legacy structure.
         return self.read_states(*args, file=file, **kwargs)
@@ -125,40 +137,121 @@ class GLSimulation(object):
             **kwargs
         )
         self.store_ham = self.param.get('store_hamiltonian', False)
-        return hamiltonian_construction(builder, self.param.get('n_threads', 1))
+        return hamiltonian_construction(
+            builder,
+            self.param.get('n_threads', 1),
+            hermitian=self.param.get('hermitian_construction', False),
+            method=self.param.get('construction_method')
+        )
 
 
-    def diagonalize_hamiltonian(self, ham, lam=None):
+    def _diagonalization_kwargs(self):
+        """ Keyword arguments for the diagonalization as given by the parameters
+            (the number of eigenvalues still needs to be capped for small
+            Hamiltonians).
+        """
+        return {
+            'full_diag' : self.param.get('full_diag'),
+            'J' : self.param['J'],
+            'gauge_particles' : self.param['gauge_particles'],
+            'n_eigenvalues' : self.param['n_eigenvalues'],
+            'which' : self.param.get('ev_type', 'SA'),
+            'compute_eigenstates' : self.compute_eigenstates,
+            'solver' : self.param.get('eigensolver', 'arpack'),
+        }
+
+
+    def diagonalize_hamiltonian(self, ham, lam=None, v0=None):
         """ Diagonalizes the Hamiltonian with given parameters.
         """
+        kwargs = self._diagonalization_kwargs()
+        kwargs['n_eigenvalues'] = max(1, min(kwargs['n_eigenvalues'], ham.n_fock-1))
         return hamiltonian_diagonalization(
             ham,
-            full_diag = self.param.get('full_diag'),
-            J = self.param['J'],
             lam = lam if lam is not None else self.param['lambda'],
-            gauge_particles = self.param['gauge_particles'],
-            n_eigenvalues = max(1, min(self.param['n_eigenvalues'], ham.n_fock-1)),
-            which = self.param.get('ev_type', 'SA'),
-            compute_eigenstates = self.compute_eigenstates
+            v0 = v0,
+            **kwargs
         )
 
 
     def run_lambda_loop(self, lambdas, ham, grp_name=None):
         """ Wrapper to run multiple values of lambdas back-to-back.
+
+            If the parameter 'continuation' is set, the lambdas are processed
+            in ascending order and every diagonalization is started from the
+            eigenvectors at the previous point (the neighbouring lambda).
+
+            ham may also be a dictionary {winding sector tag : Hamiltonian}, in
+            which case all sectors are processed. With n_threads > 1, the
+            diagonalizations are distributed over processes, see
+            run_parallel_lambda_loop.
         """
-        for i, l in enumerate(lambdas):
+        if self.param.get('n_threads', 1) > 1 and (len(lambdas) > 1 or isinstance(ham, dict)):
+            return self.run_parallel_lambda_loop(lambdas, ham, grp_name=grp_name)
+
+        if isinstance(ham, dict):
+            for ws, h in ham.items():
+                self.ws = ws
+                self.run_lambda_loop(lambdas, h, grp_name=grp_name)
+            return
+
+        continuation = self.param.get('continuation', False) and not self.param.get('full_diag')
+        order = np.argsort(lambdas, kind='stable') if continuation else range(len(lambdas))
+
+        v0 = None
+        for i, k in enumerate(order):
+            l = lambdas[k]
             self.log('[{:d} / {:d}] diagonalizing Hamiltonian for lambda={:.4f}'.format(i+1, len(lambdas), l))
 
             # Diagonalization.
-            results = self.diagonalize_hamiltonian(ham, lam=l)
-            attrs = {
-                'lambda' : l
-            }
-            if not self.compute_eigenstates:
-                self.store_data(results, ds_name='spectrum_lam_{:6f}'.format(l), attrs=attrs, grp_name=grp_name)
-            else:
-                self.store_data(results[0], ds_name='spectrum_lam_{:6f}'.format(l), attrs=attrs, grp_name=grp_name)
-                self.store_data(results[1], ds_name='eigenstates_lam_{:6f}'.format(l), attrs=attrs, grp_name=grp_name)
+            results = self.diagonalize_hamiltonian(ham, lam=l, v0=v0)
+            info = ham.solver_info if hasattr(ham, 'solver_info') and not self.param.get('full_diag') else {}
+            if continuation:
+                v0 = ham.eigenstates[:,np.argsort(ham.eigenvalues)]
+            self._store_spectrum(l, results, info, grp_name=grp_name)
+
+
+    def run_parallel_lambda_loop(self, lambdas, ham, grp_name=None):
+        """ Distributes the lambdas (and the winding sectors if ham is a
+            dictionary {winding sector tag : Hamiltonian}) over n_threads
+            processes that share the Hamiltonians. The results are stored by
+            this process as they come in. The parameter 'blas_threads' sets the
+            number of BLAS threads per process (default: 1).
+        """
+        hams = ham if isinstance(ham, dict) else {self.ws : ham}
+        ws, n = self.ws, len(lambdas)*len(hams)
+        self.log(f'Distributing {n} diagonalizations over {self.param["n_threads"]} processes.')
+
+        results = parallel_lambda_scan(
+            hams, lambdas, self.param['n_threads'], self._diagonalization_kwargs(),
+            continuation = self.param.get('continuation', False) and not self.param.get('full_diag'),
+            blas_threads = self.param.get('blas_threads', 1)
+        )
+        for i, (label, l, spectrum, info) in enumerate(results):
+            self.ws = label
+            self.log('[{:d} / {:d}] diagonalized Hamiltonian {:s} for lambda={:.4f}'.format(i+1, n, label, l))
+            self._store_spectrum(l, spectrum, info, grp_name=grp_name)
+        self.ws = ws
+
+
+    def _store_spectrum(self, l, results, info, grp_name=None):
+        """ Logs the solver statistics and stores the results for one lambda.
+        """
+        attrs = {
+            'lambda' : l
+        }
+        if info:
+            attrs.update({k : v for k, v in info.items() if v is not None})
+            self.log('  {:s}: {:d} matrix-vector products{:s}'.format(
+                info['solver'], info['matvecs'],
+                '' if info['iterations'] is None else ', {:d} iterations'.format(info['iterations'])
+            ))
+
+        if not self.compute_eigenstates:
+            self.store_data(results, ds_name='spectrum_lam_{:6f}'.format(l), attrs=attrs, grp_name=grp_name)
+        else:
+            self.store_data(results[0], ds_name='spectrum_lam_{:6f}'.format(l), attrs=attrs, grp_name=grp_name)
+            self.store_data(results[1], ds_name='eigenstates_lam_{:6f}'.format(l), attrs=attrs, grp_name=grp_name)
 
 
     # --------------------------------------------------------------------------
@@ -249,16 +342,36 @@ class GLSimulation(object):
         except (OSError):
             self.log(f'Could not find file {state_file}')
             return []
+        except (KeyError):
+            self.log(f'Could not find winding sector {self.ws} in {state_file}')
+            return []
 
 
     def read_hamiltonian(self, ham_name, file=None):
-        """ Read the Hamiltonian from file.
+        """ Read the Hamiltonian from file. The CSR arrays (see
+            store_hamiltonian) are handed to the Hamiltonian as they are, files
+            in the old format (one 3xN dataset of columns, rows and data) can
+            still be read.
         """
         ham_file = self._get_hamiltonian_file(default=file)
         try:
             with hdf.File(ham_file, 'r') as f:
-                mat = f[ham_name][...]
-                ham = GaussLatticeHamiltonian(mat[2,:], mat[1,:], mat[0,:], f[ham_name].attrs['n_fock'])
+                obj = f[ham_name]
+                if isinstance(obj, hdf.Group):
+                    ham = GaussLatticeHamiltonian(
+                        obj['data'][...], None, obj['indices'][...], obj.attrs['n_fock'],
+                        half=bool(obj.attrs.get('half', False)),
+                        indptr=obj['indptr'][...],
+                        flips=obj['flips'][...]
+                    )
+                else:
+                    mat = obj[...]
+                    flips_name = ham_name + '_flips'
+                    ham = GaussLatticeHamiltonian(
+                        mat[2,:], mat[1,:], mat[0,:], obj.attrs['n_fock'],
+                        half=bool(obj.attrs.get('half', False)),
+                        flips=f[flips_name][...] if flips_name in f else None
+                    )
             self.log(f'Read Hamiltonian from {ham_file}')
             return ham
 
@@ -272,24 +385,51 @@ class GLSimulation(object):
 
 
     def store_hamiltonian(self, ham, label, file=None, grp_name=None, attrs={}):
-        """ Stores the Hamiltonian.
+        """ Stores the Hamiltonian as group of compressed CSR arrays: the row
+            pointers (int64), the column indices (int32), the data (int8 for
+            the signs of the construction) and the number of flippable
+            plaquettes per state (diagonal of the lambda term), such that it
+            does not need to be recomputed. The attributes go to the group.
         """
         ham_file = file if file else self._get_hamiltonian_file()
         self.log(f'Storing Hamiltonian in {ham_file}')
 
-        self.store_data(
-            np.array([ham.col, ham.row, ham.data]),
-            label,
-            grp_name=grp_name,
-            attrs=attrs,
-            file=ham_file
-        )
+        name = label if not grp_name else grp_name + '/' + label
+        with hdf.File(ham_file, 'a') as f:
+            # Replace whatever is stored under this label (also in the old
+            # format, with the flips in a separate dataset).
+            for old in [name, name + '_flips']:
+                if old in f:
+                    del f[old]
+
+        indptr, indices, data = ham.csr_arrays()
+        if np.isrealobj(data) and np.array_equal(data, data.astype(np.int8)):
+            data = data.astype(np.int8)
+        arrays = {
+            'indptr' : indptr.astype(np.int64),
+            'indices' : indices.astype(np.int32),
+            'data' : data,
+            'flips' : ham.flip_counts(),
+        }
+        for ds_name, a in arrays.items():
+            self.store_data(a, ds_name, grp_name=name, file=ham_file, compression='gzip')
+
+        all_attrs = copy(attrs)
+        all_attrs['half'] = ham.half
+        all_attrs['format'] = 'csr'
+        with hdf.File(ham_file, 'a') as f:
+            for k, v in all_attrs.items():
+                f[name].attrs[k] = v
 
 
-    def store_data(self, data, ds_name, grp_name=None, attrs={}, file=None):
+    def store_data(self, data, ds_name, grp_name=None, attrs={}, file=None, compression=None):
         """ Stores the results in standardized fashion. This should be the only
             place where any output is generated - it allows for a coherent
             tagging of the results/output produced.
+
+            With compression (e.g. 'gzip'), the dataset is chunked and
+            compressed (with the shuffle filter, which groups the bytes of the
+            numbers and helps with integer arrays).
         """
         filename = file if file else self._get_result_file(default=file)
 
@@ -298,6 +438,11 @@ class GLSimulation(object):
         all_attrs['host'] = self.host
         all_attrs['version'] = self.version
 
+        data = np.asarray(data)
+        options = {}
+        if compression and data.size:
+            options = {'chunks' : True, 'compression' : compression, 'shuffle' : True}
+
         with hdf.File(filename, 'a') as f:
             ds = None
 
@@ -306,11 +451,11 @@ class GLSimulation(object):
                 grp = f[grp_name] if grp_name in f else f.create_group(grp_name)
                 if ds_name in grp:
                     del grp[ds_name]
-                ds = grp.create_dataset(ds_name, data=data)
+                ds = grp.create_dataset(ds_name, data=data, **options)
             else:
                 if ds_name in f:
                     del f[ds_name]
-                ds = f.create_dataset(ds_name, data=data)
+                ds = f.create_dataset(ds_name, data=data, **options)
 
             # Finally, store attributes.
             for k, v in all_attrs.items():
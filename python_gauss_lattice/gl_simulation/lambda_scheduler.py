@@ -0,0 +1,117 @@
+""" ----------------------------------------------------------------------------
+
+    lambda_scheduler.py - LR, December 2020
+
+    Distributes the diagonalizations of a parameter scan (lambda values and
+    winding sectors) over a process pool. The CSR structure of every
+    Hamiltonian is put into shared memory once, the workers only receive
+    labels and lambda values and send back the spectra. All output is written
+    by the main process, which is hence the only one touching the HDF5 files.
+
+    Every worker limits its BLAS to blas_threads threads (via threadpoolctl if
+    it is installed, otherwise through the environment), such that n_threads
+    workers don't oversubscribe the cores.
+
+---------------------------------------------------------------------------- """
+import os, sys
+import numpy as np
+from multiprocessing import Pool
+
+sys.path.append('../')
+from gauss_lattice import GaussLatticeHamiltonian
+from gauss_lattice.shared_tables import SharedArrays, attach
+
+try:
+    from threadpoolctl import threadpool_limits
+except ImportError:
+    threadpool_limits = None
+
+
+_TERMS = ['indices', 'indptr', 'off_data', 'diag_data']
+_BLAS_VARIABLES = ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS']
+
+
+def limit_blas_threads(n):
+    """ Restricts the number of BLAS threads of the current process. The
+        environment only takes effect for libraries that are not loaded yet,
+        hence threadpoolctl is preferred.
+    """
+    for v in _BLAS_VARIABLES:
+        os.environ[v] = str(n)
+    if threadpool_limits is not None:
+        return threadpool_limits(limits=n)
+
+
+def lambda_segments(lambdas, n_segments):
+    """ Splits the lambdas into (at most) n_segments contiguous pieces of the
+        sorted grid, such that a continuation within a segment always starts
+        from a neighbouring point.
+    """
+    return [list(s) for s in np.array_split(np.sort(lambdas), n_segments) if len(s)]
+
+
+# ------------------------------------------------------------------------------
+# Worker side.
+
+_worker = {}
+
+def _init_worker(spec, n_fock, kwargs, blas_threads):
+    _worker['limits'] = limit_blas_threads(blas_threads)
+    arrays, blocks = attach(spec)
+    _worker['blocks'] = blocks
+    _worker['kwargs'] = kwargs
+    _worker['hamiltonians'] = {
+        label : GaussLatticeHamiltonian.from_csr_terms(
+            [arrays[f'{label}/{t}'] for t in _TERMS], n, kwargs['gauge_particles']
+        ) for label, n in n_fock.items()
+    }
+
+
+def _diagonalize_segment(task):
+    """ Diagonalizes one Hamiltonian for a segment of lambdas, with a warm
+        start from the previous point if continuation is set.
+    """
+    label, lambdas, continuation = task
+    ham = _worker['hamiltonians'][label]
+    kwargs = dict(_worker['kwargs'])
+    kwargs['n_eigenvalues'] = max(1, min(kwargs['n_eigenvalues'], ham.n_fock-1))
+
+    results, v0 = [], None
+    for l in lambdas:
+        spectrum = ham.diagonalize(lam=l, v0=v0, **kwargs)
+        info = dict(ham.solver_info) if hasattr(ham, 'solver_info') and not kwargs.get('full_diag') else {}
+        if continuation:
+            v0 = ham.eigenstates[:,np.argsort(ham.eigenvalues)]
+        results.append((label, l, spectrum, info))
+    return results
+
+
+# ------------------------------------------------------------------------------
+# Driver side.
+
+def parallel_lambda_scan(hamiltonians, lambdas, n_threads, kwargs, continuation=False, blas_threads=1):
+    """ Generator over the results (label, lambda, spectrum, solver_info) of
+        all diagonalizations, in the order in which they finish.
+
+            hamiltonians    dictionary {label : GaussLatticeHamiltonian},
+            kwargs          keyword arguments for diagonalize (without lam).
+
+        Without continuation, every lambda is a task of its own. Otherwise the
+        sorted grid is cut into as many segments as needed to keep all
+        processes busy.
+    """
+    gauge_particles = kwargs['gauge_particles']
+    arrays, n_fock = {}, {}
+    for label, ham in hamiltonians.items():
+        for t, a in zip(_TERMS, ham.csr_terms(gauge_particles)):
+            arrays[f'{label}/{t}'] = a
+        n_fock[label] = ham.n_fock
+
+    n_segments = -(-n_threads // len(hamiltonians)) if continuation else len(lambdas)
+    tasks = [(label, s, continuation) for label in hamiltonians for s in lambda_segments(lambdas, n_segments)]
+
+    with SharedArrays(arrays) as shared:
+        initargs = (shared.spec, n_fock, kwargs, blas_threads)
+        with Pool(min(n_threads, len(tasks)), initializer=_init_worker, initargs=initargs) as pool:
+            for results in pool.imap_unordered(_diagonalize_segment, tasks):
+                yield from results
@@ -54,7 +54,8 @@ states = le_finding(
     base_lattices[tuple(param['L'])],
     n_threads=param["n_threads"],
     output_file=param['working_directory'] + "/le_states_" + size_tag(param['L']) + '.hdf5',
-    max_level=param['maximum_excitation_level']
+    max_level=param['maximum_excitation_level'],
+    run_file=param['working_directory'] + "/le_runs_" + size_tag(param['L']) + '.hdf5' if param.get('external_memory') else None
 )
 
 # if param["L"] == [2,2,2]:
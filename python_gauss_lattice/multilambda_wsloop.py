@@ -17,11 +17,12 @@ import numpy as np
 
 
 sim = GLSimulation()
+hams = {}
 for ws in GLSimulation.winding_sectors(sim.param['L']):
     sim.set_winding_sector(ws, shift=True)
 
     sim.log('-------------------------------------------')
-    sim.log(f'Running ws {ws}')
+    sim.log(f'Setting up ws {ws}')
 
     ham = sim.read_hamiltonian(ham_name=sim.ws)
     if not ham:
@@ -34,7 +35,10 @@ for ws in GLSimulation.winding_sectors(sim.param['L']):
         ham = sim.construct_hamiltonian(states, builder_type=ParallelHamiltonianBuilder)
         if sim.store_ham:
             sim.store_hamiltonian(ham, label=sim.ws, attrs={'n_fock':len(states)})
-
-    lambdas = np.linspace(*sim.param['lambdas']) if 'lambdas' in sim.param else [sim.param['lambda']]
-    sim.run_lambda_loop(lambdas, ham)
+    hams[sim.ws] = ham
     sim.log('-------------------------------------------')
+
+# All sectors and lambdas at once, such that they can be distributed over the
+# processes (n_threads).
+lambdas = np.linspace(*sim.param['lambdas']) if 'lambdas' in sim.param else [sim.param['lambda']]
+sim.run_lambda_loop(lambdas, hams)
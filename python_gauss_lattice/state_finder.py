@@ -37,17 +37,24 @@ args = parser.parse_args()
 param = load_config(args.i)
 
 # Create a GaussLattice with appropriate parameters & stores the states..
-state_file = file_tag(param['L'], filetype='hdf5')
+# When only counting, there is no state file.
+count_only = param.get('count_only', False)
+state_file = None if count_only else file_tag(param['L'], filetype='hdf5')
 glatt = GaussLattice(
     L=param['L'],
     static_charges=param.get('static_charges', [[],[]]),
     state_file=state_file,
     basedir=param['working_directory'],
-    append_states=param.get('append_states', False)
+    append_states=param.get('append_states', False),
+    resume=param.get('resume', False),
+    checkpoint_interval=param.get('checkpoint_interval', 60)
 )
 
-# Constructs the states & times the execution.
-wn = wrap_state_finder(glatt)
+# Constructs the states & times the execution (or only counts them).
+if count_only:
+    wn = timeit(logger=None)(glatt.count_states)()
+else:
+    wn = wrap_state_finder(glatt, n_threads=param.get('n_threads', 1), split_depth=param.get('split_depth'))
 
 print(f"Found {wn.sum()} states in total.")
 print(f"Found {wn.max()} states in the largest winding sector.")
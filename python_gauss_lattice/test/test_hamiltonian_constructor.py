@@ -5,10 +5,34 @@
     Some sanity checks for the Hamiltonian constructor.
 
 ---------------------------------------------------------------------------- """
-from gauss_lattice import HamiltonianBuilder
+from gauss_lattice import HamiltonianBuilder, ParallelHamiltonianBuilder, GaussLattice, LowEnergyStateFinder
+from gauss_lattice.aux_stuff import read_all_states
 from gauss_lattice.bit_magic import set_bits
-from gauss_lattice.hamiltonian_builder_methods import apply_u, apply_u_dagger
+from gauss_lattice.hamiltonian_builder_methods import apply_u, apply_u_dagger, cycle_plaquettes, do_single_state
+from gauss_lattice import jit_kernels, le_state_finder
+from gauss_lattice.plaquette_kernels import state_words, words_to_states, plaquette_masks
+from gauss_lattice.frontier_search import frontier_levels, read_runs
+from gauss_lattice.translations import translation_tables, translate
+from gauss_lattice.symmetry_ops import SymmetryOps
+from gauss_lattice.winding import sector_of
 import numpy as np
+import h5py as hdf
+import pytest
+from itertools import product
+
+
+def find_states(L, basedir):
+    """ Runs the state finder and returns all Gauss law states.
+    """
+    glatt = GaussLattice(L, state_file='states.hdf5', basedir=str(basedir))
+    glatt.find_states()
+    return read_all_states(L, filename=glatt.state_file)
+
+
+def coo_entries(ham):
+    """ Set of (row, col, value) triplets of a Hamiltonian.
+    """
+    return set(zip(ham.row.tolist(), ham.col.tolist(), ham.data.tolist()))
 
 
 def test_hamiltonian_builder_index_shift_2D():
@@ -242,3 +266,359 @@ def test_u_dagger_operator():
     p_ind = [19, 14, 7, 20]
     constructed, _ = apply_u_dagger(state, p_ind + [set_bits(p_ind)])
     assert expected == constructed
+
+
+
+def test_vectorized_construction(tmp_path):
+    """ The vectorized construction must reproduce the state-by-state loop,
+        including the fermionic signs.
+    """
+    for L in [[4,2], [4,4], [2,2,2]]:
+        states = find_states(L, tmp_path)
+        builder = HamiltonianBuilder({'L' : L}, states=states, silent=True)
+
+        expected = coo_entries(builder.construct(method='python'))
+        assert len(expected)
+        assert expected == coo_entries(builder.construct(method='vectorized', chunk_size=100))
+        assert expected == coo_entries(builder.construct(method='vectorized', n_threads=2, chunk_size=100))
+        assert expected == coo_entries(builder.construct(method='jit'))
+        assert expected == coo_entries(builder.construct(method='jit', n_threads=2, chunk_size=100))
+
+
+def test_vectorized_construction_big_int():
+    """ Lattices with more than 64 links are stored in two words.
+    """
+    L = [2,2,6]
+    seeds = [
+        1074260571646206819420, 1089901011134353970538, 1526095490192680073940,
+        1598215294499136381873, 2123163061129091160270, 2179642425947400317085,
+    ]
+    builder = HamiltonianBuilder({'L' : L}, states=[], silent=True)
+    states = set(seeds)
+    for s in seeds:
+        states |= cycle_plaquettes((s, builder.plaquettes))
+
+    builder = HamiltonianBuilder({'L' : L}, states=list(states), silent=True)
+    assert builder.n_words == 2
+    assert words_to_states(state_words(builder.lookup_table, 2)) == builder.lookup_table
+
+    expected = coo_entries(builder.construct(method='python'))
+    assert len(expected)
+    assert expected == coo_entries(builder.construct())
+
+
+def test_jit_single_state(tmp_path):
+    """ The compiled single-state routine must agree with the Python version.
+    """
+    states = find_states([2,2,2], tmp_path)
+    builder = HamiltonianBuilder({'L' : [2,2,2]}, states=states, silent=True)
+    links = jit_kernels.plaquette_links(builder.plaquettes)
+    for state in states[::50]:
+        expected = [tuple(e[1:]) for e in do_single_state((int(state), builder.plaquettes))]
+        new_states, signs = jit_kernels.do_single_state(np.uint64(state), links)
+        assert expected == list(zip(map(int, new_states), map(int, signs)))
+
+
+def test_jit_before_pool(tmp_path):
+    """ A pool must still work (and terminate) after the compiled construction
+        ran in the same process.
+    """
+    states = find_states([4,2], tmp_path)
+    builder = ParallelHamiltonianBuilder({'L' : [4,2]}, states=states, silent=True)
+    expected = coo_entries(builder.construct())
+    assert expected == coo_entries(builder.construct(method='vectorized', n_threads=2))
+    assert expected == coo_entries(builder.construct(method='python', n_threads=2))
+
+
+def test_low_energy_cycle_jit():
+    """ The low-energy search must find the same states with the compiled
+        plaquette cycling as with the Python version, serially and in a pool.
+    """
+    seeds = [3816540, 3872106, 5421780, 5678001, 7542990, 7743645,
+                9033570, 9234225, 11099214, 11355435, 12905109, 12960675]
+    finder = LowEnergyStateFinder({'L' : [2,2,2]}, silent=True)
+    assert not finder.big_int
+
+    for s in seeds:
+        expected = cycle_plaquettes((s, finder.plaquettes))
+        assert expected == le_state_finder._cycle_plaquettes_jit((s, jit_kernels.plaquette_links(finder.plaquettes)))
+
+    states = finder.find_all_states(seeds, max_level=3)
+    assert states == finder.find_all_states(seeds, n_threads=2, max_level=3)
+
+    finder.big_int = True
+    assert states == finder.find_all_states(seeds, max_level=3)
+
+
+def test_frontier_search(tmp_path):
+    """ The iterative low-energy search must reproduce the level-by-level set
+        based search, also for states of two words, with many small chunks
+        and in a pool.
+    """
+    seeds = [1074260571646206819420, 1089901011134353970538,  1526095490192680073940, 1598215294499136381873,
+                2123163061129091160270, 2179642425947400317085, 2542724056922244896610, 2599203421740554053425,
+                3124151188370508831822, 3196270992676965139755, 3632465471735291243157, 3648105911223438394275]
+    finder = LowEnergyStateFinder({'L' : [2,2,6]}, silent=True)
+    assert finder.n_words == 2
+
+    frontier, visited, levels = set(seeds), set(seeds), [sorted(seeds)]
+    for _ in range(3):
+        frontier = set().union(*[cycle_plaquettes((s, finder.plaquettes)) for s in frontier]) - visited
+        visited |= frontier
+        levels.append(sorted(frontier))
+
+    output_file = str(tmp_path / 'le_states.hdf5')
+    assert visited == finder.find_all_states(seeds, output_file=output_file, max_level=3, chunk_size=7)
+    assert finder.state_index.nbytes == 16*len(visited)
+    assert visited == finder.find_all_states(seeds, n_threads=2, max_level=3, chunk_size=50)
+
+    with hdf.File(output_file, 'r') as f:
+        for level, states in enumerate(levels):
+            data = f['states_lv_{:d}'.format(level)][()]
+            assert [(int(hi) << 63) + int(lo) for hi, lo in data] == states
+
+
+def test_external_frontier_search(tmp_path):
+    """ With the visited states on disk (streamed in small blocks), the
+        search must find the same levels as in memory.
+    """
+    seeds = [3816540, 3872106, 5421780, 5678001, 7542990, 7743645,
+                9033570, 9234225, 11099214, 11355435, 12905109, 12960675]
+    finder = LowEnergyStateFinder({'L' : [2,2,2]}, silent=True)
+    masks = plaquette_masks(finder.plaquettes, finder.n_words)
+
+    expected = [(level, frontier.tolist()) for level, frontier, _ in frontier_levels(seeds, masks, 1)]
+    run_file = str(tmp_path / 'runs.hdf5')
+    levels = frontier_levels(seeds, masks, 1, chunk_size=10, run_file=run_file, block_size=16)
+    assert expected == [(level, frontier.tolist()) for level, frontier, _ in levels]
+
+    states = finder.find_all_states(seeds)
+    assert finder.find_all_states(seeds, run_file=run_file) is None
+    assert finder.n_fock == len(states)
+    assert read_runs(run_file).tolist() == sorted(states)
+
+
+def test_translations():
+    """ The bit-level translations must move every link to the translated site
+        and produce the parity of the reordering of the occupied links.
+    """
+    for L in [[4,2], [3,4], [2,2,6]]:
+        builder = HamiltonianBuilder({'L' : L}, states=[], silent=True)
+        states = [int.from_bytes(np.random.bytes(16), 'little') % 2**builder.nb for _ in range(50)]
+        tables = translation_tables(L)
+        for a in range(len(L)):
+            perm = [builder.d*builder.shift_index(k // builder.d, a) + k % builder.d for k in range(builder.nb)]
+            words, parity = translate(state_words(states, builder.n_words), tables[a])
+            for s, t, p in zip(states, words_to_states(words), parity):
+                occupied = [perm[k] for k in range(builder.nb) if (s >> k) & 1]
+                inversions = sum(1 for i in range(len(occupied)) for j in range(i) if occupied[j] > occupied[i])
+                assert t == sum(1 << k for k in occupied)
+                assert p == inversions % 2
+
+
+def test_momentum_sectors(tmp_path):
+    """ The spectra of all momentum sectors together must reproduce the
+        spectrum of a winding sector, for fermions and bosons.
+    """
+    for L in [[4,2], [2,2,2]]:
+        states = find_states(L, tmp_path)
+        sectors = sector_of(states, L)
+        states = [s for s, w in zip(states, sectors) if (w == sectors[0]).all()]
+        builder = HamiltonianBuilder({'L' : L}, states=states, silent=True)
+
+        for gauge_particles in ['fermions', 'bosons']:
+            ham = builder.construct().matrix(lam=0.3, gauge_particles=gauge_particles)
+            expected = np.linalg.eigvalsh(ham.toarray())
+
+            spectrum = []
+            for h in builder.construct_momentum_sectors(gauge_particles).values():
+                ham = h.matrix(lam=0.3, gauge_particles=gauge_particles).toarray()
+                assert np.allclose(ham, ham.conj().T)
+                spectrum += list(np.linalg.eigvalsh(ham))
+            assert np.allclose(sorted(spectrum), expected)
+
+
+def test_symmetric_sectors(tmp_path):
+    """ The spectra of the irreducible representations of point group and
+        charge conjugation operations must reproduce the spectrum of the
+        central winding sector. Operations that don't commute with the
+        (fermionic) plaquette term are rejected.
+    """
+    L = [4,4]
+    states = find_states(L, tmp_path)
+    states = [s for s, w in zip(states, sector_of(states, L)) if (w == [2,2]).all()]
+    builder = HamiltonianBuilder({'L' : L}, states=states, silent=True)
+
+    cases = [('fermions', ['parity', 'charge_conjugation']), ('bosons', ['c4_z', 'charge_conjugation'])]
+    for gauge_particles, operations in cases:
+        expected = np.linalg.eigvalsh(builder.construct().matrix(lam=0.3, gauge_particles=gauge_particles).toarray())
+        spectrum = []
+        for h in builder.construct_symmetric_sectors(operations, gauge_particles).values():
+            spectrum += list(np.linalg.eigvalsh(h.matrix(lam=0.3, gauge_particles=gauge_particles).toarray()))
+        assert np.allclose(sorted(spectrum), expected)
+
+    with pytest.raises(ValueError):
+        builder.construct_symmetric(['mirror_x'], (0,))
+
+
+def test_symmetry_ops(tmp_path):
+    """ The bulk symmetry operations must reproduce the translations and the
+        charge conjugation of the vertex representation, and the orbits must
+        be consistent with the elements that map onto the representatives.
+    """
+    # Charge conjugated pairs of 2x2x2 states (from db_state_storage).
+    states = [3816540, 3872106, 5421780, 5678001, 7542990, 7743645, 9033570, 9234225, 11099214, 11355435, 12905109, 12960675]
+    ops = SymmetryOps([2,2,2])
+    conjugated, _ = ops.apply(states, ops.compile('charge_conjugation'))
+    assert conjugated == states[::-1]
+
+    for L in [[4,2], [2,2,2]]:
+        states = find_states(L, tmp_path)
+        for fermions in [True, False]:
+            ops = SymmetryOps(L, fermions=fermions)
+            words = state_words(states, ops.n_words)
+            for a, table in enumerate(translation_tables(L)):
+                expected = translate(words, table, fermions)
+                constructed = ops.apply(words, ops.compile('translation_' + 'xyz'[a]))
+                assert np.all(expected[0] == constructed[0]) and np.all(expected[1] == constructed[1])
+
+            names = ['translation_x', 'translation_y', 'mirror_x', 'charge_conjugation']
+            group = ops.group(names)
+            reps, elements, parity = ops.orbits(words, group)
+            for k in range(len(words)):
+                image, p = ops.apply(words[k:k+1], group[elements[k]])
+                assert np.all(image == reps[k]) and p[0] == parity[k]
+
+            # Every orbit consists of the Gauss law states with the same
+            # representative.
+            reps = words_to_states(reps)
+            counts = {r : reps.count(r) for r in set(reps)}
+            assert all(counts[r] == n for r, n in zip(reps, ops.orbit_sizes(words, group)))
+
+
+def test_matrix_free(tmp_path):
+    """ The matrix-free products must agree with the stored matrix, also in
+        the diagonalization on several processes.
+    """
+    L = [4,4]
+    builder = HamiltonianBuilder({'L' : L}, states=find_states(L, tmp_path), silent=True)
+    ham = builder.construct()
+    operator = builder.construct(method='matrix_free', chunk_size=100)
+    x = np.random.rand(builder.n_fock, 3)
+    for gauge_particles in ['fermions', 'bosons']:
+        matrix = ham.matrix(J=-1, lam=0.7, gauge_particles=gauge_particles)
+        assert np.allclose(operator.operator(J=-1, lam=0.7, gauge_particles=gauge_particles) @ x, matrix @ x)
+        assert np.allclose(operator.operator(J=-1, lam=0.7, gauge_particles=gauge_particles) @ (1j*x[:,0]), matrix @ (1j*x[:,0]))
+
+        expected = ham.diagonalize(J=-1, lam=0.7, gauge_particles=gauge_particles, n_eigenvalues=4, which='SA')
+        for n_threads in [1, 2]:
+            operator.n_threads = n_threads
+            spectrum = operator.diagonalize(J=-1, lam=0.7, gauge_particles=gauge_particles, n_eigenvalues=4, which='SA')
+            assert np.allclose(spectrum, expected)
+    assert np.all(operator.flip_counts() == ham.flip_counts())
+
+    with pytest.raises(ValueError):
+        operator.diagonalize(full_diag=True)
+
+
+def test_state_index():
+    """ The bisection-based inverse lookup, for one and for two words.
+    """
+    for L in [[2,2,2], [2,2,6]]:
+        builder = HamiltonianBuilder({'L' : L}, states=[], silent=True)
+        states = sorted(set(int(s) for s in np.random.randint(1, 2**62, size=200, dtype=np.int64)))
+        if builder.n_words > 1:
+            states = [s << 8 for s in states]
+
+        builder = HamiltonianBuilder({'L' : L}, states=states[::-1], silent=True)
+        assert builder.lookup_table == states
+        assert builder.state_index.nbytes == 8*builder.n_words*len(states)
+        for n in [0, 17, len(states)-1]:
+            assert builder.index_to_state(n) == states[n]
+            assert builder.state_to_index(states[n]) == n
+        assert builder.state_to_index(states[0]+1) is None
+
+        queries = states[::3] + [states[0]+1, 0]
+        expected = list(range(0, len(states), 3)) + [-1, -1]
+        assert expected == builder.states_to_indices(queries).tolist()
+
+
+def test_shared_arrays():
+    """ Arrays placed into shared memory can be attached to by name, and the
+        parallel builder yields the same matrix for two-word states.
+    """
+    from gauss_lattice.shared_tables import SharedArrays, attach
+    arrays = {'a' : np.arange(10, dtype=np.uint64), 'b' : np.ones((3,4), dtype=np.int8)}
+    with SharedArrays(arrays) as shared:
+        attached, blocks = attach(shared.spec)
+        for name in arrays:
+            assert np.array_equal(attached[name], arrays[name])
+        del attached
+        for shm in blocks:
+            shm.close()
+
+    builder = HamiltonianBuilder({'L' : [2,2,6]}, states=[], silent=True)
+    seeds = [int(s) << 20 for s in np.random.randint(1, 2**40, size=50, dtype=np.int64)]
+    states = set(seeds)
+    for s in seeds:
+        states |= cycle_plaquettes((s, builder.plaquettes))
+    builder = ParallelHamiltonianBuilder({'L' : [2,2,6]}, states=list(states), silent=True)
+    ref = coo_entries(builder.construct(method='vectorized'))
+    assert ref == coo_entries(builder.construct(n_threads=2, chunk_size=64))
+
+
+def test_coo_accumulator(tmp_path):
+    """ Streaming the chunks into growable arrays or spilling them to disk must
+        give the same entries.
+    """
+    from gauss_lattice.coo_accumulator import COOAccumulator
+    acc = COOAccumulator(100, capacity=4)
+    acc.extend([(np.arange(k), np.arange(k)[::-1], np.ones(k)) for k in range(10)])
+    row, col, data = acc.finalize()
+    assert len(row) == 45 and row.dtype == np.int32 and data.dtype == np.int8
+    assert row[:6].tolist() == [0, 0, 1, 0, 1, 2]
+    assert col[:6].tolist() == [0, 1, 0, 2, 1, 0]
+
+    builder = HamiltonianBuilder({'L' : [4,4]}, states=find_states([4,4], tmp_path), silent=True)
+    expected = coo_entries(builder.construct())
+    for method, n_threads in product(['jit', 'vectorized'], [1, 2]):
+        spill_dir = tmp_path / f'{method}_{n_threads}'
+        ham = builder.construct(method=method, n_threads=n_threads, chunk_size=500, spill_dir=spill_dir)
+        assert (spill_dir / 'coo_col.bin').stat().st_size == 4*len(expected)
+        assert expected == coo_entries(ham)
+
+
+def test_hermitian_construction(tmp_path):
+    """ Only applying U+ gives half of the entries, mirroring them must yield
+        the full matrix.
+    """
+    for L in [[4,2], [2,2,2]]:
+        builder = HamiltonianBuilder({'L' : L}, states=find_states(L, tmp_path / 'x'.join(map(str, L))), silent=True)
+        full = builder.construct(method='python')
+        expected = coo_entries(full)
+        for method, n_threads in [('python', 1), ('jit', 1), ('jit', 2), ('vectorized', 1), ('vectorized', 2)]:
+            ham = builder.construct(method=method, n_threads=n_threads, chunk_size=100, hermitian=True)
+            assert ham.half and 2*len(ham.data) == len(expected)
+            data, (row, col) = ham.full_entries()
+            assert expected == set(zip(row.tolist(), col.tolist(), data.tolist()))
+
+        for gauge_particles in ['fermions', 'bosons']:
+            diff = full.matrix(-1, 0.5, gauge_particles) - ham.matrix(-1, 0.5, gauge_particles)
+            assert abs(diff).max() == 0
+
+
+def test_cached_csr_matrix(tmp_path):
+    """ The linear combination of the cached terms must match the explicitly
+        assembled matrix for all parameters.
+    """
+    from scipy.sparse import coo_matrix
+    builder = HamiltonianBuilder({'L' : [4,4]}, states=find_states([4,4], tmp_path), silent=True)
+    for ham in [builder.construct(), builder.construct(hermitian=True)]:
+        data, (row, col) = ham.full_entries()
+        diag = np.bincount(row, minlength=ham.n_fock)
+        for gauge_particles, J, lam in product(['fermions', 'bosons'], [1, -0.5], [0, 1.5]):
+            values = np.abs(data) if gauge_particles == 'bosons' else data
+            expected = coo_matrix((J*values.astype(float), (row, col)), shape=(ham.n_fock, ham.n_fock)).toarray()
+            expected += np.diag(lam*diag)
+            assert np.allclose(ham.matrix(J, lam, gauge_particles).toarray(), expected)
+        assert len(ham._csr_cache) == 2
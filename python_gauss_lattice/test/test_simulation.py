@@ -0,0 +1,133 @@
+""" ----------------------------------------------------------------------------
+
+    test_simulation.py - LR, December 2020
+
+    Some sanity checks for the simulation object (I/O and parameter loops).
+
+---------------------------------------------------------------------------- """
+from gauss_lattice import HamiltonianBuilder, GaussLattice
+from gauss_lattice.aux_stuff import read_all_states
+from gl_simulation import GLSimulation
+import logging, os
+import h5py as hdf
+import numpy as np
+
+
+def make_simulation(tmp_path, **param):
+    """ Sets up a simulation object without going through the command line.
+    """
+    sim = GLSimulation.__new__(GLSimulation)
+    sim.param = dict({'L' : [4,4], 'J' : -1, 'lambda' : 0, 'gauge_particles' : 'fermions', 'n_eigenvalues' : 3}, **param)
+    sim.working_directory = str(tmp_path)
+    os.makedirs(sim.working_directory, exist_ok=True)
+    sim.logger = logging.getLogger('test logger')
+    sim.host, sim.version = 'test', 'test'
+    sim.compute_eigenstates = False
+    sim.set_winding_sector(None)
+    return sim
+
+
+def find_states(L, basedir):
+    """ Runs the state finder and returns all Gauss law states.
+    """
+    glatt = GaussLattice(L, state_file='states.hdf5', basedir=str(basedir))
+    glatt.find_states()
+    return read_all_states(L, filename=glatt.state_file)
+
+
+def test_hamiltonian_io(tmp_path):
+    """ The flip counts (and the storage mode) are stored along with the
+        Hamiltonian, which is read back in CSR form. Files in the old format
+        can still be read.
+    """
+    sim = make_simulation(tmp_path, hamiltonian_file=str(tmp_path / 'ham.hdf5'))
+    states = find_states([4,4], tmp_path)
+    for hermitian in [False, True]:
+        ham = HamiltonianBuilder(sim.param, states=states, silent=True).construct(hermitian=hermitian)
+        flips = ham.flip_counts().copy()
+        assert flips.sum() == 17536
+        expected = ham.matrix(lam=0.5).toarray()
+
+        sim.store_hamiltonian(ham, label=sim.ws, attrs={'n_fock' : len(states)})
+        with hdf.File(sim.param['hamiltonian_file'], 'r') as f:
+            assert f[sim.ws]['data'].dtype == np.int8
+            assert f[sim.ws]['indices'].dtype == np.int32
+            assert f[sim.ws]['indptr'].compression == 'gzip'
+
+        ham = sim.read_hamiltonian(sim.ws)
+        assert ham.half == hermitian
+        assert ham.indptr is not None
+        assert np.array_equal(ham.flips, flips)
+        assert np.array_equal(ham.matrix(lam=0.5).toarray(), expected)
+
+    # Old format: one dataset (columns, rows, data) and the flips.
+    sim.store_data(np.array([ham.col, ham.row, ham.data]), 'old', attrs={'n_fock' : len(states), 'half' : True}, file=sim.param['hamiltonian_file'])
+    ham = sim.read_hamiltonian('old')
+    assert ham.indptr is None
+    assert np.array_equal(ham.matrix(lam=0.5).toarray(), expected)
+
+
+def test_lambda_continuation(tmp_path):
+    """ Warm-started lambda scans must give the same ground state energies as
+        independent diagonalizations, and need fewer matrix-vector products.
+    """
+    states = find_states([4,4], tmp_path)
+    ham = HamiltonianBuilder({'L' : [4,4]}, states=states, silent=True).construct()
+    lambdas = [0.5, -1.0, -0.5, 0.0, -1.5]
+
+    spectra, matvecs = {}, {}
+    for continuation, solver in [(False, 'arpack'), (True, 'arpack'), (True, 'lobpcg')]:
+        result_file = str(tmp_path / f'results_{continuation}_{solver}.hdf5')
+        sim = make_simulation(tmp_path, continuation=continuation, eigensolver=solver, result_file=result_file)
+        sim.run_lambda_loop(lambdas, ham)
+        with hdf.File(result_file, 'r') as f:
+            spectra[solver, continuation] = [f['spectrum_lam_{:6f}'.format(l)][0] for l in lambdas]
+            matvecs[solver, continuation] = sum(f['spectrum_lam_{:6f}'.format(l)].attrs['matvecs'] for l in lambdas)
+
+    reference = spectra['arpack', False]
+    for key in spectra:
+        assert np.allclose(spectra[key], reference, atol=1e-6)
+    assert matvecs['lobpcg', True] < matvecs['arpack', False]
+
+
+def test_parallel_lambda_loop(tmp_path):
+    """ Distributing lambdas and sectors over processes gives the same results
+        as the serial loop, stored in the files of the respective sectors.
+    """
+    states = find_states([4,4], tmp_path)
+    ham = HamiltonianBuilder({'L' : [4,4]}, states=states, silent=True).construct()
+    hams = {'ws_a' : ham, 'ws_b' : HamiltonianBuilder({'L' : [4,4]}, states=states[:1000], silent=True).construct()}
+    lambdas = [-1.0, 0.0, -0.5, 0.5]
+
+    spectra = {}
+    for n_threads, continuation in [(1, False), (2, False), (3, True)]:
+        sim = make_simulation(tmp_path / f'{n_threads}', n_threads=n_threads, continuation=continuation, eigensolver='lobpcg')
+        sim.run_lambda_loop(lambdas, hams)
+        for ws in hams:
+            sim.ws = ws
+            with hdf.File(sim._get_result_file(), 'r') as f:
+                spectra[n_threads, ws] = [f['spectrum_lam_{:6f}'.format(l)][0] for l in lambdas]
+
+    for ws in hams:
+        assert np.allclose(spectra[2, ws], spectra[1, ws], atol=1e-6)
+        assert np.allclose(spectra[3, ws], spectra[1, ws], atol=1e-6)
+
+
+def test_single_sector_states(tmp_path):
+    """ With a winding sector set, only this sector is searched and added to
+        the state file, next to the sectors that are already there.
+    """
+    glatt = GaussLattice([4,4], state_file='states.hdf5', basedir=str(tmp_path))
+    glatt.find_states()
+    reference = dict(read_all_states([4,4], merged=False, filename=glatt.state_file))
+
+    sim = make_simulation(tmp_path / 'sectors')
+    for ws in [(0,0), (1,-1)]:
+        sim.set_winding_sector(ws)
+        assert not len(sim.read_states())
+        states = sim.find_states()
+        assert sorted(states) == sorted(reference[sim.ws])
+
+    with hdf.File(sim._get_state_file(), 'r') as f:
+        assert sorted(f) == sorted(['wx_2-wy_2', 'wx_3-wy_1'])
+        assert sorted(f['wx_2-wy_2'][...]) == sorted(reference['wx_2-wy_2'])
@@ -6,7 +6,10 @@
 
 ---------------------------------------------------------------------------- """
 from gauss_lattice import GaussLattice
+from gauss_lattice.aux_stuff import read_all_states, winding_tag
+from gauss_lattice.plaquette_kernels import n_words, state_words
 import numpy as np
+from itertools import product
 
 
 def test_winding_links_2D():
@@ -50,3 +53,178 @@ def check_winding_bins():
 
     glatt = GaussLattice(L=[2,6])
     assert glatt.winding_bins.shape == (13,5)
+
+
+def test_parallel_search(tmp_path):
+    """ The iterative search and its parallel version (for different split
+        depths) find the same states with the same winding histograms.
+    """
+    for L, n_states in [([4,2], 114), ([4,4], 2970), ([2,2,2], 9600)]:
+        glatt = GaussLattice(L, state_file='serial.hdf5', basedir=str(tmp_path))
+        bins = glatt.find_states().copy()
+        states = sorted(read_all_states(L, filename=glatt.state_file))
+        assert bins.sum() == n_states == len(states)
+
+        for split_depth in [None, 1, 3]:
+            glatt = GaussLattice(L, state_file='parallel.hdf5', basedir=str(tmp_path))
+            assert np.array_equal(bins, glatt.find_states(n_threads=2, split_depth=split_depth))
+            assert states == sorted(read_all_states(L, filename=glatt.state_file))
+
+    # Without output.
+    assert GaussLattice([4,4]).find_states(n_threads=2).sum() == 2970
+
+
+def test_check_tables():
+    """ The compiled (incremental and batched) Gauss law checks agree with a
+        direct evaluation of the Gauss law at every checkable site.
+    """
+    for L, kwargs in [([4,4], {}), ([2,2,2], {}), ([4,4], {'static_charges' : [[1], [15]]})]:
+        glatt = GaussLattice(L, **kwargs)
+        for level in [0, 2, glatt.N_sublattice-1]:
+            prefixes = glatt.prefixes(level)
+            candidates = [p + b for p in prefixes for b in glatt.lattice_base[level]]
+
+            expected = []
+            for latt in candidates:
+                valid = True
+                for g in glatt.checkable_gls[level]:
+                    links = glatt.get_vertex_links(g)
+                    s = sum((latt >> k) & 1 for k in links[::2]) - sum((latt >> k) & 1 for k in links[1::2])
+                    valid &= s == glatt.static_charges[g]
+                expected.append(valid)
+
+            assert expected == [glatt.check_lattice(c, level) for c in candidates]
+            assert expected == [glatt.check_level(c, level) for c in candidates]
+            words = state_words(candidates, n_words(glatt.bitlen))
+            assert expected == glatt.check_batch(words, level).tolist()
+
+
+def test_winding_module(tmp_path):
+    """ Winding numbers by popcount, for single states and batches (one and two
+        words), agree with summing the winding links.
+    """
+    from gauss_lattice.winding import winding_links, winding_numbers, sector_of
+    from gauss_lattice.aux_stuff import sort_into_sectors
+    for L in [[4,4], [2,2,4], [2,2,6]]:
+        links = winding_links(L)
+        nb = len(L)*int(np.prod(L))
+        states = [int(s) for s in np.random.randint(0, 2**62, size=100, dtype=np.int64)]
+        states = [s | (s << (nb - 62)) & ((1 << nb) - 1) for s in states] if nb > 62 else [s & ((1 << nb) - 1) for s in states]
+
+        expected = [tuple(sum((s >> int(k)) & 1 for k in l) for l in links) for s in states]
+        assert expected == [winding_numbers(s, L) for s in states]
+        assert expected == [tuple(w) for w in sector_of(states, L).tolist()]
+        assert expected == [tuple(w) for w in sector_of(state_words(states, n_words(nb)), L).tolist()]
+
+    glatt = GaussLattice([4,4], state_file='states.hdf5', basedir=str(tmp_path))
+    glatt.find_states()
+    sorted_states = sort_into_sectors(read_all_states([4,4], filename=glatt.state_file), [4,4])
+    for tag, states in read_all_states([4,4], merged=False, filename=glatt.state_file):
+        assert sorted(states) == sorted(sorted_states.get(tag, []))
+
+
+def test_sector_writer(tmp_path):
+    """ Small buffers (many flushes), other compressions and the text output
+        give the same states in the same sectors.
+    """
+    L = [4,4]
+    glatt = GaussLattice(L, state_file='reference.hdf5', basedir=str(tmp_path))
+    bins = glatt.find_states().copy()
+    reference = dict(read_all_states(L, merged=False, filename=glatt.state_file))
+
+    for kwargs in [{'buffer_length' : 100, 'batch_size' : 37}, {'compression' : 'lzf'}, {'compression' : None}]:
+        glatt = GaussLattice(L, state_file='small.hdf5', basedir=str(tmp_path), **kwargs)
+        assert np.array_equal(bins, glatt.find_states())
+        states = dict(read_all_states(L, merged=False, filename=glatt.state_file))
+        assert states.keys() == reference.keys()
+        for ws in reference:
+            assert sorted(states[ws]) == sorted(reference[ws])
+
+    glatt = GaussLattice(L, state_file='states.txt', basedir=str(tmp_path), buffer_length=500)
+    glatt.find_states(n_threads=2)
+    with open(glatt.state_file) as f:
+        assert f.readline().strip() == 'state,w_x,w_y'
+        lines = [list(map(int, l.split(','))) for l in f]
+    assert len(lines) == bins.sum()
+    for state, *w in lines:
+        assert w == glatt.get_winding_numbers(state)
+
+
+class InterruptedLattice(GaussLattice):
+    """ Stops the search in the middle of a subtree, after some states beyond
+        the last checkpoint have already been written to file.
+    """
+    n_batches = 5
+
+    def _write_batch(self, states, w):
+        super()._write_batch(states, w)
+        self.n_batches -= 1
+        if not self.n_batches:
+            self.writer.flush()
+            raise KeyboardInterrupt
+
+
+def test_resume(tmp_path):
+    """ An interrupted search, resumed from its checkpoint, gives every state
+        exactly once.
+    """
+    for L, kwargs in [([4,4], {}), ([4,4], {'static_charges' : [[1], [15]]})]:
+        glatt = GaussLattice(L, state_file='reference.hdf5', basedir=str(tmp_path), **kwargs)
+        bins = glatt.find_states().copy()
+        reference = dict(read_all_states(L, merged=False, filename=glatt.state_file))
+
+        for n_threads in [1, 2]:
+            kwargs.update(state_file='states.hdf5', basedir=str(tmp_path), checkpoint_interval=0, batch_size=10)
+            try:
+                InterruptedLattice(L, **kwargs).find_states(n_threads=n_threads)
+                assert False, 'Search was not interrupted.'
+            except KeyboardInterrupt:
+                pass
+
+            glatt = GaussLattice(L, resume=True, **kwargs)
+            assert glatt.writer.restored
+            assert np.array_equal(bins, glatt.find_states(n_threads=n_threads))
+            states = dict(read_all_states(L, merged=False, filename=glatt.state_file))
+            for ws in reference:
+                assert sorted(states[ws]) == sorted(reference[ws])
+
+            # Resuming a finished search does nothing.
+            glatt = GaussLattice(L, resume=True, **kwargs)
+            assert np.array_equal(bins, glatt.find_states(n_threads=n_threads))
+            assert len(read_all_states(L, filename=glatt.state_file)) == bins.sum()
+
+
+def test_count_states():
+    """ The transfer matrix recursion gives the winding histogram of the
+        search, also with static charges and for lattices that we can't
+        enumerate here.
+    """
+    for L, kwargs in [([4,2], {}), ([4,4], {}), ([6,4], {}), ([2,2,2], {}), ([4,4], {'static_charges' : [[1], [15]]})]:
+        glatt = GaussLattice(L, **kwargs)
+        assert np.array_equal(glatt.count_states(), glatt.find_states())
+
+    bins = GaussLattice([2,2,8]).count_states()
+    assert bins.sum() == 229668116320256
+    assert np.array_equal(bins, bins[::-1,::-1,::-1])
+
+
+def test_target_sector(tmp_path):
+    """ Searching a single winding sector gives the states of this sector
+        (and only writes this one), also in parallel and from the middle of
+        the search.
+    """
+    for L in [[4,4], [2,2,2]]:
+        glatt = GaussLattice(L, state_file='reference.hdf5', basedir=str(tmp_path))
+        bins = glatt.find_states().copy()
+        reference = dict(read_all_states(L, merged=False, filename=glatt.state_file))
+
+        sectors = [np.unravel_index(np.argmax(bins), bins.shape), (1,)*len(L), (0,)*len(L)]
+        for ws, n_threads in product(sectors, [1, 2]):
+            glatt = GaussLattice(L, state_file='sector.hdf5', basedir=str(tmp_path), winding_sector=ws)
+            expected = np.zeros_like(bins)
+            expected[ws] = bins[ws]
+            assert np.array_equal(glatt.find_states(n_threads=n_threads), expected)
+
+            states = dict(read_all_states(L, merged=False, filename=glatt.state_file))
+            assert list(states) == [winding_tag(ws)]
+            assert sorted(states[winding_tag(ws)]) == sorted(reference[winding_tag(ws)])
@@ -7,7 +7,7 @@
 ---------------------------------------------------------------------------- """
 import numpy as np
 import pytest
-from gauss_lattice.bit_magic import set_bits
+from gauss_lattice.bit_magic import set_bits, count_particles, sum_occupancies_ordered, popcount64, plaquette_sign_mask
 
 
 def test_state_gen():
@@ -18,3 +18,34 @@ def test_state_gen():
 
     with pytest.raises(ValueError):
         state = set_bits([1,1,2,3])
+
+
+def test_popcount_routines():
+    """ The popcount-based routines must agree with the bit-by-bit loops.
+    """
+    for state in np.random.randint(0, 2**62, size=50, dtype=np.int64):
+        state = int(state) << 10
+        assert count_particles(state, nb=80) == sum([(state>>k)&1 for k in range(80)])
+        assert count_particles(state) == sum([(state>>k)&1 for k in range(64)])
+
+        b, a = sorted(np.random.randint(0, 72, size=2))
+        assert sum_occupancies_ordered(a, b, state) == sum([(state>>k)&1 for k in range(b,a+1)])
+
+    states = np.random.randint(0, 2**63, size=50, dtype=np.int64).astype(np.uint64)
+    expected = [bin(int(s)).count('1') for s in states]
+    assert expected == popcount64(states).tolist()
+
+
+def test_plaquette_sign_mask():
+    """ One AND and one popcount with the precomputed mask must give the same
+        sign as summing the occupancies link by link.
+    """
+    p = [19, 14, 7, 20]
+    r, c = plaquette_sign_mask(p)
+    for state in np.random.randint(0, 2**24, size=50):
+        state = int(state)
+        n, new_state = 0, state
+        for k in range(4):
+            n += sum_occupancies_ordered(max(p), p[k], new_state)
+            new_state ^= 1 << p[k]
+        assert (-1)**n == (-1)**(bin(state & r).count('1') + c)